@@ -78,6 +78,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'core.middleware.EntitlementMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'allauth.account.middleware.AccountMiddleware',
@@ -119,13 +120,46 @@ WSGI_APPLICATION = 'config.wsgi.application'
 
 DATABASE_PATH = os.getenv('DATABASE_PATH', BASE_DIR / 'db.sqlite3')
 
+# Visits, rollups, sessions and login attempts (see core.routers), next to the
+# content database by default
+ANALYTICS_DATABASE_PATH = os.getenv('ANALYTICS_DATABASE_PATH', Path(DATABASE_PATH).with_name('analytics.sqlite3'))
+
+# core.backends.sqlite3 applies WAL, a busy timeout and BEGIN IMMEDIATE on top
+# of Django's SQLite backend; connections are kept for CONN_MAX_AGE seconds.
+DATABASE_CONN_MAX_AGE = int(os.getenv('DATABASE_CONN_MAX_AGE', 600))
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'core.backends.sqlite3',
         'NAME': DATABASE_PATH,
-    }
+        'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+    },
+    'analytics': {
+        'ENGINE': 'core.backends.sqlite3',
+        'NAME': ANALYTICS_DATABASE_PATH,
+        'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            # Throughput over durability: NORMAL only syncs at checkpoints
+            'pragmas': {
+                'synchronous': 'NORMAL',
+                'mmap_size': 128 * 1024 * 1024,
+            },
+        },
+    },
 }
 
+# Optional read-only connection for listing views (see core.routers.read_db)
+if os.getenv('DATABASE_READ_ONLY_ALIAS', 'False') == 'True':
+    DATABASES['read'] = {
+        **DATABASES['default'],
+        'OPTIONS': {'read_only': True},
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['core.routers.AnalyticsRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
@@ -171,12 +205,61 @@ STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Media delivery (see core.media). 'django' streams files from the worker;
+# 'x-accel' (nginx, with an internal location at MEDIA_ACCEL_PREFIX aliased to
+# MEDIA_ROOT) or 'x-sendfile' hands the body off to the front proxy.
+MEDIA_SERVE_MODE = os.getenv('MEDIA_SERVE_MODE', 'django')
+MEDIA_ACCEL_PREFIX = os.getenv('MEDIA_ACCEL_PREFIX', '/protected-media/')
+MEDIA_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Encrypted documents are only served through their protected views.
+MEDIA_PRIVATE_PREFIXES = ('articles/pdfs/',)
+
 # Security settings
 X_FRAME_OPTIONS = 'SAMEORIGIN'
 
+# Cache shared by every gunicorn worker on the host, without an external
+# service. Point CACHE_DIR at tmpfs (e.g. /dev/shm/helkein-cache) in production.
+CACHE_DIR = os.getenv('CACHE_DIR', str(BASE_DIR / '.cache'))
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': CACHE_DIR,
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+    # Kept apart so page cache culling never drops sessions
+    'sessions': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(CACHE_DIR, 'sessions'),
+        'TIMEOUT': None,
+        'OPTIONS': {'MAX_ENTRIES': 50000},
+    },
+}
+
+# Sessions are only created by login, signup and checkout: anonymous browsing
+# stores nothing (see core.sessions). Reads come from the cache, the rows in
+# the analytics database are the fallback; clear_expired_sessions prunes them.
+SESSION_ENGINE = os.getenv('SESSION_ENGINE', 'django.contrib.sessions.backends.cached_db')
+SESSION_CACHE_ALIAS = 'sessions'
+# Messages never need a session either
+MESSAGE_STORAGE = 'django.contrib.messages.storage.cookie.CookieStorage'
+
+# Tests use a throwaway copy of CACHES (see core/test_runner.py)
+TEST_RUNNER = 'core.test_runner.TestRunner'
+
 # Encryption Key
 ENCRYPTION_KEY = b'W4aUSGSXOHwvuxVudV8_pLPGH6jILOEfgg_lm8SPIIc='
 
+# Shared cache of decrypted documents (see core.document_cache); disabled when empty.
+# Use a tmpfs path such as /dev/shm/helkein-documents.
+DECRYPTED_CACHE_DIR = os.getenv('DECRYPTED_CACHE_DIR', '')
+DECRYPTED_CACHE_MAX_BYTES = int(os.getenv('DECRYPTED_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+# Full-page cache of anonymous responses (see core.page_cache)
+PAGE_CACHE_TIMEOUT = int(os.getenv('PAGE_CACHE_TIMEOUT', 60 * 60))
+PAGE_CACHE_STALE_TIMEOUT = int(os.getenv('PAGE_CACHE_STALE_TIMEOUT', 60 * 5))
+
 # Authentication Backends
 AUTHENTICATION_BACKENDS = [
     'axes.backends.AxesStandaloneBackend',
@@ -241,6 +324,16 @@ AXES_LOCKOUT_TEMPLATE = 'axes/lockout.html' # Optional: create a custom lockout
 
 STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET')
 
+# View counters (see core/counters.py)
+# Buffered Article/Course view increments are written after this many hits
+# or seconds, whichever comes first.
+VIEW_COUNTER_FLUSH_HITS = int(os.getenv('VIEW_COUNTER_FLUSH_HITS', 100))
+VIEW_COUNTER_FLUSH_INTERVAL = int(os.getenv('VIEW_COUNTER_FLUSH_INTERVAL', 10))
+
+# Daily visits (see core/visits.py)
+# Seconds between merges of each worker's unique-visitor sketch into DailyVisit.
+VISIT_FLUSH_INTERVAL = int(os.getenv('VISIT_FLUSH_INTERVAL', 30))
+
 # CKEditor Configuration
 CKEDITOR_UPLOAD_PATH = "uploads/"
 CKEDITOR_IMAGE_BACKEND = "pillow"
@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import Plan, UserProfile, Article, Course, Lesson, Module, Artigo, Ensaio, Resenha, Recomendacao, Multimidia, Comment, ShopItem, PaymentHistory, DailyVisit
+from django.utils import timezone
+from .models import Plan, UserProfile, Article, Course, Lesson, Module, Artigo, Ensaio, Resenha, Recomendacao, Multimidia, Comment, ShopItem, PaymentHistory, DailyVisit, MetricRollup, StripeEvent, Tag, RelatedArticle
 
 class ArticleAdmin(admin.ModelAdmin):
     list_display = ('title', 'category', 'status', 'views', 'created_at')
@@ -81,4 +82,34 @@ admin.site.register(Comment)
 admin.site.register(ShopItem)
 admin.site.register(PaymentHistory)
 admin.site.register(DailyVisit)
+
+@admin.register(MetricRollup)
+class MetricRollupAdmin(admin.ModelAdmin):
+    list_display = ('metric', 'period', 'bucket', 'value')
+    list_filter = ('metric', 'period')
+
+@admin.register(Tag)
+class TagAdmin(admin.ModelAdmin):
+    list_display = ('name', 'slug', 'published_count')
+    search_fields = ('name', 'slug')
+    readonly_fields = ('published_count',)
+
+@admin.register(RelatedArticle)
+class RelatedArticleAdmin(admin.ModelAdmin):
+    list_display = ('article', 'rank', 'related', 'score')
+    list_select_related = ('article', 'related')
+    search_fields = ('article__title',)
+
+@admin.register(StripeEvent)
+class StripeEventAdmin(admin.ModelAdmin):
+    list_display = ('event_id', 'type', 'status', 'attempts', 'next_attempt_at', 'received_at')
+    list_filter = ('status', 'type')
+    search_fields = ('event_id',)
+    readonly_fields = ('received_at', 'processed_at')
+    actions = ['retry_events']
+
+    @admin.action(description='Reprocessar eventos selecionados')
+    def retry_events(self, request, queryset):
+        queryset.exclude(status='processed').update(status='pending', attempts=0, next_attempt_at=timezone.now())
+
 # admin.site.register(Article, ArticleAdmin) # Optional: Keep generic view or remove
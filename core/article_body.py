@@ -0,0 +1,143 @@
+"""
+Article body render pipeline, run once when an ``Article`` is saved.
+
+``render_body`` turns the CKEditor HTML into the HTML actually shown on the
+detail page: ``<h2>``/``<h3>`` get stable anchors and are collected into a
+table of contents, images get ``loading="lazy"``, and links to other sites
+open in a new tab with ``rel="noopener noreferrer"``. It also counts words
+for the reading time. The result is stored on the article
+(``content_html``, ``content_toc``, ``word_count``, ``reading_time``)
+together with ``RENDER_VERSION``. Bump the version whenever the output
+changes, then run ``rebuild_article_bodies``.
+"""
+import math
+import re
+from html import escape, unescape
+from html.parser import HTMLParser
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.utils.text import slugify
+
+RENDER_VERSION = 2
+WORDS_PER_MINUTE = 200
+TOC_LEVELS = ('h2', 'h3')
+WORD_RE = re.compile(r'\w+')
+SKIPPED_TEXT_TAGS = ('script', 'style')
+
+
+class RenderedBody:
+    def __init__(self, html, toc, word_count):
+        self.html = html
+        self.toc = toc
+        self.word_count = word_count
+
+    @property
+    def reading_time(self):
+        return max(1, math.ceil(self.word_count / WORDS_PER_MINUTE)) if self.word_count else 0
+
+
+def is_external(href):
+    parts = urlsplit(href)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        return False
+    hosts = [host.lstrip('.') for host in settings.ALLOWED_HOSTS if host != '*']
+    return not any(parts.hostname == host or parts.hostname.endswith('.' + host) for host in hosts)
+
+
+def render_tag(tag, attrs, closed=False):
+    rendered = ''.join(f' {name}' if value is None else f' {name}="{escape(value)}"' for name, value in attrs)
+    return f'<{tag}{rendered}{" /" if closed else ""}>'
+
+
+class BodyRenderer(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.out = []
+        self.toc = []
+        self.ids = set()
+        self.text = []
+        self.skipping = 0
+        # Pending heading: [output index of its start tag, tag, attrs, text parts]
+        self.heading = None
+
+    def handle_starttag(self, tag, attrs, closed=False):
+        raw = self.get_starttag_text()
+        attrs_dict = dict(attrs)
+        # Tags separate words (<p>a</p><p>b</p>)
+        self.text.append(' ')
+        if tag in SKIPPED_TEXT_TAGS:
+            self.skipping += 1
+        elif tag in TOC_LEVELS and self.heading is None:
+            self.heading = [len(self.out), tag, attrs, []]
+        elif tag == 'img' and 'loading' not in attrs_dict:
+            raw = render_tag(tag, attrs + [('loading', 'lazy')], closed)
+        elif tag == 'a' and is_external(attrs_dict.get('href') or ''):
+            attrs = [(n, v) for n, v in attrs if n not in ('target', 'rel')]
+            raw = render_tag(tag, attrs + [('target', '_blank'), ('rel', 'noopener noreferrer')], closed)
+        self.out.append(raw)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs, closed=True)
+
+    def handle_endtag(self, tag):
+        self.text.append(' ')
+        if tag in SKIPPED_TEXT_TAGS and self.skipping:
+            self.skipping -= 1
+        elif self.heading and tag == self.heading[1]:
+            self.close_heading()
+        self.out.append(f'</{tag}>')
+
+    def close_heading(self):
+        index, tag, attrs, parts = self.heading
+        self.heading = None
+        text = ' '.join(unescape(''.join(parts)).split())
+        if not text:
+            return
+        anchor = (dict(attrs).get('id') or '').strip()
+        if not anchor or anchor in self.ids:
+            # Headings of only punctuation or emoji have no slug: use their position
+            base = slugify(text) or f'secao-{len(self.toc) + 1}'
+            anchor, n = base, 2
+            while anchor in self.ids:
+                anchor, n = f'{base}-{n}', n + 1
+            self.out[index] = render_tag(tag, [(name, value) for name, value in attrs if name != 'id'] + [('id', anchor)])
+        self.ids.add(anchor)
+        self.toc.append({'level': int(tag[1]), 'id': anchor, 'text': text})
+
+    def handle_data(self, data):
+        self.out.append(data)
+        if self.skipping:
+            return
+        self.text.append(data)
+        if self.heading:
+            self.heading[3].append(data)
+
+    def handle_entityref(self, name):
+        self.handle_data(f'&{name};')
+
+    def handle_charref(self, name):
+        self.handle_data(f'&#{name};')
+
+    def handle_comment(self, data):
+        self.out.append(f'<!--{data}-->')
+
+    def handle_decl(self, decl):
+        self.out.append(f'<!{decl}>')
+
+    def unknown_decl(self, data):
+        self.out.append(f'<![{data}]>')
+
+    def handle_pi(self, data):
+        self.out.append(f'<?{data}>')
+
+
+def render_body(html):
+    renderer = BodyRenderer()
+    renderer.feed(html or '')
+    renderer.close()
+    if renderer.heading:
+        renderer.close_heading()
+    # CKEditor writes accents as entities: count words on the decoded text
+    words = len(WORD_RE.findall(unescape(''.join(renderer.text))))
+    return RenderedBody(''.join(renderer.out), renderer.toc, words)
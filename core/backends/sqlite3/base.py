@@ -0,0 +1,63 @@
+"""
+SQLite backend tuned for several gunicorn workers sharing one file.
+
+Compared with ``django.db.backends.sqlite3``:
+
+* Every new connection applies ``DEFAULT_PRAGMAS`` updated with
+  ``OPTIONS['pragmas']``: WAL (readers never block the writer), a busy
+  timeout, in-memory temporary tables and a larger page cache.
+* Transactions start with ``BEGIN IMMEDIATE`` unless
+  ``OPTIONS['transaction_mode']`` says otherwise. A deferred transaction that
+  reads and then writes can fail at once with "database is locked" when
+  another connection wrote in between; an immediate one takes the write lock
+  up front, waiting for it under the busy timeout.
+* ``OPTIONS['read_only']`` opens the file in ``mode=ro`` with
+  ``query_only``, for the read alias used by listing views.
+
+Combine with ``CONN_MAX_AGE`` so the pragmas are paid once per worker rather
+than once per request.
+"""
+from urllib.parse import quote
+
+from django.db.backends.sqlite3 import base
+
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'FULL',
+    'busy_timeout': 10000,
+    'temp_store': 'MEMORY',
+    # Negative: KiB rather than pages
+    'cache_size': -16000,
+}
+# Pragmas a read-only connection cannot (and need not) change
+WRITE_PRAGMAS = ('journal_mode',)
+
+
+def pragma_statements(pragmas, read_only=False):
+    merged = {**DEFAULT_PRAGMAS, **(pragmas or {})}
+    statements = [f'PRAGMA {name} = {value}' for name, value in merged.items() if not (read_only and name in WRITE_PRAGMAS)]
+    if read_only:
+        statements.append('PRAGMA query_only = ON')
+    return statements
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        # Ours, not sqlite3.connect() arguments
+        self.pragmas = kwargs.pop('pragmas', {})
+        self.read_only = kwargs.pop('read_only', False)
+        # A read-only connection never takes the write lock
+        if 'transaction_mode' not in self.settings_dict['OPTIONS'] and not self.read_only:
+            self.transaction_mode = 'IMMEDIATE'
+        database = str(kwargs['database'])
+        # In-memory and URI names (test databases) are left alone
+        if self.read_only and not database.startswith('file:') and database != ':memory:':
+            kwargs['database'] = f'file:{quote(database)}?mode=ro'
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for statement in pragma_statements(self.pragmas, self.read_only):
+            conn.execute(statement)
+        return conn
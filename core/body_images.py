@@ -0,0 +1,248 @@
+"""
+Optimization of images uploaded through CKEditor into article bodies.
+
+``optimize_upload`` writes a metadata-free WebP copy of an upload, at most
+``BODY_IMAGE_MAX_WIDTH`` pixels wide, under a deterministic name::
+
+    optimized/<upload name without extension>-<stamp>.webp
+
+A ``.json`` file next to it records its dimensions; it is also cached, so
+looking a copy up never opens an image.
+
+``rewrite_images`` points every ``<img>`` in an article body that references
+an upload at its optimized copy, and adds ``width``/``height`` (from the
+editor's inline size when present), ``loading="lazy"`` and
+``decoding="async"``. Tags are parsed with ``html.parser`` and rebuilt with
+escaped values, so unquoted and boolean attributes survive. It is
+idempotent and, by default, only uses copies that already exist, so it runs
+on every ``Article`` save (``Article.compile_content``) without encoding
+anything. ``optimize_body_images`` (run periodically from entrypoint.sh)
+encodes the uploads that have no copy yet, in parallel, and then rewrites
+only the articles that reference them.
+"""
+import hashlib
+import io
+import json
+import logging
+import posixpath
+import re
+from html.parser import HTMLParser
+from urllib.parse import unquote
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+from .article_body import render_tag
+
+logger = logging.getLogger(__name__)
+
+OPTIMIZED_DIR = 'optimized'
+DEFAULT_MAX_WIDTH = 1600
+WEBP_OPTIONS = {'quality': 82, 'method': 6}
+SKIPPED_EXTENSIONS = ('.gif', '.svg')
+COPY_CACHE_TIMEOUT = 60 * 60 * 24
+
+STYLE_SIZE_RE = re.compile(r'(width|height)\s*:\s*(\d+)px', re.IGNORECASE)
+
+
+def max_width():
+    return getattr(settings, 'BODY_IMAGE_MAX_WIDTH', DEFAULT_MAX_WIDTH)
+
+
+def upload_prefix():
+    return posixpath.join(settings.MEDIA_URL, settings.CKEDITOR_UPLOAD_PATH)
+
+
+def is_optimizable(name):
+    base = posixpath.splitext(name)[0]
+    return (
+        not name.lower().endswith(SKIPPED_EXTENSIONS)
+        # CKEditor's own browser thumbnails
+        and not base.endswith('_thumb')
+    )
+
+
+def optimized_name(name):
+    stamp = hashlib.sha256(
+        f'{default_storage.size(name)}|{default_storage.get_modified_time(name).timestamp()}'.encode()
+    ).hexdigest()[:10]
+    return f'{OPTIMIZED_DIR}/{posixpath.splitext(name)[0]}-{stamp}.webp'
+
+
+def copy_cache_key(target):
+    return f'body_images:size:{hashlib.md5(target.encode()).hexdigest()}'
+
+
+def size_name(target):
+    return posixpath.splitext(target)[0] + '.json'
+
+
+def record_size(target, width, height):
+    name = size_name(target)
+    if default_storage.exists(name):
+        default_storage.delete(name)
+    default_storage.save(name, ContentFile(json.dumps([width, height]).encode()))
+    cache.set(copy_cache_key(target), [width, height], COPY_CACHE_TIMEOUT)
+
+
+def copy_size(target):
+    """``[width, height]`` of the optimized copy ``target``, or None when it does not exist yet."""
+    size = cache.get(copy_cache_key(target))
+    if size is not None:
+        return size
+    if default_storage.exists(size_name(target)):
+        with default_storage.open(size_name(target)) as f:
+            size = json.loads(f.read())
+    elif default_storage.exists(target):
+        # Written before sizes were recorded: measured once
+        with default_storage.open(target) as f:
+            size = list(Image.open(f).size)
+        record_size(target, *size)
+    else:
+        return None
+    cache.set(copy_cache_key(target), size, COPY_CACHE_TIMEOUT)
+    return size
+
+
+def optimized_copy(name):
+    """
+    Return ``(optimized name, width, height)`` when the upload ``name`` already
+    has an optimized copy, otherwise None. Never encodes anything.
+    """
+    if not is_optimizable(name) or not default_storage.exists(name):
+        return None
+    try:
+        target = optimized_name(name)
+        size = copy_size(target)
+        return (target, *size) if size is not None else None
+    except Exception:
+        logger.exception("Error reading optimized copy of %s", name)
+        return None
+
+
+def optimize_upload(name):
+    """
+    Return ``(optimized name, width, height)`` for the upload ``name``
+    (relative to MEDIA_ROOT), writing the optimized copy if needed. Returns
+    None when the file cannot be optimized.
+    """
+    existing = optimized_copy(name)
+    if existing is not None or not is_optimizable(name) or not default_storage.exists(name):
+        return existing
+    try:
+        target = optimized_name(name)
+        with default_storage.open(name) as f:
+            image = ImageOps.exif_transpose(Image.open(f))
+            image.load()
+        if image.width > max_width():
+            image = image.resize((max_width(), max(1, round(image.height * max_width() / image.width))), Image.LANCZOS)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+        buffer = io.BytesIO()
+        # No exif/icc arguments: metadata is dropped
+        image.save(buffer, 'WEBP', **WEBP_OPTIONS)
+        target = default_storage.save(target, ContentFile(buffer.getvalue()))
+        record_size(target, image.width, image.height)
+        return target, image.width, image.height
+    except Exception:
+        logger.exception("Error optimizing body image %s", name)
+        return None
+
+
+def rewrite_tag(attrs, optimize=optimized_copy):
+    """Return the attributes of an ``<img>`` pointed at its optimized copy, or None to keep it."""
+    attrs = dict(attrs)
+    src = attrs.get('src') or ''
+    if not src.startswith(upload_prefix()):
+        return None
+
+    result = optimize(unquote(src[len(settings.MEDIA_URL):]))
+    if result is None:
+        return None
+    name, width, height = result
+
+    # The editor's inline size is what is displayed; keep its aspect ratio
+    styled = {key.lower(): int(value) for key, value in STYLE_SIZE_RE.findall(attrs.get('style') or '')}
+    if 'width' in styled and 'height' in styled:
+        width, height = styled['width'], styled['height']
+
+    attrs.update({'src': default_storage.url(name), 'width': str(width), 'height': str(height)})
+    attrs.setdefault('loading', 'lazy')
+    attrs.setdefault('decoding', 'async')
+    return list(attrs.items())
+
+
+class ImageRewriter(HTMLParser):
+    """Copies the markup through, rebuilding only the ``<img>`` tags that change."""
+
+    def __init__(self, optimize):
+        super().__init__(convert_charrefs=False)
+        self.optimize = optimize
+        self.out = []
+
+    def handle_starttag(self, tag, attrs, closed=False):
+        raw = self.get_starttag_text()
+        if tag == 'img':
+            rewritten = rewrite_tag(attrs, self.optimize)
+            if rewritten is not None:
+                raw = render_tag(tag, rewritten, closed=True)
+        self.out.append(raw)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs, closed=True)
+
+    def handle_endtag(self, tag):
+        self.out.append(f'</{tag}>')
+
+    def handle_data(self, data):
+        self.out.append(data)
+
+    def handle_entityref(self, name):
+        self.out.append(f'&{name};')
+
+    def handle_charref(self, name):
+        self.out.append(f'&#{name};')
+
+    def handle_comment(self, data):
+        self.out.append(f'<!--{data}-->')
+
+    def handle_decl(self, decl):
+        self.out.append(f'<!{decl}>')
+
+    def unknown_decl(self, data):
+        self.out.append(f'<![{data}]>')
+
+    def handle_pi(self, data):
+        self.out.append(f'<?{data}>')
+
+
+def rewrite_images(html, optimize=optimized_copy):
+    """
+    Return ``html`` with uploaded images pointing at their optimized copies.
+    ``optimize`` maps an upload name to ``(name, width, height)`` or None.
+    """
+    if not html or '<img' not in html.lower():
+        return html
+    rewriter = ImageRewriter(optimize)
+    rewriter.feed(html)
+    rewriter.close()
+    return ''.join(rewriter.out)
+
+
+def upload_names():
+    """Every optimizable file under ``CKEDITOR_UPLOAD_PATH``."""
+    pending = [settings.CKEDITOR_UPLOAD_PATH.rstrip('/')]
+    while pending:
+        directory = pending.pop()
+        try:
+            dirs, files = default_storage.listdir(directory)
+        except FileNotFoundError:
+            continue
+        pending.extend(posixpath.join(directory, d) for d in dirs)
+        for filename in files:
+            name = posixpath.join(directory, filename)
+            if is_optimizable(name):
+                yield name
@@ -0,0 +1,135 @@
+"""
+Threaded comment loading for article and lesson pages.
+
+Top-level threads of an ``Article`` or ``Lesson`` are paginated in SQL with
+an opaque cursor built from ``(created_at, id)``. The replies of the page's
+threads are then fetched in one query (a recursive CTE over ``parent_id``,
+with ``select_related('user')``) and assembled into a tree in memory, so
+templates never touch ``comment.replies``. The query count and memory use
+stay constant no matter how long the discussion gets.
+"""
+import datetime
+
+from django.db.models import Count, Q
+from django.db.models.expressions import RawSQL
+
+from .models import Comment
+
+COMMENTS_PER_PAGE = 50
+CURSOR_PARAM = 'comentarios'
+
+
+class CommentTree:
+    """
+    One page of top-level comments plus all of their nested replies.
+
+    Each comment in ``roots`` (and below) carries a ``children`` list ordered
+    oldest first, and a ``reply_count`` with the number of descendants.
+    """
+
+    def __init__(self, roots, total, root_count, next_cursor):
+        self.roots = roots
+        self.total = total
+        self.root_count = root_count
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.roots)
+
+    def __len__(self):
+        return len(self.roots)
+
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+# Active comments reachable from ``{start}`` through active parents only.
+THREAD_SQL = (
+    'WITH RECURSIVE thread(id) AS ('
+    'SELECT id FROM {table} WHERE active = %s AND {column} = %s AND {start} '
+    'UNION ALL '
+    'SELECT c.id FROM {table} c JOIN thread t ON c.parent_id = t.id '
+    'WHERE c.active = %s AND c.{column} = %s'
+    ') SELECT id FROM thread'
+)
+
+
+def encode_cursor(comment):
+    return f"{(comment.created_at - EPOCH) // MICROSECOND}-{comment.pk}"
+
+
+def decode_cursor(cursor):
+    """Return the ``(created_at, id)`` key for a cursor, or None if invalid."""
+    try:
+        timestamp, pk = cursor.split('-', 1)
+        return EPOCH + datetime.timedelta(microseconds=int(timestamp)), int(pk)
+    except (AttributeError, ValueError, OverflowError):
+        return None
+
+
+def thread_ids(column, owner_id, start, start_params=()):
+    sql = THREAD_SQL.format(table=Comment._meta.db_table, column=column, start=start)
+    return RawSQL(sql, (True, owner_id, *start_params, True, owner_id))
+
+
+def load_comment_tree(article=None, lesson=None, cursor=None, per_page=COMMENTS_PER_PAGE):
+    """
+    Load one page of the comment tree for ``article`` or ``lesson``.
+
+    Replies whose parent is inactive (or belongs to another object) are
+    dropped together with their subtree, matching what the templates used to
+    show. ``cursor`` is the value from a previous page's ``next_cursor``.
+    Runs three queries: the counts, the page of threads and their replies.
+    """
+    column, owner_id = ('article_id', article.pk) if article is not None else ('lesson_id', lesson.pk)
+    comments = Comment.objects.filter(active=True, **{column: owner_id})
+
+    counts = Comment.objects.filter(pk__in=thread_ids(column, owner_id, 'parent_id IS NULL')).aggregate(
+        total=Count('pk'), roots=Count('pk', filter=Q(parent=None)),
+    )
+
+    # Newest threads first, like the Comment model's default ordering.
+    roots = comments.filter(parent=None).select_related('user').order_by('-created_at', '-id')
+    position = decode_cursor(cursor) if cursor else None
+    if position is not None:
+        created_at, pk = position
+        roots = roots.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+    roots = list(roots[:per_page + 1])
+    next_cursor = None
+    if len(roots) > per_page:
+        roots = roots[:per_page]
+        next_cursor = encode_cursor(roots[-1])
+
+    by_id = {}
+    for root in roots:
+        root.children = []
+        root.reply_count = 0
+        by_id[root.pk] = root
+    if roots:
+        placeholders = ', '.join(['%s'] * len(roots))
+        replies = Comment.objects.filter(
+            pk__in=thread_ids(column, owner_id, f'parent_id IN ({placeholders})', [root.pk for root in roots])
+        ).select_related('user').order_by('created_at', 'id')
+        replies = list(replies)
+        for reply in replies:
+            reply.children = []
+            reply.reply_count = 0
+            by_id[reply.pk] = reply
+        for reply in replies:
+            by_id[reply.parent_id].children.append(reply)
+
+        # Count descendants bottom-up.
+        stack = [(root, False) for root in roots]
+        while stack:
+            node, visited = stack.pop()
+            if visited:
+                node.reply_count = sum(1 + child.reply_count for child in node.children)
+                continue
+            stack.append((node, True))
+            stack.extend((child, False) for child in node.children)
+
+    return CommentTree(roots, counts['total'], counts['roots'], next_cursor)
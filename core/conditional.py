@@ -0,0 +1,91 @@
+"""
+Conditional GET for content pages.
+
+``article_detail``, ``course_detail`` and ``content_list`` compute a weak
+``ETag`` from what the page shows before rendering it: the ``updated_at`` of
+the object (or the count and latest ``updated_at`` of the listed objects),
+the article's render version and comments, and the reader's entitlement,
+since gated content and the header differ per user. Data without a timestamp
+of its own (related articles, plans) is covered by the page cache group
+versions (see ``core.page_cache``).
+
+A matching ``If-None-Match`` gets ``304 Not Modified`` without rendering.
+No ``Last-Modified`` is sent: a date cannot express the reader's tier,
+deletions or group versions, so ``If-Modified-Since`` alone would answer 304
+with a stale page. Views count the page view before checking, so
+revalidations are counted like full hits. Pages are sent with
+``Cache-Control: private, no-cache`` so browsers revalidate each time.
+"""
+import hashlib
+
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+
+from .entitlements import get_entitlement
+from .page_cache import group_versions
+
+
+class Validators:
+    def __init__(self, parts):
+        digest = hashlib.md5('|'.join(str(part) for part in parts).encode()).hexdigest()
+        # Weak: the markup differs by CSRF token masking between renders
+        self.etag = f'W/"{digest}"'
+
+    def not_modified(self, request):
+        """Return a 304 response when the client's copy is current, otherwise None."""
+        if request.method not in ('GET', 'HEAD'):
+            return None
+        response = get_conditional_response(request, etag=self.etag)
+        return self.apply(response) if response is not None else None
+
+    def apply(self, response):
+        response['ETag'] = self.etag
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ['Cookie'])
+        return response
+
+
+def reader_tier(request):
+    entitlement = get_entitlement(request.user)
+    return f'{entitlement.user_id or "-"}:{entitlement.plan_level}'
+
+
+def latest(*stamps):
+    stamps = [stamp for stamp in stamps if stamp is not None]
+    return max(stamps) if stamps else None
+
+
+def listing_stamp(items):
+    """Return ``(count, latest updated_at)`` for a queryset or a list of objects."""
+    if isinstance(items, list):
+        return len(items), latest(*(item.updated_at for item in items))
+    stamp = items.order_by().aggregate(count=Count('pk'), latest=Max('updated_at'))
+    return stamp['count'], stamp['latest']
+
+
+def article_validators(request, article):
+    comments = article.comments.filter(active=True).aggregate(count=Count('pk'), latest=Max('created_at'))
+    return Validators(
+        (
+            'article', article.pk, article.updated_at.isoformat(), article.content_version,
+            comments['count'], comments['latest'], *group_versions(('articles', 'plans')), reader_tier(request),
+        ),
+    )
+
+
+def course_validators(request, course, outline):
+    structure = hashlib.md5(repr((outline.modules, outline.lessons)).encode()).hexdigest()
+    return Validators(
+        ('course', course.pk, course.updated_at.isoformat(), structure, reader_tier(request)),
+    )
+
+
+def listing_validators(request, articles, courses):
+    article_count, articles_updated = listing_stamp(articles)
+    course_count, courses_updated = listing_stamp(courses)
+    return Validators(
+        (
+            'listing', article_count, articles_updated, course_count, courses_updated,
+            *group_versions(('articles', 'plans')), reader_tier(request),
+        ),
+    )
@@ -0,0 +1,163 @@
+"""
+Write-buffered view counters for ``Article.views`` and ``Course.views``.
+
+Page views are added to an in-process buffer instead of issuing an
+``UPDATE ... SET views = views + 1`` per hit. The buffer is flushed as a few
+batched ``F('views') + n`` updates (one per distinct increment) when
+``VIEW_COUNTER_FLUSH_HITS`` hits or ``VIEW_COUNTER_FLUSH_INTERVAL`` seconds
+have accumulated, checked after each response has been sent
+(``request_finished``), and when a gunicorn worker exits (``worker_exit`` in
+``gunicorn.conf.py``).
+
+Each gunicorn worker keeps its own buffer. Because flushes only ever add
+deltas, counts stay correct across workers without any coordination. Each
+worker also publishes its pending total to the cache so the staff dashboard
+can show how many increments are still waiting to be written. Workers claim
+one of ``WORKER_SLOTS`` cache keys with ``cache.add`` and only ever write
+their own, so no shared value is read, modified and written back.
+"""
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+
+logger = logging.getLogger(__name__)
+
+SLOT_KEY = 'view_counters:slot:{slot}'
+WORKER_SLOTS = 64
+PENDING_TIMEOUT = 60 * 60
+
+
+class ViewCounterBuffer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = defaultdict(int)
+        self._hits = 0
+        self._last_flush = time.monotonic()
+        self._last_publish = 0.0
+        self._slot = None
+
+    @property
+    def flush_hits(self):
+        return getattr(settings, 'VIEW_COUNTER_FLUSH_HITS', 100)
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, 'VIEW_COUNTER_FLUSH_INTERVAL', 10)
+
+    def incr(self, model, pk, amount=1):
+        with self._lock:
+            self._counts[(model._meta.label, pk)] += amount
+            self._hits += amount
+        self._publish_pending()
+
+    def discard(self):
+        """Drop every buffered increment without writing it."""
+        with self._lock:
+            self._counts.clear()
+            self._hits = 0
+
+    def pending(self):
+        with self._lock:
+            return self._hits
+
+    def is_due(self):
+        with self._lock:
+            if not self._hits:
+                return False
+            return (
+                self._hits >= self.flush_hits
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            )
+
+    def flush_if_due(self):
+        if self.is_due():
+            return self.flush()
+        return 0
+
+    def flush(self):
+        """Write every buffered increment to the database. Returns the hit count."""
+        with self._lock:
+            counts, self._counts = self._counts, defaultdict(int)
+            hits, self._hits = self._hits, 0
+            self._last_flush = time.monotonic()
+        if not counts:
+            return 0
+
+        # Group objects by delta so each distinct increment is one UPDATE.
+        batches = defaultdict(list)
+        for (label, pk), delta in counts.items():
+            batches[(label, delta)].append(pk)
+
+        try:
+            with transaction.atomic():
+                for (label, delta), pks in batches.items():
+                    apps.get_model(label).objects.filter(pk__in=pks).update(views=F('views') + delta)
+        except Exception:
+            # Put the increments back so the next flush retries them.
+            logger.exception("Error flushing view counters")
+            with self._lock:
+                for key, delta in counts.items():
+                    self._counts[key] += delta
+                self._hits += hits
+            return 0
+        finally:
+            self._publish_pending(force=True)
+        return hits
+
+    def _publish_pending(self, force=False):
+        """Share this worker's pending total through the cache, at most once a second."""
+        now = time.monotonic()
+        if not force and now - self._last_publish < 1:
+            return
+        self._last_publish = now
+        value = (os.getpid(), self.pending())
+        try:
+            if self._slot is not None and self._owns_slot(self._slot):
+                cache.set(SLOT_KEY.format(slot=self._slot), value, PENDING_TIMEOUT)
+                return
+            # First publish, a slot inherited across fork, or one that expired and was taken
+            self._slot = None
+            for slot in range(WORKER_SLOTS):
+                if cache.add(SLOT_KEY.format(slot=slot), value, PENDING_TIMEOUT) and self._owns_slot(slot):
+                    self._slot = slot
+                    return
+            logger.warning("No free view counter slot to publish pending increments")
+        except Exception:
+            logger.exception("Error publishing pending view counters")
+
+    def _owns_slot(self, slot):
+        value = cache.get(SLOT_KEY.format(slot=slot))
+        return value is not None and value[0] == os.getpid()
+
+
+view_counters = ViewCounterBuffer()
+
+
+def count_view(obj):
+    """Buffer one page view of an ``Article`` or ``Course``."""
+    view_counters.incr(obj._meta.concrete_model, obj.pk)
+
+
+def pending_increments():
+    """Return the number of buffered increments across every worker."""
+    published = cache.get_many([SLOT_KEY.format(slot=slot) for slot in range(WORKER_SLOTS)])
+    # Slots of restarted or gone workers expire after PENDING_TIMEOUT.
+    pid = os.getpid()
+    others = sum(pending for owner, pending in published.values() if owner != pid)
+    return others + view_counters.pending()
+
+
+def flush_view_counters(**kwargs):
+    return view_counters.flush()
+
+
+def flush_view_counters_if_due(**kwargs):
+    return view_counters.flush_if_due()
@@ -0,0 +1,360 @@
+"""
+Shared cache of decrypted documents.
+
+When ``DECRYPTED_CACHE_DIR`` is set (ideally on tmpfs, e.g.
+``/dev/shm/helkein-documents``), ``EncryptedFileSystemStorage`` keeps the
+plaintext of recently opened files there, so a popular PDF is decrypted once
+rather than on every download. Every gunicorn worker uses the same directory.
+
+Entries are keyed by storage name plus the stored file's mtime and size, so
+a replaced file is never served from a stale entry. A miss does not decrypt
+ahead of the reader: the plaintext is copied into the entry as it is read
+(``filling``), and the entry is only kept when the file was read from start
+to end, so a range request decrypts no more than its range. An entry's
+mtime is touched on every hit and, once the total exceeds
+``DECRYPTED_CACHE_MAX_BYTES``, the least recently used entries are deleted.
+Files bigger than ``DECRYPTED_CACHE_MAX_ENTRY_BYTES`` are never cached.
+
+Hit, miss and eviction counts are added up in memory and written every
+``STATS_FLUSH_INTERVAL`` seconds to a ``stats-<pid>.json`` file that only
+that worker writes, so lookups never wait on the other workers. A worker
+folds its file into the shared ``stats.json`` totals when it exits
+(``retire_worker_stats``), and ``stats()`` does the same for the files of
+workers that died without doing so.
+"""
+import fcntl
+import glob
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+STATS_FILE = 'stats-{pid}.json'
+STATS_FILE_RE = re.compile(r'stats-(\d+)\.json$')
+RETIRED_STATS_FILE = 'stats.json'
+STATS_FLUSH_INTERVAL = 10
+LOCK_FILE = '.lock'
+ENTRY_SUFFIX = '.doc'
+
+# Counts not yet written to this worker's stats file, per cache directory
+_pending_stats = defaultdict(Counter)
+_stats_lock = threading.Lock()
+_last_stats_flush = {}
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read_stats(path):
+    try:
+        with open(path) as f:
+            return Counter(json.load(f))
+    except FileNotFoundError:
+        return Counter()
+
+
+def touch(path):
+    # Explicit nanoseconds: the implicit "now" can be as coarse as a clock tick
+    now = time.time_ns()
+    os.utime(path, ns=(now, now))
+
+
+class DocumentCache:
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES, max_entry_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes if max_entry_bytes is not None else max_bytes // 8
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def entry_path(self, name, mtime_ns, size):
+        key = hashlib.sha256(f'{name}|{mtime_ns}|{size}'.encode()).hexdigest()
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    @contextmanager
+    def _locked(self):
+        with open(os.path.join(self.directory, LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _count(self, **increments):
+        with _stats_lock:
+            _pending_stats[self.directory].update(increments)
+            now = time.monotonic()
+            if now - _last_stats_flush.setdefault(self.directory, now) < STATS_FLUSH_INTERVAL:
+                return
+            _last_stats_flush[self.directory] = now
+            pending = _pending_stats.pop(self.directory)
+        try:
+            self._write_stats(pending)
+        except (OSError, ValueError):
+            logger.exception("Error saving document cache stats")
+
+    def _write_stats(self, pending):
+        # Only this process writes its file, so no lock is needed
+        path = os.path.join(self.directory, STATS_FILE.format(pid=os.getpid()))
+        stats = read_stats(path)
+        stats.update(pending)
+        self._replace_stats(path, stats)
+
+    def _replace_stats(self, path, stats):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as tmp:
+            json.dump(stats, tmp)
+        os.replace(tmp_path, path)
+
+    def retire_stats(self, pids):
+        """Add the stats files of ``pids`` to the shared totals and delete them."""
+        with self._locked():
+            retired_path = os.path.join(self.directory, RETIRED_STATS_FILE)
+            retired = read_stats(retired_path)
+            paths = [os.path.join(self.directory, STATS_FILE.format(pid=pid)) for pid in pids]
+            for path in paths:
+                retired.update(read_stats(path))
+            self._replace_stats(retired_path, retired)
+            for path in paths:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+    def flush_stats(self):
+        with _stats_lock:
+            pending = _pending_stats.pop(self.directory, Counter())
+        if pending:
+            self._write_stats(pending)
+
+    def _entries(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(ENTRY_SUFFIX):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return entries
+
+    def get(self, name, mtime_ns, size):
+        """Return an open plaintext file for the entry, or None on a miss."""
+        path = self.entry_path(name, mtime_ns, size)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            self._count(misses=1)
+            return None
+        try:
+            touch(path)
+        except FileNotFoundError:
+            # Evicted meanwhile; the open handle stays readable
+            pass
+        self._count(hits=1)
+        return f
+
+    def filling(self, name, mtime_ns, size, source, length):
+        """
+        Wrap the plaintext ``source`` so that reading it from start to end
+        stores it as the entry. Returns None when it is too big to cache.
+        """
+        if length > self.max_entry_bytes:
+            return None
+        return FillingReader(self, self.entry_path(name, mtime_ns, size), source, length)
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits its budget."""
+        with self._locked():
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            evicted = 0
+            for _, entry_size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= entry_size
+                evicted += 1
+        if evicted:
+            self._count(evictions=evicted)
+        return evicted
+
+    def _stats_files(self):
+        return glob.glob(os.path.join(glob.escape(self.directory), STATS_FILE.format(pid='*')))
+
+    def _worker_pids(self):
+        pids = (STATS_FILE_RE.search(path) for path in self._stats_files())
+        return [int(match.group(1)) for match in pids if match]
+
+    def stats(self):
+        dead = [pid for pid in self._worker_pids() if not pid_alive(pid)]
+        if dead:
+            try:
+                self.retire_stats(dead)
+            except (OSError, ValueError):
+                logger.exception("Error retiring document cache stats")
+        stats = Counter()
+        for path in self._stats_files() + [os.path.join(self.directory, RETIRED_STATS_FILE)]:
+            try:
+                stats.update(read_stats(path))
+            except (OSError, ValueError):
+                continue
+        with _stats_lock:
+            stats.update(_pending_stats.get(self.directory, {}))
+        entries = self._entries()
+        return {
+            'hits': stats['hits'],
+            'misses': stats['misses'],
+            'evictions': stats['evictions'],
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+            'max_bytes': self.max_bytes,
+        }
+
+    def clear(self):
+        with self._locked():
+            for _, _, path in self._entries():
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            for path in self._stats_files() + [os.path.join(self.directory, RETIRED_STATS_FILE)]:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+        with _stats_lock:
+            _pending_stats.pop(self.directory, None)
+
+
+class FillingReader(io.RawIOBase):
+    """
+    Reads a plaintext file and copies what is read, in order, into a
+    temporary file. The copy becomes the cache entry once the last byte has
+    been read; any read out of sequence (a range request) abandons it.
+    """
+
+    def __init__(self, cache, path, source, length):
+        super().__init__()
+        self.cache = cache
+        self.path = path
+        self.source = source
+        self.length = length
+        self.position = 0
+        self.filled = 0
+        self.tmp = None
+        self.tmp_path = None
+        self.done = False
+
+    @property
+    def size(self):
+        return self.length
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self.position = self.source.seek(offset, whence)
+        return self.position
+
+    def readinto(self, buffer):
+        data = self.source.read(len(buffer))
+        buffer[:len(data)] = data
+        self._fill(data)
+        self.position += len(data)
+        return len(data)
+
+    def _fill(self, data):
+        if self.done:
+            return
+        if self.position != self.filled:
+            self._abandon()
+            return
+        try:
+            if self.tmp is None:
+                fd, self.tmp_path = tempfile.mkstemp(dir=self.cache.directory, suffix='.tmp')
+                self.tmp = os.fdopen(fd, 'wb')
+            self.tmp.write(data)
+            self.filled += len(data)
+            if not data or self.filled >= self.length:
+                self._commit()
+        except OSError:
+            logger.exception("Error caching decrypted %s", self.path)
+            self._abandon()
+
+    def _commit(self):
+        self.tmp.close()
+        self.tmp = None
+        touch(self.tmp_path)
+        os.replace(self.tmp_path, self.path)
+        self.done = True
+        self.cache.evict()
+
+    def _abandon(self):
+        self.done = True
+        if self.tmp is not None:
+            self.tmp.close()
+            self.tmp = None
+            try:
+                os.unlink(self.tmp_path)
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        if not self.closed:
+            self._abandon()
+            self.source.close()
+        super().close()
+
+
+def get_document_cache():
+    """Return the configured cache, or None when ``DECRYPTED_CACHE_DIR`` is unset."""
+    directory = getattr(settings, 'DECRYPTED_CACHE_DIR', None)
+    if not directory:
+        return None
+    try:
+        return DocumentCache(
+            directory,
+            getattr(settings, 'DECRYPTED_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES),
+            getattr(settings, 'DECRYPTED_CACHE_MAX_ENTRY_BYTES', None),
+        )
+    except OSError:
+        logger.exception("Decrypted document cache unavailable at %s", directory)
+        return None
+
+
+def retire_worker_stats(**kwargs):
+    """Write this worker's pending counts into the shared totals, as it exits."""
+    cache = get_document_cache()
+    if cache is not None:
+        cache.flush_stats()
+        cache.retire_stats([os.getpid()])
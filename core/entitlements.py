@@ -0,0 +1,103 @@
+"""
+Per-request entitlement resolution.
+
+An ``Entitlement`` is a small, picklable summary of what a user may open:
+their plan id, name and level. It is resolved at most once per request by
+``core.middleware.EntitlementMiddleware`` (as the lazy
+``request.entitlement``), loaded with a single ``UserProfile`` + ``Plan``
+join, and cached under the user id. It is also memoized on the user object,
+so ``check_plan_access(request.user, ...)`` shares the same resolution.
+
+Cache entries are dropped when the user's ``UserProfile`` is saved or
+deleted. Any ``Plan`` change bumps a global version that is part of every
+key, since a plan's level affects everyone on it.
+"""
+from django.core.cache import cache
+
+ENTITLEMENT_TIMEOUT = 60 * 15
+PLANS_VERSION_KEY = 'entitlements:plans_version'
+
+
+class Entitlement:
+    def __init__(self, user_id=None, plan_id=None, plan_name=None, plan_level=None):
+        self.user_id = user_id
+        self.plan_id = plan_id
+        self.plan_name = plan_name
+        self.plan_level = plan_level
+
+    @property
+    def is_authenticated(self):
+        return self.user_id is not None
+
+    def can_access_level(self, level):
+        # Level 0 (Free/Public) content is open to everyone
+        if not level:
+            return True
+        if not self.is_authenticated or self.plan_level is None:
+            return False
+        return self.plan_level >= level
+
+    def can_access(self, required_plan):
+        if not required_plan:
+            return True
+        return self.can_access_level(required_plan.level)
+
+    def __repr__(self):
+        return f"<Entitlement user={self.user_id} plan={self.plan_name!r} level={self.plan_level}>"
+
+
+ANONYMOUS = Entitlement()
+
+
+def _plans_version():
+    return cache.get_or_set(PLANS_VERSION_KEY, 1, None)
+
+
+def entitlement_cache_key(user_id):
+    return f'entitlement:v{_plans_version()}:{user_id}'
+
+
+def load_entitlement(user_id):
+    """Build an entitlement from the database with one joined query."""
+    from .models import UserProfile
+
+    row = (
+        UserProfile.objects.filter(user_id=user_id)
+        .values('current_plan_id', 'current_plan__name', 'current_plan__level')
+        .first()
+    )
+    if row is None:
+        return Entitlement(user_id)
+    return Entitlement(user_id, row['current_plan_id'], row['current_plan__name'], row['current_plan__level'])
+
+
+def get_entitlement(user):
+    if user is None or not user.is_authenticated:
+        return ANONYMOUS
+    entitlement = getattr(user, '_entitlement', None)
+    if entitlement is not None:
+        return entitlement
+    key = entitlement_cache_key(user.pk)
+    entitlement = cache.get(key)
+    if entitlement is None:
+        entitlement = load_entitlement(user.pk)
+        cache.set(key, entitlement, ENTITLEMENT_TIMEOUT)
+    user._entitlement = entitlement
+    return entitlement
+
+
+def invalidate_user(user_id):
+    cache.delete(entitlement_cache_key(user_id))
+
+
+def invalidate_users(user_ids):
+    """Drop cached entitlements for users changed by bulk updates (no signals)."""
+    cache.delete_many([entitlement_cache_key(user_id) for user_id in user_ids])
+
+
+def invalidate_plans():
+    try:
+        cache.incr(PLANS_VERSION_KEY)
+    except ValueError:
+        cache.set(PLANS_VERSION_KEY, 2, None)
+
@@ -0,0 +1,104 @@
+"""
+Conditional and partial responses for stored files.
+
+``serve_file`` answers ``If-None-Match``/``If-Modified-Since`` with 304 and a
+single ``Range: bytes=...`` with 206, reading only the requested slice from
+the (seekable) file. With ``EncryptedFileSystemStorage`` that means only the
+segments covering the range are decrypted. Multiple ranges and malformed
+headers get the full file, and ranges past the end get 416.
+"""
+import re
+
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+CHUNK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header, size):
+    """
+    Return ``(start, end)`` (inclusive) for a single byte range, or None to
+    serve the whole file. Raises ``RangeNotSatisfiable``.
+    """
+    match = RANGE_RE.match((header or '').strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if not length:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size:
+        raise RangeNotSatisfiable()
+    if end < start:
+        return None
+    return start, end
+
+
+def file_etag(size, modified):
+    return quote_etag(f'{size:x}-{int(modified.timestamp() * 1000000):x}')
+
+
+def read_range(f, start, length):
+    try:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(CHUNK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def serve_file(request, open_file, size, modified, content_type, cache_control, filename=None):
+    """
+    Serve the file opened by ``open_file()`` (only called when a body is
+    needed), honouring conditional and range headers.
+    """
+    etag = file_etag(size, modified)
+    timestamp = int(modified.timestamp())
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+
+    if response is None:
+        byte_range = None
+        # If-Range: only honour the range while the file is unchanged
+        if_range = request.headers.get('If-Range')
+        if if_range is None or if_range in (etag, http_date(timestamp)):
+            try:
+                byte_range = parse_range(request.headers.get('Range'), size)
+            except RangeNotSatisfiable:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = f'bytes */{size}'
+
+        if response is None and byte_range:
+            start, end = byte_range
+            response = StreamingHttpResponse(
+                read_range(open_file(), start, end - start + 1), status=206, content_type=content_type,
+            )
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+            response['Content-Length'] = end - start + 1
+        elif response is None:
+            response = FileResponse(open_file(), content_type=content_type)
+            response['Content-Length'] = size
+
+    if filename and response.status_code in (200, 206):
+        response['Content-Disposition'] = f'inline; filename="{filename}"'
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(timestamp)
+    response['Cache-Control'] = cache_control
+    return response
@@ -0,0 +1,139 @@
+"""
+Responsive derivatives of uploaded images.
+
+For each cover/shop image, ``build_derivatives`` writes WebP and JPEG copies
+at the ``DERIVATIVE_WIDTHS`` not larger than the original, under a
+deterministic path::
+
+    derivatives/<upload name without extension>-<stamp>/<width>w.<format>
+
+``stamp`` hashes the source size and mtime, so a replaced upload gets new
+URLs (media is served as immutable). A ``manifest.json`` next to the files
+records the source dimensions and every variant; it is also cached.
+
+Derivatives are built when an image is saved (see ``core.signals``) and by
+the ``build_image_derivatives`` command, never while a page renders: the
+``{% responsive_image %}`` tag falls back to the original upload until they
+exist.
+"""
+import hashlib
+import io
+import json
+import logging
+import posixpath
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+DERIVATIVE_WIDTHS = (320, 640, 960, 1280)
+# (format, Pillow format, save options), best first
+DERIVATIVE_FORMATS = (
+    ('webp', 'WEBP', {'quality': 80, 'method': 6}),
+    ('jpeg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+)
+MANIFEST_VERSION = 1
+MANIFEST_TIMEOUT = 60 * 60 * 24
+
+
+def derivative_dir(field):
+    storage = field.storage
+    stamp = hashlib.sha256(
+        f'{storage.size(field.name)}|{storage.get_modified_time(field.name).timestamp()}'.encode()
+    ).hexdigest()[:10]
+    return f'derivatives/{posixpath.splitext(field.name)[0]}-{stamp}'
+
+
+def manifest_cache_key(directory):
+    return f'image_derivatives:v{MANIFEST_VERSION}:{hashlib.md5(directory.encode()).hexdigest()}'
+
+
+def target_widths(width):
+    widths = [w for w in DERIVATIVE_WIDTHS if w < width]
+    # Always offer the full size, capped at the largest derivative width
+    widths.append(min(width, DERIVATIVE_WIDTHS[-1]))
+    return widths
+
+
+def flatten(image):
+    """JPEG has no alpha channel: composite transparent images on white."""
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def build_derivatives(field):
+    """Write every derivative of ``field`` (an ImageField file) and return its manifest."""
+    storage = field.storage
+    directory = derivative_dir(field)
+    with storage.open(field.name) as f:
+        source = Image.open(f)
+        source = ImageOps.exif_transpose(source)
+        source.load()
+
+    width, height = source.size
+    manifest = {
+        'version': MANIFEST_VERSION, 'source': field.name, 'width': width, 'height': height,
+        'variants': {},
+    }
+    for target in target_widths(width):
+        resized = source if target == width else source.resize(
+            (target, max(1, round(height * target / width))), Image.LANCZOS,
+        )
+        for fmt, pillow_format, options in DERIVATIVE_FORMATS:
+            name = f'{directory}/{target}w.{fmt}'
+            if not storage.exists(name):
+                image = resized if fmt == 'webp' else flatten(resized)
+                if fmt == 'webp' and image.mode not in ('RGB', 'RGBA'):
+                    image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+                buffer = io.BytesIO()
+                image.save(buffer, pillow_format, **options)
+                name = storage.save(name, ContentFile(buffer.getvalue()))
+            manifest['variants'].setdefault(fmt, []).append([target, name])
+
+    manifest_name = f'{directory}/manifest.json'
+    if storage.exists(manifest_name):
+        storage.delete(manifest_name)
+    storage.save(manifest_name, ContentFile(json.dumps(manifest).encode()))
+    cache.set(manifest_cache_key(directory), manifest, MANIFEST_TIMEOUT)
+    return manifest
+
+
+def get_manifest(field, build=True):
+    """
+    Return the derivative manifest of ``field``, building it if missing and
+    ``build`` is set. Returns None when the image cannot be processed.
+    """
+    if not field:
+        return None
+    try:
+        directory = derivative_dir(field)
+    except (OSError, NotImplementedError):
+        return None
+    key = manifest_cache_key(directory)
+    manifest = cache.get(key)
+    if manifest is not None:
+        return manifest
+
+    storage = field.storage
+    manifest_name = f'{directory}/manifest.json'
+    try:
+        if storage.exists(manifest_name):
+            with storage.open(manifest_name) as f:
+                manifest = json.loads(f.read())
+            cache.set(key, manifest, MANIFEST_TIMEOUT)
+            return manifest
+        if build:
+            return build_derivatives(field)
+    except Exception:
+        logger.exception("Error building image derivatives for %s", field.name)
+    return None
+
+
+def srcset(storage, variants):
+    return ', '.join(f'{storage.url(name)} {width}w' for width, name in variants)
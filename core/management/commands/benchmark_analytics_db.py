@@ -0,0 +1,105 @@
+import math
+import multiprocessing
+import os
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from core.backends.sqlite3.base import pragma_statements
+from core.routers import ANALYTICS_DB
+
+SCHEMA = 'CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY, payload BLOB)'
+
+
+def init_commands(alias):
+    options = settings.DATABASES.get(alias, {}).get('OPTIONS', {})
+    return pragma_statements(options.get('pragmas'))
+
+
+def writer(path, pragmas, table, deadline, pause, results):
+    """Insert rows into ``table`` until ``deadline``, one write transaction each."""
+    conn = sqlite3.connect(path, timeout=5, isolation_level=None)
+    for pragma in pragmas:
+        conn.execute(pragma)
+    latencies, errors = [], 0
+    while time.time() < deadline:
+        start = time.perf_counter()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(f'INSERT INTO {table} (payload) VALUES (?)', (os.urandom(256),))
+            conn.execute('COMMIT')
+            latencies.append(time.perf_counter() - start)
+        except sqlite3.OperationalError:
+            errors += 1
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+        if pause:
+            time.sleep(pause)
+    conn.close()
+    results.put((table, latencies, errors))
+
+
+class Command(BaseCommand):
+    help = 'Measure content write latency with analytics writes in the same SQLite file and in a separate one'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', type=float, default=5, help='Duration of each scenario')
+        parser.add_argument('--analytics-writers', type=int, default=3, help='Processes writing analytics rows')
+        parser.add_argument('--content-writers', type=int, default=1, help='Processes writing content rows')
+
+    def scenario(self, directory, split, options):
+        content_path = os.path.join(directory, 'split-content.sqlite3' if split else 'shared.sqlite3')
+        analytics_path = os.path.join(directory, 'split-analytics.sqlite3') if split else content_path
+        content_pragmas = init_commands(DEFAULT_DB_ALIAS)
+        analytics_pragmas = init_commands(ANALYTICS_DB) if split else content_pragmas
+        for path, pragmas, table in ((content_path, content_pragmas, 'content'), (analytics_path, analytics_pragmas, 'analytics')):
+            conn = sqlite3.connect(path, isolation_level=None)
+            for pragma in pragmas:
+                conn.execute(pragma)
+            conn.execute(SCHEMA.format(table=table))
+            conn.close()
+
+        results = multiprocessing.Queue()
+        deadline = time.time() + options['seconds']
+        processes = [
+            multiprocessing.Process(target=writer, args=(analytics_path, analytics_pragmas, 'analytics', deadline, 0, results))
+            for _ in range(options['analytics_writers'])
+        ] + [
+            # Content edits are rarer than page-view writes
+            multiprocessing.Process(target=writer, args=(content_path, content_pragmas, 'content', deadline, 0.005, results))
+            for _ in range(options['content_writers'])
+        ]
+        for process in processes:
+            process.start()
+        collected = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+        stats = {}
+        for table in ('content', 'analytics'):
+            latencies = sorted(l for t, ls, _ in collected if t == table for l in ls)
+            errors = sum(e for t, _, e in collected if t == table)
+            stats[table] = (latencies, errors)
+        return stats
+
+    def report(self, name, stats, seconds):
+        self.stdout.write(name)
+        for table, (latencies, errors) in stats.items():
+            if latencies:
+                p95 = latencies[math.ceil(len(latencies) * 0.95) - 1]
+                self.stdout.write(
+                    f'  {table:<9} {len(latencies) / seconds:8.0f} writes/s  '
+                    f'p50 {statistics.median(latencies) * 1000:7.2f} ms  p95 {p95 * 1000:7.2f} ms  '
+                    f'max {latencies[-1] * 1000:7.2f} ms  {errors} locked'
+                )
+            else:
+                self.stdout.write(f'  {table:<9} no writes completed, {errors} locked')
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as directory:
+            self.report('Shared file (before)', self.scenario(directory, False, options), options['seconds'])
+            self.report('Separate analytics file', self.scenario(directory, True, options), options['seconds'])
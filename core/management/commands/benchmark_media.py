@@ -0,0 +1,61 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+from django.views.static import serve
+from core.media import serve_media
+
+class Command(BaseCommand):
+    help = 'Compare core.media.serve_media with django.views.static.serve on a media file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', help='File under MEDIA_ROOT (defaults to the largest one)')
+        parser.add_argument('--requests', type=int, default=500, help='Requests per scenario')
+
+    def largest_media_file(self):
+        largest = None
+        for root, dirs, files in os.walk(settings.MEDIA_ROOT):
+            for filename in files:
+                path = os.path.join(root, filename)
+                size = os.path.getsize(path)
+                if largest is None or size > largest[0]:
+                    largest = (size, os.path.relpath(path, settings.MEDIA_ROOT))
+        return largest[1] if largest else None
+
+    def run(self, view, path, count, **headers):
+        factory = RequestFactory()
+        status = None
+        start = time.perf_counter()
+        for _ in range(count):
+            response = view(factory.get(f'/media/{path}', headers=headers), path)
+            status = response.status_code
+            # Consume the body like a WSGI server would
+            for _chunk in (response.streaming_content if response.streaming else [response.content]):
+                pass
+            response.close()
+        elapsed = time.perf_counter() - start
+        return status, count / elapsed, elapsed / count * 1000
+
+    def handle(self, *args, **options):
+        path = options['path'] or self.largest_media_file()
+        if not path or not os.path.isfile(os.path.join(settings.MEDIA_ROOT, path)):
+            raise CommandError('No media file to benchmark.')
+        count = options['requests']
+        size = os.path.getsize(os.path.join(settings.MEDIA_ROOT, path))
+        self.stdout.write(f'{path} ({size} bytes), {count} requests per scenario\n')
+
+        static_serve = lambda request, path: serve(request, path, document_root=settings.MEDIA_ROOT)
+        first = serve_media(RequestFactory().get(f'/media/{path}'), path)
+        scenarios = [
+            ('static.serve  full GET', static_serve, {}),
+            ('serve_media   full GET', serve_media, {}),
+            ('static.serve  revalidate', static_serve, {'If-Modified-Since': first['Last-Modified']}),
+            ('serve_media   revalidate', serve_media, {'If-None-Match': first['ETag']}),
+            ('serve_media   range 64KB', serve_media, {'Range': 'bytes=0-65535'}),
+        ]
+        first.close()
+        for label, view, headers in scenarios:
+            status, rate, latency = self.run(view, path, count, **headers)
+            self.stdout.write(f'{label:28} {status}  {rate:9.0f} req/s  {latency:7.3f} ms/req')
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from core.images import get_manifest
+from core.signals import DERIVATIVE_FIELDS
+
+class Command(BaseCommand):
+    help = 'Build the responsive WebP/JPEG derivatives of every cover and shop image'
+
+    def handle(self, *args, **options):
+        built = failed = 0
+        for model, field_name in DERIVATIVE_FIELDS:
+            for obj in model.objects.exclude(**{field_name: ''}).exclude(**{f'{field_name}__isnull': True}).iterator():
+                field = getattr(obj, field_name)
+                if get_manifest(field):
+                    built += 1
+                else:
+                    failed += 1
+                    self.stderr.write(f'Could not process {field.name}')
+        self.stdout.write(self.style.SUCCESS(f'Derivatives ready for {built} images ({failed} failed).'))
@@ -1,39 +1,98 @@
+from collections import Counter
 from django.core.management.base import BaseCommand
+from django.db import transaction
 from django.utils import timezone
 from core.models import UserProfile, Plan
+from core import entitlements, rollups
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
 class Command(BaseCommand):
     help = 'Check for expired subscriptions and downgrade users to Free plan'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of profiles downgraded per UPDATE/transaction (default: 1000)',
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Report what would be downgraded without changing anything',
+        )
+
     def handle(self, *args, **options):
+        batch_size = max(1, options['batch_size'])
+        dry_run = options['dry_run']
+        verbosity = options['verbosity']
+        started = time.monotonic()
         now = timezone.now()
+
+        # Resolve the free plan once (level 0, falling back to 'Livre')
+        free_plan = Plan.objects.filter(level=0).order_by('id').first()
+        if not free_plan:
+            free_plan = Plan.objects.filter(name='Livre').first()
+        if not free_plan:
+            self.stdout.write(self.style.ERROR('Free plan not found. Could not downgrade expired subscriptions.'))
+            return
+
         expired_profiles = UserProfile.objects.filter(
             subscription_end_date__lt=now,
             current_plan__level__gt=0  # Only check paid plans
-        )
+        ).order_by('pk')
 
         count = 0
-        for profile in expired_profiles:
-            # Downgrade to Free plan (assuming ID 1 or name 'Livre' is free)
-            # Ideally, fetch the default free plan
-            free_plan = Plan.objects.filter(level=0).first()
-            if not free_plan:
-                free_plan = Plan.objects.filter(name='Livre').first()
-            
-            if free_plan:
-                old_plan = profile.current_plan.name
-                profile.current_plan = free_plan
-                profile.stripe_subscription_id = None
-                profile.subscription_end_date = None
-                profile.cancel_at_period_end = False
-                profile.save()
-                
-                self.stdout.write(self.style.SUCCESS(f'Downgraded user {profile.user.username} from {old_plan} to {free_plan.name}'))
-                count += 1
-            else:
-                self.stdout.write(self.style.ERROR(f'Free plan not found. Could not downgrade user {profile.user.username}'))
-
-        self.stdout.write(self.style.SUCCESS(f'Successfully checked subscriptions. Downgraded {count} users.'))
+        batches = 0
+        by_plan = Counter()
+        last_pk = 0
+        while True:
+            # Each batch is its own short transaction, so the SQLite write lock
+            # is only held for one bounded UPDATE at a time.
+            with transaction.atomic():
+                rows = list(
+                    expired_profiles.filter(pk__gt=last_pk)
+                    .values_list('pk', 'user_id', 'user__username', 'current_plan__name')[:batch_size]
+                )
+                if not rows:
+                    break
+                pks = [row[0] for row in rows]
+                if not dry_run:
+                    # Re-check the expiry in the UPDATE: a renewal may have landed since the SELECT
+                    updated = expired_profiles.filter(pk__in=pks).update(
+                        current_plan=free_plan,
+                        stripe_subscription_id=None,
+                        subscription_end_date=None,
+                        cancel_at_period_end=False,
+                    )
+                    if updated < len(rows):
+                        renewed = set(
+                            UserProfile.objects.filter(pk__in=pks).exclude(current_plan=free_plan)
+                            .values_list('pk', flat=True)
+                        )
+                        rows = [row for row in rows if row[0] not in renewed]
+                    # Bulk updates bypass the UserProfile signals. Rollups live in
+                    # the analytics database, so only count committed downgrades.
+                    transaction.on_commit(lambda updated=updated: rollups.record('churn', now, updated))
+
+            if not dry_run:
+                entitlements.invalidate_users([row[1] for row in rows])
+
+            last_pk = pks[-1]
+            batches += 1
+            count += len(rows)
+            for _, _, username, old_plan in rows:
+                by_plan[old_plan] += 1
+                if verbosity >= 2:
+                    self.stdout.write(f'Downgraded user {username} from {old_plan} to {free_plan.name}')
+
+        elapsed = time.monotonic() - started
+        action = 'Would downgrade' if dry_run else 'Downgraded'
+        for plan_name, plan_count in sorted(by_plan.items()):
+            self.stdout.write(f'  {plan_name}: {plan_count}')
+        self.stdout.write(
+            f'{action} {count} profiles to {free_plan.name} in {batches} batches '
+            f'of up to {batch_size} ({elapsed:.2f}s, {count / elapsed if elapsed else 0:.0f} profiles/s).'
+        )
+        logger.info("check_subscriptions: %s %d profiles in %.2fs", action.lower(), count, elapsed)
+        self.stdout.write(self.style.SUCCESS(f'Successfully checked subscriptions. {action} {count} users.'))
@@ -0,0 +1,32 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from core.sessions import DEFAULT_BATCH_SIZE, clear_expired_sessions
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Delete expired sessions in small batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Sessions deleted per transaction')
+        parser.add_argument('--pause', type=float, default=0.1, help='Seconds to wait between batches')
+        parser.add_argument('--interval', type=float, default=None, help='Keep running, clearing every INTERVAL seconds')
+
+    def handle(self, *args, **options):
+        if options['interval'] is None:
+            self.clear(options)
+            return
+        while True:
+            try:
+                self.clear(options)
+            except Exception:
+                logger.exception("Error clearing expired sessions")
+                close_old_connections()
+            time.sleep(options['interval'])
+
+    def clear(self, options):
+        deleted = clear_expired_sessions(max(1, options['batch_size']), options['pause'])
+        self.stdout.write(f'Deleted {deleted} expired sessions.')
@@ -0,0 +1,48 @@
+import gzip
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Formats that benefit from compression; images and PDFs are already compressed.
+COMPRESSIBLE_EXTENSIONS = ('.svg', '.css', '.js', '.json', '.txt', '.html', '.xml', '.csv', '.md')
+
+class Command(BaseCommand):
+    help = 'Write precompressed .gz (and .br, with brotli installed) siblings of text media files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-size', type=int, default=1024, help='Skip files smaller than this many bytes')
+
+    def handle(self, *args, **options):
+        written = skipped = 0
+        for root, dirs, files in os.walk(settings.MEDIA_ROOT):
+            for filename in files:
+                if not filename.lower().endswith(COMPRESSIBLE_EXTENSIONS):
+                    continue
+                path = os.path.join(root, filename)
+                stat = os.stat(path)
+                if stat.st_size < options['min_size']:
+                    continue
+                with open(path, 'rb') as f:
+                    data = f.read()
+                variants = [('.gz', lambda: gzip.compress(data, compresslevel=9, mtime=0))]
+                if brotli is not None:
+                    variants.append(('.br', lambda: brotli.compress(data)))
+                for suffix, compress in variants:
+                    target = path + suffix
+                    if os.path.exists(target) and os.stat(target).st_mtime >= stat.st_mtime:
+                        skipped += 1
+                        continue
+                    compressed = compress()
+                    # Not worth serving unless it saves at least 5%
+                    if len(compressed) > stat.st_size * 0.95:
+                        continue
+                    with open(target, 'wb') as f:
+                        f.write(compressed)
+                    written += 1
+        self.stdout.write(self.style.SUCCESS(f'Wrote {written} precompressed media files ({skipped} up to date).'))
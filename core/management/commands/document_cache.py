@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.document_cache import get_document_cache
+
+class Command(BaseCommand):
+    help = 'Show (or clear) the shared cache of decrypted documents'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clear', action='store_true', help='Delete every cached document and reset the counters')
+
+    def handle(self, *args, **options):
+        cache = get_document_cache()
+        if cache is None:
+            raise CommandError('DECRYPTED_CACHE_DIR is not configured.')
+        if options['clear']:
+            cache.clear()
+            self.stdout.write(self.style.SUCCESS('Cleared the decrypted document cache.'))
+            return
+        stats = cache.stats()
+        lookups = stats['hits'] + stats['misses']
+        ratio = stats['hits'] / lookups if lookups else 0
+        self.stdout.write(
+            f"{stats['entries']} documents, {stats['bytes']} of {stats['max_bytes']} bytes; "
+            f"{stats['hits']} hits, {stats['misses']} misses ({ratio:.0%} hit rate), {stats['evictions']} evictions."
+        )
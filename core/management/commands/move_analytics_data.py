@@ -0,0 +1,163 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections, models, transaction
+from core import rollups
+from core.routers import ANALYTICS_DB, ANALYTICS_MODELS, analytics_enabled
+from core.visits import HyperLogLog
+
+# Rows of these models are merged into the row with the same key already in
+# the analytics database, if any (see merge_daily_visit and merge_rollup)
+MERGE_KEYS = {
+    'core.dailyvisit': ('date',),
+    'core.metricrollup': ('metric', 'period', 'bucket'),
+}
+
+
+def merge_daily_visit(target, row):
+    if target.sketch and row['sketch']:
+        sketch = HyperLogLog(registers=bytes(target.sketch))
+        sketch.merge(HyperLogLog(registers=bytes(row['sketch'])))
+        target.sketch = sketch.to_bytes()
+        target.count = max(sketch.count(), target.count, row['count'])
+    else:
+        # Counted before sketches existed: the visitors cannot be deduplicated
+        target.sketch = target.sketch or row['sketch']
+        target.count += row['count']
+
+
+def merge_rollup(target, row):
+    target.value += row['value']
+
+
+MERGERS = {
+    'core.dailyvisit': merge_daily_visit,
+    'core.metricrollup': merge_rollup,
+}
+
+# Rows pointing at a model whose pks change on the way, moved along with it
+# (deleting the source rows cascades to them): {model: (dependent, foreign key)}
+DEPENDENTS = {
+    'axes.accessattempt': ('axes.accessattemptexpiration', 'access_attempt_id'),
+}
+
+
+class Command(BaseCommand):
+    help = 'Move rows of the analytics tables written to the content database before the split'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows copied per transaction')
+        parser.add_argument('--keep', action='store_true', help='Copy without deleting the original rows (running again copies them again)')
+
+    def handle(self, *args, **options):
+        if not analytics_enabled():
+            raise CommandError(f"DATABASES has no '{ANALYTICS_DB}' alias.")
+        self.source_tables = connections[DEFAULT_DB_ALIAS].introspection.table_names()
+        self.visit_days = set()
+        dependents = {dependent for dependent, _ in DEPENDENTS.values()}
+        for label in sorted(ANALYTICS_MODELS - dependents):
+            try:
+                model = apps.get_model(label)
+            except LookupError:
+                continue
+            if model._meta.db_table not in self.source_tables:
+                continue
+            moved = self.move(model, options['batch_size'], options['keep'])
+            self.stdout.write(f'{model._meta.label}: {moved} rows')
+        if self.visit_days:
+            # Merged days no longer add up to the moved rollups
+            rollups.rebuild_visits(self.visit_days)
+            self.stdout.write(f'Rebuilt visit rollups for {len(self.visit_days)} days.')
+        self.stdout.write(self.style.SUCCESS('Analytics data moved.'))
+
+    def move(self, model, batch_size, keep):
+        connection = connections[DEFAULT_DB_ALIAS]
+        with connection.cursor() as cursor:
+            columns = {column.name for column in connection.introspection.get_table_description(cursor, model._meta.db_table)}
+        # The old table may predate later columns, which then get their defaults
+        fields = [field.attname for field in model._meta.concrete_fields if field.column in columns]
+        pk_name = model._meta.pk.attname
+        source = model._default_manager.using(DEFAULT_DB_ALIAS)
+        moved = 0
+        last_pk = None
+        while True:
+            batch = source.order_by('pk')
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            rows = list(batch.values(*fields)[:batch_size])
+            if not rows:
+                return moved
+            # Every row of the batch is written, or the batch fails and nothing is deleted
+            with transaction.atomic(using=ANALYTICS_DB):
+                self.write(model, rows)
+            pks = [row[pk_name] for row in rows]
+            if not keep:
+                source.filter(pk__in=pks).delete()
+            last_pk = pks[-1]
+            moved += len(rows)
+
+    def write(self, model, rows):
+        label = model._meta.label_lower
+        target = model._default_manager.using(ANALYTICS_DB)
+        pk = model._meta.pk
+        old_pks = [row[pk.attname] for row in rows]
+        if isinstance(pk, models.AutoField):
+            # The analytics database numbers its own rows since the split
+            rows = [{name: value for name, value in row.items() if name != pk.attname} for row in rows]
+        elif label not in MERGE_KEYS:
+            rows = self.without_copies(model, rows)
+
+        if label == 'core.dailyvisit':
+            self.visit_days.update(row['date'] for row in rows)
+        elif label == 'core.metricrollup':
+            # Rebuilt from the merged days afterwards
+            self.visit_days.update(row['bucket'] for row in rows if row['metric'] == 'visits')
+            rows = [row for row in rows if row['metric'] != 'visits']
+
+        if label in MERGE_KEYS:
+            key_names = MERGE_KEYS[label]
+            new_rows = []
+            for row in rows:
+                existing = target.select_for_update().filter(**{name: row[name] for name in key_names}).first()
+                if existing is None:
+                    new_rows.append(row)
+                else:
+                    MERGERS[label](existing, row)
+                    existing.save()
+            rows = new_rows
+
+        try:
+            created = target.bulk_create([model(**row) for row in rows])
+            if label in DEPENDENTS:
+                self.write_dependents(label, dict(zip(old_pks, (obj.pk for obj in created))))
+        except IntegrityError as error:
+            raise CommandError(f'{model._meta.label}: could not copy a batch, nothing was deleted: {error}')
+
+    def write_dependents(self, label, new_pks):
+        dependent_label, foreign_key = DEPENDENTS[label]
+        try:
+            dependent = apps.get_model(dependent_label)
+        except LookupError:
+            return
+        if dependent._meta.db_table not in self.source_tables:
+            return
+        rows = list(
+            dependent._default_manager.using(DEFAULT_DB_ALIAS)
+            .filter(**{f'{foreign_key}__in': list(new_pks)})
+            .values(*[field.attname for field in dependent._meta.concrete_fields])
+        )
+        for row in rows:
+            row[foreign_key] = new_pks[row[foreign_key]]
+        dependent._default_manager.using(ANALYTICS_DB).bulk_create([dependent(**row) for row in rows])
+
+    def without_copies(self, model, rows):
+        """Drop rows already copied by an interrupted run, refusing rows that clash with newer ones."""
+        pk_name = model._meta.pk.attname
+        existing = {
+            row[pk_name]: row
+            for row in model._default_manager.using(ANALYTICS_DB)
+            .filter(pk__in=[row[pk_name] for row in rows]).values(*rows[0])
+        }
+        for row in rows:
+            if row[pk_name] in existing and existing[row[pk_name]] != row:
+                raise CommandError(f'{model._meta.label} {row[pk_name]!r} already exists with other data, nothing was deleted.')
+        return [row for row in rows if row[pk_name] not in existing]
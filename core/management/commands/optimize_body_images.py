@@ -0,0 +1,72 @@
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+from operator import or_
+from urllib.parse import quote
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.db.models import Q
+from core.body_images import optimize_upload, optimized_copy, rewrite_images, upload_names
+from core.models import Article
+
+logger = logging.getLogger(__name__)
+
+# Upload names matched per article query
+ARTICLE_QUERY_NAMES = 100
+
+class Command(BaseCommand):
+    help = 'Optimize new CKEditor uploads and point the article bodies using them at the optimized images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Processes used to optimize images')
+        parser.add_argument('--interval', type=float, default=None, help='Keep running, optimizing new uploads every INTERVAL seconds')
+        parser.add_argument('--all-articles', action='store_true', help='Check every article, not only those using new uploads (e.g. after an interrupted run)')
+
+    def handle(self, *args, **options):
+        if options['interval'] is None:
+            self.optimize(options['workers'], options['all_articles'])
+            return
+        while True:
+            try:
+                self.optimize(options['workers'])
+            except Exception:
+                logger.exception("Error optimizing body images")
+                close_old_connections()
+            time.sleep(options['interval'])
+
+    def optimize(self, workers, all_articles=False):
+        names = list(upload_names())
+        # Uploads optimized by an earlier pass are only looked up, never opened
+        pending = [name for name in names if optimized_copy(name) is None]
+        if workers > 1 and len(pending) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = dict(zip(pending, executor.map(optimize_upload, pending, chunksize=4)))
+        else:
+            results = {name: optimize_upload(name) for name in pending}
+        optimized = [name for name, result in results.items() if result]
+        self.stdout.write(f'Optimized {len(optimized)} of {len(names)} uploaded images.')
+
+        # Other articles already point at every copy that existed when they were saved
+        if all_articles:
+            rewritten = self.rewrite(Article.objects.all())
+        else:
+            rewritten = 0
+            for start in range(0, len(optimized), ARTICLE_QUERY_NAMES):
+                chunk = optimized[start:start + ARTICLE_QUERY_NAMES]
+                mentions = reduce(or_, (Q(content__contains=name) | Q(content__contains=quote(name)) for name in chunk))
+                rewritten += self.rewrite(Article.objects.filter(mentions))
+        self.stdout.write(self.style.SUCCESS(f'Rewrote images in {rewritten} articles.'))
+
+    def rewrite(self, articles):
+        rewritten = 0
+        for article in articles.iterator():
+            content = rewrite_images(article.content)
+            if content != article.content:
+                article.content = content
+                # Bumps updated_at too, so cached copies of the page are refreshed
+                article.save(update_fields=['content', 'updated_at'])
+                rewritten += 1
+        return rewritten
@@ -0,0 +1,41 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from core.stripe_inbox import process_due_events
+
+logger = logging.getLogger(__name__)
+
+MAX_ERROR_BACKOFF = 300
+
+class Command(BaseCommand):
+    help = 'Process stored Stripe events, retrying failed ones with backoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Process the due events once and exit')
+        parser.add_argument('--interval', type=float, default=5, help='Seconds to wait between polls')
+        parser.add_argument('--batch-size', type=int, default=100, help='Events to process per poll')
+
+    def handle(self, *args, **options):
+        errors = 0
+        while True:
+            try:
+                processed, failed = process_due_events(options['batch_size'])
+            except Exception:
+                # "database is locked", a dropped connection...: keep the worker alive
+                if options['once']:
+                    raise
+                errors += 1
+                logger.exception("Error polling Stripe events")
+                close_old_connections()
+                time.sleep(min(options['interval'] * 2 ** min(errors, 10), MAX_ERROR_BACKOFF))
+                continue
+            errors = 0
+            if processed or failed or options['once']:
+                self.stdout.write(f"Processed {processed} Stripe events, {failed} failed.")
+            if options['once']:
+                break
+            # Keep draining while a full batch was due
+            if processed + failed < options['batch_size']:
+                time.sleep(options['interval'])
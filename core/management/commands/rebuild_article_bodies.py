@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from core.article_body import RENDER_VERSION
+from core.models import Article
+
+class Command(BaseCommand):
+    help = 'Re-render the stored body HTML of articles compiled by an older pipeline version'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Rebuild every article, even if up to date')
+
+    def handle(self, *args, **options):
+        articles = Article.objects.all()
+        if not options['all']:
+            articles = articles.exclude(content_version=RENDER_VERSION)
+        rebuilt = 0
+        for article in articles.iterator(chunk_size=200):
+            article.compile_content()
+            # Compiled fields only: a pipeline change is not an edit (updated_at is kept)
+            Article.objects.filter(pk=article.pk).update(**{
+                field: getattr(article, field) for field in Article.COMPILED_FIELDS
+            })
+            rebuilt += 1
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {rebuilt} article bodies (pipeline version {RENDER_VERSION}).'))
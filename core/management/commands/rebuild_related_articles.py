@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from core import related
+
+class Command(BaseCommand):
+    help = 'Recompute the term vectors and related-content lists of every published article'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=None, help='Neighbours kept per article (default: RELATED_ARTICLES_COUNT)')
+
+    def handle(self, *args, **options):
+        k = options['count'] or related.related_count()
+        count = related.rebuild_related(k)
+        self.stdout.write(self.style.SUCCESS(f'Computed {k} related articles for {count} published articles.'))
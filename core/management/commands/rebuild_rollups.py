@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from core.rollups import rebuild_rollups
+
+class Command(BaseCommand):
+    help = 'Recompute the visits and revenue rollups from DailyVisit and PaymentHistory'
+
+    def handle(self, *args, **options):
+        rebuild_rollups()
+        self.stdout.write(self.style.SUCCESS('Successfully rebuilt visits and revenue rollups.'))
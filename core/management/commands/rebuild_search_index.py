@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from core.models import Article
+from core import search
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index for all articles'
+
+    def handle(self, *args, **options):
+        if not search.is_available():
+            self.stdout.write(self.style.ERROR('Search index table not found. Run migrations on an SQLite database first.'))
+            return
+
+        count = search.rebuild_index(Article.objects.all())
+        self.stdout.write(self.style.SUCCESS(f'Successfully indexed {count} articles.'))
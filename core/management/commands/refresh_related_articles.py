@@ -0,0 +1,36 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from core import related
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Refresh the related-content lists of articles saved or deleted since the last run'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=related.REFRESH_BATCH, help='Queued articles refreshed at once')
+        parser.add_argument('--interval', type=float, default=None, help='Keep running, draining the queue every INTERVAL seconds')
+
+    def handle(self, *args, **options):
+        if options['interval'] is None:
+            self.refresh(options['batch'])
+            return
+        while True:
+            try:
+                self.refresh(options['batch'])
+            except Exception:
+                logger.exception("Error refreshing related articles")
+                close_old_connections()
+            time.sleep(options['interval'])
+
+    def refresh(self, batch):
+        refreshed = 0
+        while True:
+            count = related.refresh_pending(batch=batch)
+            if not count:
+                break
+            refreshed += count
+        self.stdout.write(self.style.SUCCESS(f'Refreshed related content for {refreshed} articles.'))
@@ -0,0 +1,122 @@
+"""
+Production delivery of files under ``MEDIA_ROOT``.
+
+``serve_media`` replaces ``django.views.static.serve``:
+
+* Responses carry ``MEDIA_CACHE_CONTROL`` (by default a year, ``immutable``;
+  Django storages never overwrite an existing name) plus ETag/Last-Modified,
+  so revalidations are answered with 304 and ranges with 206 (see
+  ``core.file_serving``).
+* When the client accepts it, a precompressed ``.br``/``.gz`` sibling that is
+  at least as new as the original is sent instead (``compress_media`` builds
+  them for text formats such as SVG, CSS and JS).
+* With ``MEDIA_SERVE_MODE = 'x-accel'`` (nginx) or ``'x-sendfile'`` (Apache,
+  lighttpd) the body is handed off to the front proxy and the worker only
+  checks the path and headers.
+* Prefixes in ``MEDIA_PRIVATE_PREFIXES`` (encrypted PDFs) are never served.
+"""
+import mimetypes
+import os
+import posixpath
+from datetime import datetime, timezone as dt_timezone
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_vary_headers
+
+from .file_serving import file_etag, serve_file
+
+DEFAULT_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# (Accept-Encoding token, file suffix), in order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def media_setting(name, default):
+    return getattr(settings, name, default)
+
+
+def accepted_encodings(request):
+    header = request.headers.get('Accept-Encoding', '')
+    accepted = set()
+    for part in header.split(','):
+        token, _, params = part.partition(';')
+        name, _, value = params.strip().partition('=')
+        try:
+            quality = float(value) if name.strip() == 'q' else 1.0
+        except ValueError:
+            quality = 1.0
+        if quality > 0:
+            accepted.add(token.strip().lower())
+    return accepted
+
+
+def precompressed_variant(request, path, stat):
+    """Return ``(encoding, path, stat)`` of the best usable variant, or None."""
+    if request.headers.get('Range'):
+        return None
+    accepted = accepted_encodings(request)
+    for encoding, suffix in ENCODINGS:
+        if encoding not in accepted:
+            continue
+        try:
+            variant_stat = os.stat(path + suffix)
+        except OSError:
+            continue
+        if variant_stat.st_mtime >= stat.st_mtime:
+            return encoding, path + suffix, variant_stat
+    return None
+
+
+def handoff_response(request, mode, path, stat, content_type, cache_control):
+    etag = file_etag(stat.st_size, datetime.fromtimestamp(stat.st_mtime, tz=dt_timezone.utc))
+    response = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    if response is None:
+        response = HttpResponse(content_type=content_type)
+        if mode == 'x-accel':
+            prefix = media_setting('MEDIA_ACCEL_PREFIX', '/protected-media/')
+            response['X-Accel-Redirect'] = prefix + quote(path)
+        else:
+            response['X-Sendfile'] = os.path.join(settings.MEDIA_ROOT, path)
+    response['ETag'] = etag
+    response['Cache-Control'] = cache_control
+    return response
+
+
+def serve_media(request, path):
+    path = posixpath.normpath(path).lstrip('/')
+    if path.startswith(tuple(media_setting('MEDIA_PRIVATE_PREFIXES', ()))):
+        raise Http404("Not found")
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404("Not found")
+    try:
+        stat = os.stat(full_path)
+    except OSError:
+        raise Http404("Not found")
+    if not os.path.isfile(full_path):
+        raise Http404("Not found")
+
+    content_type, encoding = mimetypes.guess_type(full_path)
+    content_type = content_type or 'application/octet-stream'
+    cache_control = media_setting('MEDIA_CACHE_CONTROL', DEFAULT_CACHE_CONTROL)
+
+    mode = media_setting('MEDIA_SERVE_MODE', 'django')
+    if mode in ('x-accel', 'x-sendfile'):
+        return handoff_response(request, mode, path, stat, content_type, cache_control)
+
+    # Files that are themselves compressed (e.g. .gz downloads) are sent as is
+    variant = None if encoding else precompressed_variant(request, full_path, stat)
+    body_path, body_stat = (variant[1], variant[2]) if variant else (full_path, stat)
+    modified = datetime.fromtimestamp(body_stat.st_mtime, tz=dt_timezone.utc)
+    response = serve_file(
+        request, lambda: open(body_path, 'rb'), body_stat.st_size, modified, content_type, cache_control,
+    )
+    if variant:
+        response['Content-Encoding'] = variant[0]
+    if variant or any(os.path.exists(full_path + suffix) for _, suffix in ENCODINGS):
+        patch_vary_headers(response, ['Accept-Encoding'])
+    return response
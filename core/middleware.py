@@ -1,37 +1,38 @@
-from django.utils import timezone
-from .models import DailyVisit
+import logging
+from django.utils.functional import SimpleLazyObject
+from .entitlements import get_entitlement
+from .visits import visit_aggregator
+
+logger = logging.getLogger(__name__)
 
 class DailyVisitMiddleware:
+    """
+    Count daily unique visitors without touching the session or the database.
+
+    Visits go into an in-process HyperLogLog sketch that is flushed to
+    DailyVisit in the background of later requests (see core.visits).
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            visit_aggregator.record(request)
+        except Exception:
+            # Ignore errors to not break the site
+            logger.exception("Error recording daily visit")
+
+        return self.get_response(request)
+
+class EntitlementMiddleware:
+    """
+    Attach a lazily resolved request.entitlement (see core.entitlements).
+
+    Must come after AuthenticationMiddleware.
+    """
     def __init__(self, get_response):
         self.get_response = get_response
 
     def __call__(self, request):
-        # Logic to count daily visits
-        # We use session to avoid counting the same user multiple times a day
-        today = timezone.now().date().isoformat()
-        
-        if not request.session.get(f'visited_{today}'):
-            try:
-                visit, created = DailyVisit.objects.get_or_create(date=timezone.now().date())
-                # If it's not created, we still increment because this is a new session/user for today
-                # Wait, get_or_create returns the object.
-                # If we want to count unique visitors, we should only increment if session doesn't have the flag.
-                # But DailyVisit.count is a simple integer.
-                # We need to handle concurrency properly, using F() expression.
-                from django.db.models import F
-                
-                if created:
-                    # If created, count is 0 (default), so we set to 1.
-                    visit.count = 1
-                    visit.save()
-                else:
-                    visit.count = F('count') + 1
-                    visit.save()
-                
-                request.session[f'visited_{today}'] = True
-            except Exception:
-                # Ignore errors to not break the site
-                pass
-
-        response = self.get_response(request)
-        return response
+        request.entitlement = SimpleLazyObject(lambda: get_entitlement(request.user))
+        return self.get_response(request)
@@ -0,0 +1,38 @@
+# Generated by Django 6.0 on 2026-01-12 10:00
+
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    from core import search
+
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(search.CREATE_TABLE_SQL)
+
+    Article = apps.get_model('core', 'Article')
+    for article in Article.objects.all().iterator(chunk_size=500):
+        search.index_article(article, connection)
+
+
+def drop_search_index(apps, schema_editor):
+    from core import search
+
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {search.SEARCH_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_dailyvisit_article_views_course_views'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
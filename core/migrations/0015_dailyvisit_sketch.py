@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-01-14 09:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_article_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dailyvisit',
+            name='sketch',
+            field=models.BinaryField(blank=True, default=b''),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 6.0 on 2026-01-16 11:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_dailyvisit_sketch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetricRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('metric', models.CharField(choices=[('visits', 'Visitas'), ('revenue', 'Receita'), ('new_subscribers', 'Novos assinantes'), ('churn', 'Cancelamentos')], max_length=20)),
+                ('period', models.CharField(choices=[('day', 'Dia'), ('week', 'Semana'), ('month', 'Mês')], max_length=5)),
+                ('bucket', models.DateField(help_text='First day of the day/week/month bucket')),
+                ('value', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+            ],
+            options={
+                'verbose_name': 'Agregado de Métrica',
+                'verbose_name_plural': 'Agregados de Métricas',
+                'ordering': ['metric', 'period', 'bucket'],
+                'constraints': [models.UniqueConstraint(fields=('metric', 'period', 'bucket'), name='unique_metric_rollup_bucket')],
+            },
+        ),
+    ]
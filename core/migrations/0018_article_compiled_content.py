@@ -0,0 +1,50 @@
+# Generated by Django 6.0 on 2026-10-18 16:31
+
+from django.db import migrations, models
+
+
+def compile_articles(apps, schema_editor):
+    from core.article_body import RENDER_VERSION, render_body
+
+    Article = apps.get_model('core', 'Article')
+    for article in Article.objects.all().iterator(chunk_size=500):
+        body = render_body(article.content)
+        Article.objects.filter(pk=article.pk).update(
+            content_html=body.html, content_toc=body.toc, word_count=body.word_count,
+            reading_time=body.reading_time, content_version=RENDER_VERSION,
+        )
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_stripeevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='article',
+            name='content_html',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='content_toc',
+            field=models.JSONField(blank=True, default=list, editable=False),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='content_version',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='reading_time',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Minutos'),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='word_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(compile_articles, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 6.0 on 2026-10-18 16:40
+
+from django.db import migrations, models
+
+
+def backfill_tags(apps, schema_editor):
+    from core.tags import parse_tags
+
+    Article = apps.get_model('core', 'Article')
+    Tag = apps.get_model('core', 'Tag')
+    Through = Article.tag_set.through
+
+    tag_ids = {}
+    links = []
+    for article in Article.objects.only('pk', 'tags').iterator(chunk_size=500):
+        for slug, name in parse_tags(article.tags):
+            if slug not in tag_ids:
+                tag_ids[slug] = Tag.objects.create(slug=slug, name=name).pk
+            links.append(Through(article_id=article.pk, tag_id=tag_ids[slug]))
+    Through.objects.bulk_create(links, batch_size=500)
+
+    for tag in Tag.objects.all():
+        tag.published_count = Through.objects.filter(tag_id=tag.pk, article__status='published').count()
+        tag.save(update_fields=['published_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_article_compiled_content'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tag',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50)),
+                ('slug', models.SlugField(unique=True)),
+                ('published_count', models.PositiveIntegerField(default=0, editable=False)),
+            ],
+            options={
+                'verbose_name': 'Tag',
+                'verbose_name_plural': 'Tags',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='tag_set',
+            field=models.ManyToManyField(blank=True, editable=False, related_name='articles', to='core.tag'),
+        ),
+        migrations.RunPython(backfill_tags, migrations.RunPython.noop),
+    ]
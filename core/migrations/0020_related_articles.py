@@ -0,0 +1,68 @@
+# Generated by Django 6.0 on 2026-10-18 17:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_related(apps, schema_editor):
+    from core.related import article_terms, build_index, neighbours, related_count, weigh
+
+    Article = apps.get_model('core', 'Article')
+    ArticleTermVector = apps.get_model('core', 'ArticleTermVector')
+    RelatedArticle = apps.get_model('core', 'RelatedArticle')
+
+    articles = Article.objects.filter(status='published').only('pk', 'title', 'tags', 'summary', 'content', 'category')
+    corpus = {article.pk: article_terms(article) for article in articles.iterator(chunk_size=200)}
+    ArticleTermVector.objects.bulk_create(
+        [ArticleTermVector(article_id=pk, terms=terms) for pk, terms in corpus.items()], batch_size=200,
+    )
+    vectors = weigh(corpus)
+    index = build_index(vectors)
+    k = related_count()
+    RelatedArticle.objects.bulk_create(
+        [
+            RelatedArticle(article_id=pk, related_id=other, score=score, rank=rank)
+            for pk in vectors
+            for rank, (other, score) in enumerate(neighbours(pk, vectors, index, k))
+        ],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0019_tag'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArticleTermVector',
+            fields=[
+                ('article', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='term_vector', serialize=False, to='core.article')),
+                ('terms', models.JSONField(default=dict)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Vetor de Termos',
+                'verbose_name_plural': 'Vetores de Termos',
+            },
+        ),
+        migrations.CreateModel(
+            name='RelatedArticle',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('article', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='related_links', to='core.article')),
+                ('related', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.article')),
+            ],
+            options={
+                'verbose_name': 'Conteúdo Relacionado',
+                'verbose_name_plural': 'Conteúdos Relacionados',
+                'ordering': ['article', 'rank'],
+                'constraints': [models.UniqueConstraint(fields=('article', 'rank'), name='unique_related_article_rank')],
+            },
+        ),
+        migrations.RunPython(backfill_related, migrations.RunPython.noop),
+    ]
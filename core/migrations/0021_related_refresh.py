@@ -0,0 +1,25 @@
+# Generated by Django 6.0 on 2026-10-18 17:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0020_related_articles'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RelatedRefresh',
+            fields=[
+                ('article_id', models.IntegerField(primary_key=True, serialize=False)),
+                ('referrers', models.JSONField(default=list)),
+                ('queued_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Atualização de Relacionados',
+                'verbose_name_plural': 'Atualizações de Relacionados',
+            },
+        ),
+    ]
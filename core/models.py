@@ -1,7 +1,10 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 from django.utils.text import slugify
 from .storage import EncryptedFileSystemStorage
+from .article_body import RENDER_VERSION, render_body
+from .body_images import rewrite_images
 from ckeditor_uploader.fields import RichTextUploadingField
 
 class Plan(models.Model):
@@ -30,6 +33,19 @@ class UserProfile(models.Model):
     def __str__(self):
         return f"{self.user.username} - {self.current_plan}"
 
+class Tag(models.Model):
+    name = models.CharField(max_length=50)
+    slug = models.SlugField(unique=True)
+    published_count = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta:
+        ordering = ['name']
+        verbose_name = "Tag"
+        verbose_name_plural = "Tags"
+
+    def __str__(self):
+        return self.name
+
 class Article(models.Model):
     STATUS_CHOICES = [
         ('draft', 'Draft'),
@@ -51,6 +67,8 @@ class Article(models.Model):
     summary = models.TextField()
     content = RichTextUploadingField(blank=True, default='')
     tags = models.CharField(max_length=200, help_text="Comma separated tags")
+    # Normalized copy of `tags`, kept in sync on save (see core.tags)
+    tag_set = models.ManyToManyField('Tag', related_name='articles', blank=True, editable=False)
     authors = models.ManyToManyField(User, related_name='articles')
     # pdf_file = models.FileField(
     #     upload_to='articles/pdfs/', 
@@ -65,13 +83,35 @@ class Article(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     views = models.PositiveIntegerField(default=0)
+    # Rendered from `content` on save (see core.article_body)
+    content_html = models.TextField(blank=True, default='', editable=False)
+    content_toc = models.JSONField(blank=True, default=list, editable=False)
+    word_count = models.PositiveIntegerField(default=0, editable=False)
+    reading_time = models.PositiveIntegerField(default=0, editable=False, help_text="Minutos")
+    content_version = models.PositiveSmallIntegerField(default=0, editable=False)
+
+    COMPILED_FIELDS = ['content', 'content_html', 'content_toc', 'word_count', 'reading_time', 'content_version']
 
     def get_tags_list(self):
         return [tag.strip() for tag in self.tags.split(',')] if self.tags else []
 
+    def compile_content(self):
+        self.content = rewrite_images(self.content)
+        body = render_body(self.content)
+        self.content_html = body.html
+        self.content_toc = body.toc
+        self.word_count = body.word_count
+        self.reading_time = body.reading_time
+        self.content_version = RENDER_VERSION
+
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = slugify(self.title)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'content' in update_fields:
+            self.compile_content()
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | set(self.COMPILED_FIELDS)
         super().save(*args, **kwargs)
 
     def __str__(self):
@@ -107,6 +147,51 @@ class Multimidia(Article):
         verbose_name = "Multimídia"
         verbose_name_plural = "Multimídia"
 
+# Weighted term counts of a published article (see core.related)
+class ArticleTermVector(models.Model):
+    article = models.OneToOneField(Article, on_delete=models.CASCADE, primary_key=True, related_name='term_vector')
+    terms = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Vetor de Termos"
+        verbose_name_plural = "Vetores de Termos"
+
+    def __str__(self):
+        return f"{self.article_id}: {len(self.terms)} termos"
+
+# Precomputed nearest neighbours of an article, best first (see core.related)
+class RelatedArticle(models.Model):
+    article = models.ForeignKey(Article, on_delete=models.CASCADE, related_name='related_links')
+    related = models.ForeignKey(Article, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField()
+    rank = models.PositiveSmallIntegerField()
+
+    class Meta:
+        ordering = ['article', 'rank']
+        constraints = [
+            models.UniqueConstraint(fields=['article', 'rank'], name='unique_related_article_rank'),
+        ]
+        verbose_name = "Conteúdo Relacionado"
+        verbose_name_plural = "Conteúdos Relacionados"
+
+    def __str__(self):
+        return f"{self.article_id} -> {self.related_id} ({self.score:.3f})"
+
+# Saved or deleted article whose related lists are still to be refreshed (see core.related)
+class RelatedRefresh(models.Model):
+    # Not a foreign key: deleted articles stay queued so their referrers are refreshed
+    article_id = models.IntegerField(primary_key=True)
+    referrers = models.JSONField(default=list)
+    queued_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Atualização de Relacionados"
+        verbose_name_plural = "Atualizações de Relacionados"
+
+    def __str__(self):
+        return f"{self.article_id} ({self.queued_at:%Y-%m-%d %H:%M})"
+
 class Course(models.Model):
     STATUS_CHOICES = [
         ('draft', 'Draft'),
@@ -231,6 +316,8 @@ class ShopItem(models.Model):
 class DailyVisit(models.Model):
     date = models.DateField(unique=True)
     count = models.PositiveIntegerField(default=0)
+    # HyperLogLog registers behind `count`, merged by every worker (see core/visits.py)
+    sketch = models.BinaryField(blank=True, default=b'')
 
     class Meta:
         ordering = ['-date']
@@ -239,3 +326,64 @@ class DailyVisit(models.Model):
 
     def __str__(self):
         return f"{self.date}: {self.count}"
+
+
+class MetricRollup(models.Model):
+    METRIC_CHOICES = [
+        ('visits', 'Visitas'),
+        ('revenue', 'Receita'),
+        ('new_subscribers', 'Novos assinantes'),
+        ('churn', 'Cancelamentos'),
+    ]
+
+    PERIOD_CHOICES = [
+        ('day', 'Dia'),
+        ('week', 'Semana'),
+        ('month', 'Mês'),
+    ]
+
+    metric = models.CharField(max_length=20, choices=METRIC_CHOICES)
+    period = models.CharField(max_length=5, choices=PERIOD_CHOICES)
+    bucket = models.DateField(help_text="First day of the day/week/month bucket")
+    value = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        ordering = ['metric', 'period', 'bucket']
+        constraints = [
+            models.UniqueConstraint(fields=['metric', 'period', 'bucket'], name='unique_metric_rollup_bucket'),
+        ]
+        verbose_name = "Agregado de Métrica"
+        verbose_name_plural = "Agregados de Métricas"
+
+    def __str__(self):
+        return f"{self.metric} {self.period} {self.bucket}: {self.value}"
+
+
+class StripeEvent(models.Model):
+    STATUS_CHOICES = [
+        ('pending', 'Pendente'),
+        ('processing', 'Processando'),
+        ('processed', 'Processado'),
+        ('failed', 'Falhou'),
+    ]
+
+    event_id = models.CharField(max_length=255, unique=True, help_text="Stripe event id, or an internal id for redirect notifications")
+    type = models.CharField(max_length=100)
+    payload = models.JSONField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['-received_at']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='core_stripeevent_due_idx'),
+        ]
+        verbose_name = "Evento do Stripe"
+        verbose_name_plural = "Eventos do Stripe"
+
+    def __str__(self):
+        return f"{self.type} ({self.event_id}) - {self.status}"
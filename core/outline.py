@@ -0,0 +1,116 @@
+"""
+Cached course outlines.
+
+A ``CourseOutline`` is a plain, picklable snapshot of a course's modules and
+ordered lessons, with lesson counts, total duration and prev/next links. It
+is stored in the default cache under a versioned key and rebuilt by the
+``Course``/``Module``/``Lesson`` signal receivers in ``core.signals``, so the
+course and lesson pages render their sidebars without touching the database.
+"""
+from django.core.cache import cache
+
+# Bump when the CourseOutline structure changes so stale pickles are ignored.
+OUTLINE_VERSION = 1
+OUTLINE_TIMEOUT = 60 * 60 * 24
+
+
+def outline_cache_key(course_id):
+    return f'course_outline:v{OUTLINE_VERSION}:{course_id}'
+
+
+def parse_duration(value):
+    """Return the number of seconds in an "MM:SS" or "HH:MM:SS" string, or 0."""
+    if not value:
+        return 0
+    try:
+        parts = [int(part) for part in value.strip().split(':')]
+    except ValueError:
+        return 0
+    if not 1 <= len(parts) <= 3 or any(part < 0 for part in parts):
+        return 0
+    seconds = 0
+    for part in parts:
+        seconds = seconds * 60 + part
+    return seconds
+
+
+def format_duration(seconds):
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f'{hours}:{minutes:02d}:{seconds:02d}'
+    return f'{minutes}:{seconds:02d}'
+
+
+class CourseOutline:
+    """
+    Modules and lessons of one course, in display order.
+
+    ``modules`` is a list of dicts (``id``, ``title``, ``lessons``,
+    ``lesson_count``); ``lessons`` is the flat playback sequence. Courses
+    without modules list every lesson directly, like the templates did.
+    """
+
+    def __init__(self, course_id, modules, lessons, lesson_count):
+        self.course_id = course_id
+        self.modules = modules
+        self.lessons = lessons
+        self.lesson_count = lesson_count
+        self.total_seconds = sum(lesson['duration_seconds'] for lesson in lessons)
+        self._positions = {lesson['id']: i for i, lesson in enumerate(lessons)}
+
+    @property
+    def total_duration(self):
+        return format_duration(self.total_seconds) if self.total_seconds else ''
+
+    def neighbours(self, lesson_id):
+        """Return the ``(previous, next)`` lesson dicts around ``lesson_id``."""
+        position = self._positions.get(lesson_id)
+        if position is None:
+            return None, None
+        previous = self.lessons[position - 1] if position > 0 else None
+        following = self.lessons[position + 1] if position + 1 < len(self.lessons) else None
+        return previous, following
+
+
+def build_course_outline(course_id):
+    """Build an outline from the database with two queries."""
+    from .models import Lesson, Module
+
+    modules = [
+        {'id': module['id'], 'title': module['title'], 'lessons': []}
+        for module in Module.objects.filter(course_id=course_id).order_by('order', 'id').values('id', 'title')
+    ]
+    by_module = {module['id']: module for module in modules}
+
+    lessons = []
+    for lesson in Lesson.objects.filter(course_id=course_id).order_by('order', 'id').values(
+        'id', 'title', 'order', 'duration', 'module_id'
+    ):
+        lesson['duration_seconds'] = parse_duration(lesson['duration'])
+        lessons.append(lesson)
+        if lesson['module_id'] in by_module:
+            by_module[lesson['module_id']]['lessons'].append(lesson)
+
+    for module in modules:
+        module['lesson_count'] = len(module['lessons'])
+
+    sequence = [lesson for module in modules for lesson in module['lessons']] if modules else lessons
+    return CourseOutline(course_id, modules, sequence, len(lessons))
+
+
+def rebuild_course_outline(course_id):
+    outline = build_course_outline(course_id)
+    cache.set(outline_cache_key(course_id), outline, OUTLINE_TIMEOUT)
+    return outline
+
+
+def get_course_outline(course_id):
+    outline = cache.get(outline_cache_key(course_id))
+    if outline is None:
+        outline = rebuild_course_outline(course_id)
+    return outline
+
+
+def delete_course_outline(course_id):
+    cache.delete(outline_cache_key(course_id))
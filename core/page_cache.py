@@ -0,0 +1,155 @@
+"""
+Full-page cache of anonymous responses.
+
+Views decorated with ``anonymous_page_cache(*groups)`` store their rendered
+response for anonymous GET/HEAD requests in the default cache, which is
+shared by every gunicorn worker. Each page depends on content *groups*
+(``articles``, ``courses``, ``shop``, ``plans``); every group has a version
+token, bumped after commit by the ``post_save``/``post_delete`` receivers in
+``core.signals``, so saving a course only purges the pages listing courses.
+
+An entry outdated by a version bump or older than ``PAGE_CACHE_TIMEOUT`` is
+stale. The first request to see it takes a lock and renders the page again;
+while it does, other requests get the stale copy (for at most
+``PAGE_CACHE_STALE_TIMEOUT`` seconds past its expiry), so a publish during a
+traffic spike costs one render instead of one per worker. The lock is an
+``flock`` on a file under the default cache directory rather than a cache
+key: ``FileBasedCache.add`` checks and then writes, so two workers could
+both get it. It is only exclusive between processes of one host, which is
+also all the file cache is shared with.
+
+Only the query parameters listed in ``params`` are cached (e.g. the
+category filter); other parameters, like a search, bypass the cache.
+"""
+import fcntl
+import hashlib
+import os
+import time
+import uuid
+from contextlib import ExitStack, contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import parse_http_date_safe
+
+PAGE_KEY = 'page_cache:page:{digest}'
+GROUP_KEY = 'page_cache:group:{group}'
+LOCK_DIR = 'page-locks'
+GROUPS = ('articles', 'courses', 'shop', 'plans')
+STATUS_HEADER = 'X-Page-Cache'
+DEFAULT_TIMEOUT = 60 * 60
+DEFAULT_STALE_TIMEOUT = 60 * 5
+
+
+def page_timeout():
+    return getattr(settings, 'PAGE_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+
+
+def stale_timeout():
+    return getattr(settings, 'PAGE_CACHE_STALE_TIMEOUT', DEFAULT_STALE_TIMEOUT)
+
+
+def group_versions(groups):
+    keys = {GROUP_KEY.format(group=group): group for group in groups}
+    versions = cache.get_many(list(keys))
+    missing = {key: uuid.uuid4().hex for key in keys if key not in versions}
+    if missing:
+        cache.set_many(missing, None)
+        versions.update(missing)
+    return tuple(versions[key] for key in keys)
+
+
+def invalidate(*groups):
+    """Mark every page depending on ``groups`` as stale."""
+    cache.set_many({GROUP_KEY.format(group=group): uuid.uuid4().hex for group in groups}, None)
+
+
+def page_digest(request):
+    return hashlib.md5(request.get_full_path().encode()).hexdigest()
+
+
+def is_cacheable(request, params):
+    return (
+        request.method in ('GET', 'HEAD')
+        and set(request.GET) <= set(params)
+        and not request.user.is_authenticated
+    )
+
+
+@contextmanager
+def render_lock(digest):
+    """Yield whether this process got the lock to render page ``digest`` again.
+
+    The lock is released when the render ends, or when the worker dies.
+    """
+    directory = os.path.join(settings.CACHES['default']['LOCATION'], LOCK_DIR)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, digest + '.lock'), 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def build_response(request, entry, status):
+    response = HttpResponse(entry['content'], status=entry['status'])
+    for header, value in entry['headers']:
+        response[header] = value
+    response[STATUS_HEADER] = status
+    # Validators stored with the page (see core.conditional) still answer 304
+    return get_conditional_response(
+        request,
+        etag=response.get('ETag'),
+        last_modified=parse_http_date_safe(response.get('Last-Modified')),
+        response=response,
+    )
+
+
+def store(digest, response, versions):
+    cache.set(PAGE_KEY.format(digest=digest), {
+        'versions': versions,
+        'expires': time.time() + page_timeout(),
+        'status': response.status_code,
+        'headers': list(response.items()),
+        'content': response.content,
+    }, page_timeout() + stale_timeout())
+
+
+def anonymous_page_cache(*groups, params=()):
+    """Cache the anonymous responses of a view that depends on ``groups``."""
+    unknown = set(groups) - set(GROUPS)
+    if unknown:
+        raise ValueError(f"Unknown page cache groups: {', '.join(sorted(unknown))}")
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not is_cacheable(request, params):
+                return view(request, *args, **kwargs)
+
+            digest = page_digest(request)
+            versions = group_versions(groups)
+            entry = cache.get(PAGE_KEY.format(digest=digest))
+            with ExitStack() as stack:
+                if entry is not None:
+                    if entry['versions'] == versions and time.time() < entry['expires']:
+                        return build_response(request, entry, 'hit')
+                    if not stack.enter_context(render_lock(digest)):
+                        # Someone else is rendering the page again
+                        return build_response(request, entry, 'stale')
+
+                response = view(request, *args, **kwargs)
+                if response.status_code == 200 and not response.streaming and not response.cookies:
+                    store(digest, response, versions)
+            response[STATUS_HEADER] = 'miss'
+            return response
+        return wrapper
+    return decorator
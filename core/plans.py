@@ -0,0 +1,131 @@
+"""
+Cached ``Plan`` lookups and Stripe product → price resolution.
+
+There are only a handful of plans, so ``get_registry()`` loads them all once
+into a ``PlanRegistry`` indexed by id, name, Stripe price id and Stripe
+product id (``Plan.stripe_price_id`` may hold either). The registry is kept
+in the shared cache under a version token and memoized in-process for that
+token, so most lookups cost one cache read and no query. ``Plan`` save/delete
+receivers replace the token (see ``core.signals``).
+
+``resolve_price_id`` turns a ``prod_`` id into the product's default price,
+caching the answer for ``STRIPE_PRICE_CACHE_TIMEOUT`` seconds so starting a
+checkout does not call ``stripe.Product.retrieve`` every time.
+"""
+import threading
+import uuid
+
+import stripe
+from django.conf import settings
+from django.core.cache import cache
+
+REGISTRY_VERSION_KEY = 'plans:registry_version'
+REGISTRY_KEY = 'plans:registry:{version}'
+REGISTRY_TIMEOUT = 60 * 60 * 24
+PRICE_KEY = 'plans:default_price:{product_id}'
+
+# Price ids from settings used when no plan carries the Stripe id itself.
+SETTINGS_PRICE_PLANS = (
+    ('STRIPE_PRICE_ID_APOIADOR', 'Apoiador'),
+    ('STRIPE_PRICE_ID_IRRESTRITO', 'Irrestrito'),
+    ('STRIPE_PRICE_ID_MECENAS', 'Mecenas'),
+)
+
+
+class PlanRegistry:
+    def __init__(self, plans):
+        self.plans = list(plans)
+        self.by_id = {plan.pk: plan for plan in self.plans}
+        self.by_name = {}
+        self.by_price = {}
+        self.by_product = {}
+        for plan in self.plans:
+            # First plan wins, like the .first() lookups this replaces
+            self.by_name.setdefault(plan.name.lower(), plan)
+            stripe_id = plan.stripe_price_id or ''
+            if stripe_id.startswith('prod_'):
+                self.by_product.setdefault(stripe_id, plan)
+            elif stripe_id:
+                self.by_price.setdefault(stripe_id, plan)
+
+    def get(self, plan_id):
+        try:
+            return self.by_id.get(int(plan_id))
+        except (TypeError, ValueError):
+            return None
+
+    def named(self, name):
+        return self.by_name.get(name.lower())
+
+    def for_price(self, price_id, product_id=None):
+        """Find the plan sold by a Stripe price, falling back to its product and to settings."""
+        plan = self.by_price.get(price_id)
+        if plan is None and product_id:
+            plan = self.by_product.get(product_id) or self.by_price.get(product_id)
+        if plan is None:
+            for setting, name in SETTINGS_PRICE_PLANS:
+                if price_id == getattr(settings, setting, None):
+                    return self.named(name)
+        return plan
+
+    def __len__(self):
+        return len(self.plans)
+
+
+_local = threading.local()
+
+
+def _registry_version():
+    return cache.get_or_set(REGISTRY_VERSION_KEY, lambda: uuid.uuid4().hex, None)
+
+
+def load_registry():
+    from .models import Plan
+
+    return PlanRegistry(Plan.objects.order_by('pk'))
+
+
+def get_registry():
+    version = _registry_version()
+    if getattr(_local, 'version', None) == version:
+        return _local.registry
+    key = REGISTRY_KEY.format(version=version)
+    registry = cache.get(key)
+    if registry is None:
+        registry = load_registry()
+        cache.set(key, registry, REGISTRY_TIMEOUT)
+    _local.version, _local.registry = version, registry
+    return registry
+
+
+def invalidate_registry():
+    cache.set(REGISTRY_VERSION_KEY, uuid.uuid4().hex, None)
+    _local.__dict__.clear()
+
+
+def price_cache_timeout():
+    return getattr(settings, 'STRIPE_PRICE_CACHE_TIMEOUT', 60 * 15)
+
+
+def resolve_price_id(stripe_id):
+    """
+    Return the Stripe price to charge for ``stripe_id``: the id itself, or the
+    default price when it is a product id. Returns None when the product has
+    no default price; Stripe errors propagate.
+    """
+    if not stripe_id.startswith('prod_'):
+        return stripe_id
+    key = PRICE_KEY.format(product_id=stripe_id)
+    price_id = cache.get(key)
+    if price_id is None:
+        product = stripe.Product.retrieve(stripe_id)
+        if not product.default_price:
+            return None
+        price_id = product.default_price if isinstance(product.default_price, str) else product.default_price.id
+        cache.set(key, price_id, price_cache_timeout())
+    return price_id
+
+
+def forget_price(stripe_id):
+    if stripe_id and stripe_id.startswith('prod_'):
+        cache.delete(PRICE_KEY.format(product_id=stripe_id))
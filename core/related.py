@@ -0,0 +1,250 @@
+"""
+Precomputed related-content recommendations.
+
+Every published article is reduced to weighted term counts (title, tags and
+category count more than the summary, which counts more than the body),
+stored in ``ArticleTermVector``. Similarity is the cosine of TF-IDF vectors
+built from those counts, and the ``RELATED_ARTICLES_COUNT`` best neighbours
+of each article are stored in ``RelatedArticle``, so ``article_detail`` reads
+them with one indexed lookup.
+
+``rebuild_related`` recomputes everything (``rebuild_related_articles``
+command). Saving or deleting an article only queues it in ``RelatedRefresh``;
+the ``refresh_related_articles`` worker drains the queue with
+``refresh_articles``, which weighs the corpus once per batch and only updates
+the queued vectors, their own lists and the lists they enter or leave. Scores
+of untouched lists keep the document frequencies of their last computation
+until the next rebuild.
+"""
+import math
+import re
+import unicodedata
+from collections import Counter, defaultdict
+from functools import reduce
+from html import unescape
+from operator import or_
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils.html import strip_tags
+
+from . import page_cache
+
+DEFAULT_COUNT = 4
+REFRESH_BATCH = 100
+MAX_TERMS = 200
+MIN_SCORE = 0.05
+MIN_TERM_LENGTH = 3
+# (field, weight) of the term sources
+FIELD_WEIGHTS = (('title', 3), ('tags', 3), ('summary', 2), ('content', 1))
+CATEGORY_WEIGHT = 2
+
+WORD_RE = re.compile(r'[^\W\d_]+')
+STOPWORDS = frozenset('''
+    aos aquela aquelas aquele aqueles aquilo as ate com como contra das dela delas dele deles depois
+    dos ela elas ele eles em entre era eram essa essas esse esses esta estao estas este estes eu foi
+    foram isso isto lhe lhes mais mas mesmo muito nao nas nem nos nossa nossas nosso nossos num numa
+    onde para pela pelas pelo pelos por qual quando que quem sao seja sem ser seu seus sobre sua suas
+    tambem tem ter voce voces
+'''.split())
+
+
+def related_count():
+    return getattr(settings, 'RELATED_ARTICLES_COUNT', DEFAULT_COUNT)
+
+
+def normalize(text):
+    text = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in text if not unicodedata.combining(c)).lower()
+
+
+def tokenize(text):
+    """Accent-free, lowercase words of ``text`` (HTML allowed), without stopwords."""
+    words = WORD_RE.findall(normalize(unescape(strip_tags(text or ''))))
+    return [word for word in words if len(word) >= MIN_TERM_LENGTH and word not in STOPWORDS]
+
+
+def article_terms(article):
+    """Return ``{term: weighted count}`` for ``article``, keeping the ``MAX_TERMS`` heaviest."""
+    counts = Counter()
+    for field, weight in FIELD_WEIGHTS:
+        for term in tokenize(getattr(article, field)):
+            counts[term] += weight
+    # Not a word: only matches articles of the same category
+    counts[f'category:{article.category}'] += CATEGORY_WEIGHT
+    return dict(sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:MAX_TERMS])
+
+
+def weigh(corpus):
+    """Turn ``{pk: terms}`` into unit-length TF-IDF vectors ``{pk: {term: weight}}``."""
+    df = Counter(term for terms in corpus.values() for term in terms)
+    n = len(corpus)
+    vectors = {}
+    for pk, terms in corpus.items():
+        vector = {term: (1 + math.log(count)) * math.log(1 + n / df[term]) for term, count in terms.items()}
+        norm = math.sqrt(sum(w * w for w in vector.values())) or 1.0
+        vectors[pk] = {term: w / norm for term, w in vector.items()}
+    return vectors
+
+
+def build_index(vectors):
+    """Inverted index ``{term: [(pk, weight), ...]}``."""
+    index = defaultdict(list)
+    for pk, vector in vectors.items():
+        for term, weight in vector.items():
+            index[term].append((pk, weight))
+    return index
+
+
+def similarity(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(weight * b[term] for term, weight in a.items() if term in b)
+
+
+def neighbours(pk, vectors, index, k):
+    """Return the ``k`` best ``[(related pk, score), ...]`` for ``pk``, best first."""
+    scores = defaultdict(float)
+    for term, weight in vectors[pk].items():
+        for other, other_weight in index[term]:
+            if other != pk:
+                scores[other] += weight * other_weight
+    ranked = sorted(
+        ((other, score) for other, score in scores.items() if score >= MIN_SCORE),
+        # Newer articles (higher pk) win ties
+        key=lambda item: (-item[1], -item[0]),
+    )
+    return ranked[:k]
+
+
+def load_corpus():
+    from .models import ArticleTermVector
+
+    return dict(
+        ArticleTermVector.objects.filter(article__status='published').values_list('article_id', 'terms')
+    )
+
+
+def write_lists(lists):
+    """Replace the stored neighbours of every pk in ``lists`` (``{pk: [(related, score)]}``)."""
+    from .models import RelatedArticle
+
+    RelatedArticle.objects.filter(article_id__in=list(lists)).delete()
+    RelatedArticle.objects.bulk_create(
+        [
+            RelatedArticle(article_id=pk, related_id=other, score=score, rank=rank)
+            for pk, ranked in lists.items()
+            for rank, (other, score) in enumerate(ranked)
+        ],
+        batch_size=500,
+    )
+
+
+def rebuild_related(k=None):
+    """Recompute every term vector and neighbour list. Returns the number of articles."""
+    from .models import Article, ArticleTermVector, RelatedArticle
+
+    k = k or related_count()
+    articles = Article.objects.filter(status='published').only(
+        'pk', 'title', 'tags', 'summary', 'content', 'category',
+    )
+    corpus = {article.pk: article_terms(article) for article in articles.iterator(chunk_size=200)}
+    vectors = weigh(corpus)
+    index = build_index(vectors)
+    with transaction.atomic():
+        ArticleTermVector.objects.all().delete()
+        ArticleTermVector.objects.bulk_create(
+            [ArticleTermVector(article_id=pk, terms=terms) for pk, terms in corpus.items()],
+            batch_size=200,
+        )
+        RelatedArticle.objects.all().delete()
+        write_lists({pk: neighbours(pk, vectors, index, k) for pk in vectors})
+    return len(corpus)
+
+
+def queue_refresh(article_id, referrers=()):
+    """Queue ``article_id`` (and ``referrers``, articles known to list it) for ``refresh_pending``."""
+    from .models import RelatedRefresh
+
+    with transaction.atomic():
+        entry, created = RelatedRefresh.objects.select_for_update().get_or_create(
+            article_id=article_id, defaults={'referrers': sorted(referrers)},
+        )
+        if not created:
+            entry.referrers = sorted(set(entry.referrers) | set(referrers))
+            entry.save()
+
+
+def refresh_pending(k=None, batch=REFRESH_BATCH):
+    """Refresh up to ``batch`` queued articles at once. Returns how many were taken from the queue."""
+    from .models import RelatedRefresh
+
+    entries = list(RelatedRefresh.objects.order_by('queued_at')[:batch])
+    if not entries:
+        return 0
+    refresh_articles({entry.article_id: entry.referrers for entry in entries}, k)
+    # Entries queued again meanwhile have a newer queued_at and stay for the next batch
+    RelatedRefresh.objects.filter(
+        reduce(or_, (Q(article_id=entry.article_id, queued_at=entry.queued_at) for entry in entries))
+    ).delete()
+    return len(entries)
+
+
+def refresh_articles(changes, k=None):
+    """
+    Bring the recommendations up to date after the articles in ``changes``
+    (``{article_id: referrers}``) were saved or deleted. ``referrers`` are
+    articles known to have listed it (their rows are already gone once it is
+    deleted). Returns the number of lists rewritten.
+    """
+    from .models import Article, ArticleTermVector, RelatedArticle
+
+    k = k or related_count()
+    articles = Article.objects.filter(pk__in=list(changes), status='published')
+    gone = set(changes)
+    changed = set()
+
+    with transaction.atomic():
+        stored = dict(
+            ArticleTermVector.objects.filter(article_id__in=list(changes)).values_list('article_id', 'terms')
+        )
+        for article in articles:
+            gone.discard(article.pk)
+            terms = article_terms(article)
+            if stored.get(article.pk) != terms:
+                ArticleTermVector.objects.update_or_create(article_id=article.pk, defaults={'terms': terms})
+                changed.add(article.pk)
+        # Drafts that were never published have nothing to remove
+        gone = {pk for pk in gone if pk in stored or changes[pk]}
+        if gone:
+            ArticleTermVector.objects.filter(article_id__in=list(gone)).delete()
+            RelatedArticle.objects.filter(article_id__in=list(gone)).delete()
+        if not changed and not gone:
+            return 0
+
+        listing = {referrer for referrers in changes.values() for referrer in referrers} | set(
+            RelatedArticle.objects.filter(related_id__in=list(changed | gone)).values_list('article_id', flat=True)
+        )
+        corpus = load_corpus()
+        affected = changed | (listing & set(corpus))
+        vectors = weigh(corpus)
+        index = build_index(vectors)
+        if changed:
+            # Lists a changed article now enters: it beats their weakest entry, or they have room
+            current = defaultdict(list)
+            for pk, score in RelatedArticle.objects.filter(article_id__in=list(vectors)).values_list('article_id', 'score'):
+                current[pk].append(score)
+            for pk, vector in vectors.items():
+                if pk in affected:
+                    continue
+                for article_id in changed:
+                    score = similarity(vectors[article_id], vector)
+                    if score >= MIN_SCORE and (len(current[pk]) < k or score > min(current[pk])):
+                        affected.add(pk)
+                        break
+
+        write_lists({pk: neighbours(pk, vectors, index, k) for pk in affected})
+    # Article pages and their validators show the lists (see core.conditional)
+    page_cache.invalidate('articles')
+    return len(affected)
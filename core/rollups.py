@@ -0,0 +1,146 @@
+"""
+Incrementally maintained day/week/month rollups for the staff dashboard.
+
+``record()`` adds an amount to the day, week (starting Monday) and month
+buckets of a metric, so a date-range query reads one row per bucket instead
+of scanning ``DailyVisit``/``PaymentHistory``/``UserProfile``. Writers:
+
+* ``visits``: ``core.visits`` records the change in each ``DailyVisit.count``.
+* ``revenue``: the ``PaymentHistory`` ``post_save`` receiver.
+* ``new_subscribers`` / ``churn``: the ``UserProfile`` receivers, when a
+  profile moves between a free (level 0) and a paid plan.
+
+Writers inside a transaction on the content database record after it
+commits, so a rolled-back save never reaches the analytics rollups.
+
+``rebuild_rollups`` recomputes visits and revenue from the source tables, and
+``rebuild_visits`` only the visits buckets containing some days.
+"""
+import datetime
+from decimal import Decimal
+
+from django.db import IntegrityError, router, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+METRICS = ('visits', 'revenue', 'new_subscribers', 'churn')
+PERIODS = ('day', 'week', 'month')
+# Longest date range the staff dashboard reads at once
+MAX_RANGE_DAYS = 366
+
+# PaymentHistory statuses counted as revenue.
+REVENUE_STATUSES = ('paid', 'succeeded')
+
+
+def bucket_start(day, period):
+    if period == 'day':
+        return day
+    if period == 'week':
+        return day - datetime.timedelta(days=day.weekday())
+    if period == 'month':
+        return day.replace(day=1)
+    raise ValueError(f"Unknown period: {period}")
+
+
+def next_bucket(bucket, period):
+    if period == 'day':
+        return bucket + datetime.timedelta(days=1)
+    if period == 'week':
+        return bucket + datetime.timedelta(days=7)
+    if bucket.month == 12:
+        return bucket.replace(year=bucket.year + 1, month=1)
+    return bucket.replace(month=bucket.month + 1)
+
+
+def bucket_range(start, end, period):
+    """Widen ``start``/``end`` to the first and last day of the buckets containing them."""
+    return bucket_start(start, period), next_bucket(bucket_start(end, period), period) - datetime.timedelta(days=1)
+
+
+def to_local_date(when):
+    if isinstance(when, datetime.datetime):
+        return timezone.localdate(when) if timezone.is_aware(when) else when.date()
+    return when
+
+
+def parse_day(value):
+    """Parse a YYYY-MM-DD query parameter, returning None when invalid."""
+    try:
+        return parse_date(value or '')
+    except ValueError:
+        return None
+
+
+def record(metric, when, amount=1):
+    """Add ``amount`` to every bucket of ``metric`` containing ``when``."""
+    from .models import MetricRollup
+
+    if not amount:
+        return
+    amount = Decimal(str(amount))
+    day = to_local_date(when)
+    for period in PERIODS:
+        bucket = bucket_start(day, period)
+        rollups = MetricRollup.objects.filter(metric=metric, period=period, bucket=bucket)
+        if rollups.update(value=F('value') + amount):
+            continue
+        try:
+            with transaction.atomic(using=router.db_for_write(MetricRollup)):
+                MetricRollup.objects.create(metric=metric, period=period, bucket=bucket, value=amount)
+        except IntegrityError:
+            # Another writer created the bucket first.
+            rollups.update(value=F('value') + amount)
+
+
+def series(metric, start, end, period='day'):
+    """
+    Return ``[(bucket, value), ...]`` for every bucket between ``start`` and
+    ``end`` (inclusive), with missing buckets filled with zero. Buckets are
+    whole, so the first and last may cover days outside the range; see
+    ``bucket_range``.
+    """
+    from .models import MetricRollup
+
+    first = bucket_start(start, period)
+    values = dict(
+        MetricRollup.objects.filter(
+            metric=metric, period=period, bucket__gte=first, bucket__lte=end,
+        ).values_list('bucket', 'value')
+    )
+    result = []
+    bucket = first
+    while bucket <= end:
+        result.append((bucket, values.get(bucket, Decimal(0))))
+        bucket = next_bucket(bucket, period)
+    return result
+
+
+def total(metric, start, end, period='day'):
+    return sum((value for _, value in series(metric, start, end, period)), Decimal(0))
+
+
+def rebuild_rollups():
+    """Recompute the visits and revenue rollups from their source tables."""
+    from .models import DailyVisit, MetricRollup, PaymentHistory
+
+    with transaction.atomic(using=router.db_for_write(MetricRollup)):
+        MetricRollup.objects.filter(metric__in=['visits', 'revenue']).delete()
+        for visit in DailyVisit.objects.all().iterator():
+            record('visits', visit.date, visit.count)
+        for payment in PaymentHistory.objects.filter(status__in=REVENUE_STATUSES).iterator():
+            record('revenue', payment.date, payment.amount)
+
+
+def rebuild_visits(days):
+    """Recompute the ``visits`` rollups of every bucket containing one of ``days``."""
+    from .models import DailyVisit, MetricRollup
+
+    buckets = {(period, bucket_start(day, period)) for day in days for period in PERIODS}
+    with transaction.atomic(using=router.db_for_write(MetricRollup)):
+        for period, bucket in sorted(buckets):
+            last_day = next_bucket(bucket, period) - datetime.timedelta(days=1)
+            visits = DailyVisit.objects.filter(date__range=(bucket, last_day)).aggregate(total=Sum('count'))['total']
+            MetricRollup.objects.update_or_create(
+                metric='visits', period=period, bucket=bucket, defaults={'value': visits or 0},
+            )
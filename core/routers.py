@@ -0,0 +1,70 @@
+"""
+Database routing.
+
+High-churn, low-value tables (daily visits, metric rollups, sessions and the
+axes login records) live in their own SQLite file, the ``analytics`` alias,
+so their writes never queue behind, or hold up, the write lock of the
+content database where payments, comments and edits go. The file is tuned
+for throughput over durability (see ``DATABASES`` in settings): losing the
+last moments of visits on a power cut is acceptable there.
+
+Run ``migrate --database analytics`` to create its tables and
+``move_analytics_data`` to carry over rows written before the split.
+
+When ``DATABASES`` has a ``read`` alias (a read-only connection to the
+content database, see ``core.backends.sqlite3``), listing views query it
+through ``read_db()``.
+"""
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+ANALYTICS_DB = 'analytics'
+READ_DB = 'read'
+ANALYTICS_MODELS = frozenset({
+    'core.dailyvisit',
+    'core.metricrollup',
+    'sessions.session',
+    'axes.accessattempt',
+    'axes.accessattemptexpiration',
+    'axes.accessfailurelog',
+    'axes.accesslog',
+})
+
+
+def analytics_enabled():
+    return ANALYTICS_DB in settings.DATABASES
+
+
+def read_db():
+    """Alias for listing queries: the read-only connection when configured."""
+    return READ_DB if READ_DB in settings.DATABASES else DEFAULT_DB_ALIAS
+
+
+class AnalyticsRouter:
+    def _route(self, model):
+        if model._meta.label_lower in ANALYTICS_MODELS and analytics_enabled():
+            return ANALYTICS_DB
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self._route(model)
+
+    def db_for_write(self, model, **hints):
+        return self._route(model)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # No foreign keys cross the two files
+        if (self._route(type(obj1)) == ANALYTICS_DB) != (self._route(type(obj2)) == ANALYTICS_DB):
+            return False
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == READ_DB:
+            return False
+        if not analytics_enabled():
+            return None
+        routed = f'{app_label}.{model_name}' in ANALYTICS_MODELS
+        if db == ANALYTICS_DB:
+            # Data migrations (no model name) belong to the content database
+            return routed
+        return False if routed else None
@@ -0,0 +1,185 @@
+"""
+Full-text search for articles backed by an SQLite FTS5 index.
+
+The index lives in the ``core_article_search`` virtual table (created by
+migration 0014) and uses the ``unicode61`` tokenizer with diacritics removed,
+so "acao" matches "ação". Rows are keyed by the article id (``rowid``) and are
+kept in sync by the ``post_save``/``post_delete`` receivers in ``core.signals``.
+
+On databases without FTS5 support the helpers fall back to the old
+``icontains`` filter so the site keeps working.
+"""
+import html
+import re
+import unicodedata
+
+from django.db import connection, connections
+from django.db.models import Case, IntegerField, Q, When
+from django.utils.html import escape, strip_tags
+
+SEARCH_TABLE = 'core_article_search'
+SEARCH_RESULTS_LIMIT = 200
+
+# bm25() weights for the title, summary, body and tags columns.
+COLUMN_WEIGHTS = (10.0, 5.0, 1.0, 3.0)
+
+SNIPPET_START = '\x02'
+SNIPPET_END = '\x03'
+
+CREATE_TABLE_SQL = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} "
+    "USING fts5(title, summary, body, tags, tokenize='unicode61 remove_diacritics 2')"
+)
+
+_TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+# Connection aliases already known to have the search table.
+_available_aliases = set()
+
+
+def is_available(conn=None):
+    """Return True when the search table can be used on this connection."""
+    conn = conn or connection
+    if conn.alias in _available_aliases:
+        return True
+    if conn.vendor != 'sqlite':
+        return False
+    if SEARCH_TABLE in conn.introspection.table_names():
+        _available_aliases.add(conn.alias)
+        return True
+    return False
+
+
+def normalize(text):
+    """Lowercase and strip accents, mirroring the FTS5 tokenizer."""
+    text = unicodedata.normalize('NFKD', text or '')
+    return ''.join(c for c in text if not unicodedata.combining(c)).lower()
+
+
+def build_match_query(query):
+    """
+    Turn free text into an FTS5 MATCH expression.
+
+    Every term is quoted (so user input cannot inject FTS operators) and
+    prefix-matched, which also covers Portuguese plural and gender suffixes
+    ("ideia" finds "ideias").
+    """
+    terms = _TERM_RE.findall(normalize(query))
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def article_document(article):
+    """Return the (title, summary, body, tags) tuple indexed for an article."""
+    body = html.unescape(strip_tags(article.content or ''))
+    tags = ' '.join(tag.strip() for tag in (article.tags or '').split(','))
+    return (article.title or '', article.summary or '', body, tags)
+
+
+def index_article(article, conn=None):
+    conn = conn or connection
+    if not is_available(conn):
+        return
+    with conn.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [article.pk])
+        cursor.execute(
+            f"INSERT INTO {SEARCH_TABLE} (rowid, title, summary, body, tags) VALUES (%s, %s, %s, %s, %s)",
+            [article.pk, *article_document(article)],
+        )
+
+
+def remove_article(article_id, conn=None):
+    conn = conn or connection
+    if not is_available(conn):
+        return
+    with conn.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [article_id])
+
+
+def rebuild_index(articles, conn=None):
+    """Drop every indexed row and re-index ``articles``. Returns the row count."""
+    conn = conn or connection
+    if not is_available(conn):
+        return 0
+    count = 0
+    with conn.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE}")
+        for article in articles.iterator(chunk_size=500):
+            cursor.execute(
+                f"INSERT INTO {SEARCH_TABLE} (rowid, title, summary, body, tags) VALUES (%s, %s, %s, %s, %s)",
+                [article.pk, *article_document(article)],
+            )
+            count += 1
+        cursor.execute(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('optimize')")
+    return count
+
+
+def _render_snippet(raw):
+    """Escape a raw FTS5 snippet and turn the match markers into <mark> tags."""
+    return (
+        escape(raw)
+        .replace(SNIPPET_START, '<mark>')
+        .replace(SNIPPET_END, '</mark>')
+    )
+
+
+def search(query, category=None, limit=SEARCH_RESULTS_LIMIT, within=None):
+    """
+    Rank published articles matching ``query``.
+
+    ``within`` is an optional Article queryset (e.g. filtered by tag) that the
+    matches must belong to; it is applied in SQL, before the limit.
+    Returns a list of ``(article_id, snippet_html)`` tuples, best match first.
+    """
+    match = build_match_query(query)
+    if not match or (within is not None and within.query.is_empty()):
+        return []
+
+    weights = ', '.join(str(w) for w in COLUMN_WEIGHTS)
+    sql = (
+        f"SELECT s.rowid, snippet({SEARCH_TABLE}, -1, %s, %s, '…', 24) "
+        f"FROM {SEARCH_TABLE} s JOIN core_article a ON a.id = s.rowid "
+        f"WHERE {SEARCH_TABLE} MATCH %s AND a.status = 'published'"
+    )
+    params = [SNIPPET_START, SNIPPET_END, match]
+    if category:
+        sql += " AND a.category = %s"
+        params.append(category)
+    conn = connection
+    if within is not None:
+        within_sql, within_params = within.order_by().values('pk').query.sql_with_params()
+        sql += f" AND s.rowid IN ({within_sql})"
+        params.extend(within_params)
+        conn = connections[within.db]
+    sql += f" ORDER BY bm25({SEARCH_TABLE}, {weights}) LIMIT %s"
+    params.append(limit)
+
+    with conn.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [(row[0], _render_snippet(row[1])) for row in cursor.fetchall()]
+
+
+def search_articles(queryset, query, category=None):
+    """
+    Filter ``queryset`` down to the ranked matches for ``query``.
+
+    Each returned article carries a ``search_snippet`` attribute with the
+    highlighted excerpt. Falls back to ``icontains`` when FTS5 is unavailable.
+    """
+    if not is_available():
+        return list(queryset.filter(
+            Q(title__icontains=query) | Q(summary__icontains=query) | Q(content__icontains=query)
+        ).distinct())
+
+    results = search(query, category=category, within=queryset)
+    if not results:
+        return []
+
+    snippets = dict(results)
+    ordering = Case(
+        *[When(pk=pk, then=position) for position, (pk, _) in enumerate(results)],
+        output_field=IntegerField(),
+    )
+    articles = list(queryset.filter(pk__in=snippets).order_by(ordering))
+    for article in articles:
+        article.search_snippet = snippets[article.pk]
+    return articles
@@ -0,0 +1,51 @@
+"""
+Session housekeeping.
+
+Anonymous visitors never get a session: nothing on an anonymous page writes
+to ``request.session`` (visits are counted by ``core.visits``, messages live
+in a cookie, CSRF uses its own cookie), so no ``sessionid`` cookie is set and
+no row is written until allauth logs someone in.
+
+With a database-backed ``SESSION_ENGINE`` (``db`` or ``cached_db``) expired
+rows pile up, since Django only deletes a session when it is used again.
+``clear_expired_sessions`` deletes them in small batches, each its own short
+transaction, instead of the single ``DELETE`` of ``clearsessions`` that holds
+the write lock for as long as it takes.
+"""
+import time
+from importlib import import_module
+
+from django.conf import settings
+from django.db import router, transaction
+from django.utils import timezone
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def session_model():
+    """The model behind ``SESSION_ENGINE``, or None when sessions are not stored in the database."""
+    store = import_module(settings.SESSION_ENGINE).SessionStore
+    get_model_class = getattr(store, 'get_model_class', None)
+    return get_model_class() if get_model_class else None
+
+
+def clear_expired_sessions(batch_size=DEFAULT_BATCH_SIZE, pause=0):
+    """Delete expired session rows ``batch_size`` at a time. Returns the number deleted."""
+    model = session_model()
+    if model is None:
+        # Cache and signed-cookie sessions expire by themselves
+        return 0
+    now = timezone.now()
+    using = router.db_for_write(model)
+    deleted = 0
+    while True:
+        keys = list(
+            model.objects.filter(expire_date__lt=now).order_by('expire_date')
+            .values_list('pk', flat=True)[:batch_size]
+        )
+        if not keys:
+            return deleted
+        with transaction.atomic(using=using):
+            deleted += model.objects.filter(pk__in=keys).delete()[0]
+        if pause:
+            time.sleep(pause)
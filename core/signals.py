@@ -1,7 +1,22 @@
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.core.signals import request_finished
+from django.db.models import DEFERRED
+from django.db.models.signals import post_init, post_save, pre_delete, post_delete
 from django.contrib.auth.models import User
 from django.dispatch import receiver
-from .models import UserProfile, Plan
+from django.utils import timezone
+from .models import UserProfile, Plan, Article, Course, Module, Lesson, PaymentHistory, ShopItem, RelatedArticle, Tag
+from . import search
+from . import outline
+from . import counters
+from . import visits
+from . import rollups
+from . import entitlements
+from . import plans
+from . import images
+from . import tags
+from . import related
+from . import page_cache
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
@@ -11,4 +26,150 @@ def create_user_profile(sender, instance, created, **kwargs):
 
 @receiver(post_save, sender=User)
 def save_user_profile(sender, instance, **kwargs):
-    instance.profile.save()
\ No newline at end of file
+    instance.profile.save()
+
+# Articles are edited through proxy models (Artigo, Ensaio...), whose signals
+# use the proxy as sender, so these receivers match on isinstance instead.
+@receiver(post_save)
+def index_article(sender, instance, **kwargs):
+    if isinstance(instance, Article):
+        search.index_article(instance)
+
+@receiver(post_delete)
+def unindex_article(sender, instance, **kwargs):
+    if isinstance(instance, Article):
+        search.remove_article(instance.pk)
+
+@receiver(post_init)
+def remember_loaded_status(sender, instance, **kwargs):
+    if isinstance(instance, Article):
+        # Read from __dict__ so a deferred status is not fetched for every row
+        instance._loaded_status = instance.__dict__.get('status')
+
+@receiver(post_save)
+def sync_article_tags(sender, instance, created, raw=False, **kwargs):
+    if isinstance(instance, Article) and not raw:
+        status_changed = created or instance._loaded_status != instance.status
+        instance._loaded_status = instance.status
+        tags.sync_article_tags(instance, status_changed)
+
+@receiver(pre_delete)
+def remember_article_tags(sender, instance, **kwargs):
+    if isinstance(instance, Article):
+        instance._tag_ids = set(instance.tag_set.values_list('pk', flat=True))
+
+@receiver(post_delete)
+def recount_deleted_article_tags(sender, instance, **kwargs):
+    if isinstance(instance, Article):
+        tags.recount(getattr(instance, '_tag_ids', set()))
+
+# Related lists are refreshed by the refresh_related_articles worker
+@receiver(post_save)
+def queue_related_refresh(sender, instance, raw=False, **kwargs):
+    if isinstance(instance, Article) and not raw:
+        related.queue_refresh(instance.pk)
+
+@receiver(pre_delete)
+def remember_related_referrers(sender, instance, **kwargs):
+    if isinstance(instance, Article):
+        instance._related_referrers = set(
+            RelatedArticle.objects.filter(related=instance).values_list('article_id', flat=True)
+        )
+
+@receiver(post_delete)
+def queue_deleted_article_referrers(sender, instance, **kwargs):
+    if isinstance(instance, Article):
+        related.queue_refresh(instance.pk, getattr(instance, '_related_referrers', set()))
+
+@receiver(post_save, sender=Course)
+def rebuild_outline_for_course(sender, instance, **kwargs):
+    transaction.on_commit(lambda: outline.rebuild_course_outline(instance.pk))
+
+@receiver(post_delete, sender=Course)
+def delete_outline_for_course(sender, instance, **kwargs):
+    transaction.on_commit(lambda: outline.delete_course_outline(instance.pk))
+
+@receiver(post_save, sender=Module)
+@receiver(post_delete, sender=Module)
+@receiver(post_save, sender=Lesson)
+@receiver(post_delete, sender=Lesson)
+def rebuild_outline_for_content(sender, instance, **kwargs):
+    course_id = instance.course_id
+    transaction.on_commit(lambda: outline.rebuild_course_outline(course_id))
+
+@receiver(request_finished)
+def flush_view_counters(sender, **kwargs):
+    counters.flush_view_counters_if_due()
+
+@receiver(request_finished)
+def flush_daily_visits(sender, **kwargs):
+    visits.flush_visits_if_due()
+
+# Rollups live in the analytics database: record them once the save is committed
+@receiver(post_save, sender=PaymentHistory)
+def record_revenue(sender, instance, created, using, **kwargs):
+    if created and instance.status in rollups.REVENUE_STATUSES:
+        date, amount = instance.date, instance.amount
+        transaction.on_commit(lambda: rollups.record('revenue', date, amount), using=using)
+
+@receiver(post_init, sender=UserProfile)
+def remember_loaded_plan(sender, instance, **kwargs):
+    # Read from __dict__ so a deferred plan is not fetched for every row
+    instance._loaded_plan_id = instance.__dict__.get('current_plan_id', DEFERRED)
+
+@receiver(post_save, sender=UserProfile)
+def record_subscription_change(sender, instance, created, using, **kwargs):
+    old_plan_id = None if created else instance._loaded_plan_id
+    new_plan_id = instance.current_plan_id
+    instance._loaded_plan_id = new_plan_id
+    # A plan that was never loaded is unknown: nothing to compare with
+    if old_plan_id is DEFERRED or old_plan_id == new_plan_id:
+        return
+
+    registry = plans.get_registry()
+    was_paid = bool(old_plan_id) and getattr(registry.get(old_plan_id), 'level', 0) > 0
+    is_paid = bool(new_plan_id) and getattr(registry.get(new_plan_id), 'level', 0) > 0
+    now = timezone.now()
+    if is_paid and not was_paid:
+        transaction.on_commit(lambda: rollups.record('new_subscribers', now), using=using)
+    elif was_paid and not is_paid:
+        transaction.on_commit(lambda: rollups.record('churn', now), using=using)
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def invalidate_user_entitlement(sender, instance, using, **kwargs):
+    # After commit: a request reading the old plan before then would cache it again
+    user_id = instance.user_id
+    transaction.on_commit(lambda: entitlements.invalidate_user(user_id), using=using)
+
+@receiver(post_save, sender=Plan)
+@receiver(post_delete, sender=Plan)
+def invalidate_plan_entitlements(sender, instance, using, **kwargs):
+    transaction.on_commit(entitlements.invalidate_plans, using=using)
+
+@receiver(post_save, sender=Plan)
+@receiver(post_delete, sender=Plan)
+def invalidate_plan_registry(sender, instance, **kwargs):
+    plans.invalidate_registry()
+    plans.forget_price(instance.stripe_price_id)
+
+# Image fields whose responsive derivatives are built on save (see core.images)
+DERIVATIVE_FIELDS = ((Article, 'cover_image'), (Course, 'cover_image'), (ShopItem, 'image'))
+
+@receiver(post_save)
+def build_image_derivatives(sender, instance, **kwargs):
+    for model, field_name in DERIVATIVE_FIELDS:
+        if isinstance(instance, model):
+            field = getattr(instance, field_name)
+            if field:
+                transaction.on_commit(lambda: images.get_manifest(field))
+
+# Cached anonymous pages purged when a model changes (see core.page_cache)
+PAGE_CACHE_GROUPS = ((Article, 'articles'), (Tag, 'articles'), (Course, 'courses'), (ShopItem, 'shop'), (Plan, 'plans'))
+
+@receiver(post_save)
+@receiver(post_delete)
+def invalidate_cached_pages(sender, instance, **kwargs):
+    groups = [group for model, group in PAGE_CACHE_GROUPS if isinstance(instance, model)]
+    if groups:
+        transaction.on_commit(lambda: page_cache.invalidate(*groups))
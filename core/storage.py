@@ -1,38 +1,261 @@
-from django.core.files.storage import FileSystemStorage
-from django.conf import settings
-from cryptography.fernet import Fernet
-from django.core.files.base import ContentFile
+"""
+Encrypted media storage.
+
+Files are written in a streaming, segmented format so neither uploads nor
+downloads are ever held in memory whole::
+
+    header:   MAGIC (4) | VERSION (1) | segment size (4, big endian) | salt (16)
+    segments: AES-256-GCM(plaintext[i * size:(i + 1) * size]) + tag (16)
+
+Each file gets its own key, derived with HKDF from ``ENCRYPTION_KEY`` and the
+random salt, so segment nonces can simply be the segment index. The header,
+the index and a "last segment" flag are authenticated with every segment,
+so segments cannot be reordered, swapped between files or truncated.
+Every segment but the last is full, which makes the plaintext size and the
+segment holding any byte offset a matter of arithmetic: ``_open`` returns a
+seekable reader that decrypts one segment at a time.
+
+Files stored before this format (a single Fernet token, or plain bytes) are
+still read transparently. Decrypted copies of hot files can be shared between
+workers through ``core.document_cache``.
+"""
+import base64
 import io
+import logging
+import os
+import struct
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from django.conf import settings
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import FileSystemStorage
+
+from .document_cache import get_document_cache
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'HKEF'
+VERSION = 1
+HEADER = struct.Struct('>4sBI16s')
+TAG_SIZE = 16
+DEFAULT_SEGMENT_SIZE = 64 * 1024
+FERNET_PREFIX = b'gAAAAA'
+
+
+class EncryptedFileError(Exception):
+    pass
+
+
+def derive_key(master_key, salt):
+    return HKDF(
+        algorithm=hashes.SHA256(), length=32, salt=salt, info=b'helkein-storage-segments-v1',
+    ).derive(base64.urlsafe_b64decode(master_key))
+
+
+def segment_aad(header, index, last):
+    return header + struct.pack('>Q?', index, last)
+
+
+def segment_nonce(index):
+    return struct.pack('>4xQ', index)
+
+
+class EncryptingReader(io.RawIOBase):
+    """Read ``source`` chunks as the encrypted container, one segment at a time."""
+
+    def __init__(self, chunks, master_key, segment_size=DEFAULT_SEGMENT_SIZE):
+        salt = os.urandom(16)
+        self.header = HEADER.pack(MAGIC, VERSION, segment_size, salt)
+        self.aead = AESGCM(derive_key(master_key, salt))
+        self.segment_size = segment_size
+        self.chunks = iter(chunks)
+        self.plain = bytearray()
+        self.index = 0
+        self.pending = bytearray(self.header)
+        self.finished = False
+
+    def readable(self):
+        return True
+
+    def _encrypt(self, data, last):
+        self.pending += self.aead.encrypt(
+            segment_nonce(self.index), bytes(data), segment_aad(self.header, self.index, last),
+        )
+        self.index += 1
+
+    def _fill(self):
+        # Only emit a segment once more data follows it, so the last one is
+        # always flagged correctly (and may be short, or empty).
+        while not self.pending and not self.finished:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self._encrypt(self.plain, last=True)
+                self.plain = bytearray()
+                self.finished = True
+                break
+            self.plain += chunk
+            while len(self.plain) > self.segment_size:
+                self._encrypt(self.plain[:self.segment_size], last=False)
+                del self.plain[:self.segment_size]
+
+    def readinto(self, buffer):
+        self._fill()
+        size = min(len(buffer), len(self.pending))
+        memoryview(buffer).cast('B')[:size] = self.pending[:size]
+        del self.pending[:size]
+        return size
+
+
+class DecryptingReader(io.RawIOBase):
+    """Seekable plaintext view of an encrypted container file."""
+
+    def __init__(self, raw, master_key):
+        self.raw = raw
+        self.header = raw.read(HEADER.size)
+        try:
+            magic, version, self.segment_size, salt = HEADER.unpack(self.header)
+        except struct.error:
+            raise EncryptedFileError("Truncated header")
+        if magic != MAGIC or version != VERSION or not self.segment_size:
+            raise EncryptedFileError("Unsupported encrypted file format")
+        self.aead = AESGCM(derive_key(master_key, salt))
+
+        body = raw.seek(0, io.SEEK_END) - HEADER.size
+        stored_segment = self.segment_size + TAG_SIZE
+        self.segment_count = max(-(-body // stored_segment), 1)
+        self.size = body - self.segment_count * TAG_SIZE
+        if self.size < 0:
+            raise EncryptedFileError("Truncated file")
+        self.position = 0
+        self.cached_index = None
+        self.cached = b''
+
+    @property
+    def name(self):
+        return getattr(self.raw, 'name', None)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if position < 0:
+            raise ValueError("Negative seek position")
+        self.position = position
+        return position
+
+    def _segment(self, index):
+        if index != self.cached_index:
+            stored_segment = self.segment_size + TAG_SIZE
+            self.raw.seek(HEADER.size + index * stored_segment)
+            data = self.raw.read(stored_segment)
+            last = index == self.segment_count - 1
+            try:
+                self.cached = self.aead.decrypt(
+                    segment_nonce(index), data, segment_aad(self.header, index, last),
+                )
+            except InvalidTag:
+                raise EncryptedFileError(f"Segment {index} failed authentication")
+            self.cached_index = index
+        return self.cached
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        filled = 0
+        while filled < len(view) and self.position < self.size:
+            index, offset = divmod(self.position, self.segment_size)
+            data = self._segment(index)[offset:offset + len(view) - filled]
+            view[filled:filled + len(data)] = data
+            filled += len(data)
+            self.position += len(data)
+        return filled
+
+    def close(self):
+        self.raw.close()
+        super().close()
+
 
 class EncryptedFileSystemStorage(FileSystemStorage):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.master_key = settings.ENCRYPTION_KEY
         self.fernet = Fernet(settings.ENCRYPTION_KEY)
+        self.segment_size = getattr(settings, 'ENCRYPTED_STORAGE_SEGMENT_SIZE', DEFAULT_SEGMENT_SIZE)
 
     def _save(self, name, content):
-        # Read the content
-        if hasattr(content, 'read'):
-            data = content.read()
+        if hasattr(content, 'chunks'):
+            chunks = content.chunks()
+        elif hasattr(content, 'read'):
+            chunks = iter(lambda: content.read(self.segment_size), b'')
         else:
-            data = content
-            
-        # Encrypt the data
-        encrypted_data = self.fernet.encrypt(data)
-        
-        # Create a new file-like object with encrypted data
-        # We use ContentFile to ensure it behaves like a Django file
-        encrypted_content = ContentFile(encrypted_data)
-        return super()._save(name, encrypted_content)
+            chunks = [content]
+        encrypted = EncryptingReader(chunks, self.master_key, self.segment_size)
+        return super()._save(name, File(encrypted))
+
+    def _is_encrypted(self, f):
+        prefix = f.read(len(MAGIC))
+        f.seek(0)
+        return prefix in (MAGIC, FERNET_PREFIX[:len(MAGIC)])
+
+    def _decrypted(self, f, name):
+        """Return a plaintext file for the stored file ``f``."""
+        prefix = f.read(len(MAGIC))
+        f.seek(0)
+        if prefix == MAGIC:
+            try:
+                return File(DecryptingReader(f, self.master_key), name)
+            except Exception:
+                f.close()
+                raise
+
+        if prefix == FERNET_PREFIX[:len(MAGIC)]:
+            # Legacy single Fernet token: has to be decrypted as a whole
+            data = f.read()
+            f.close()
+            try:
+                return ContentFile(self.fernet.decrypt(data), name)
+            except InvalidToken:
+                return ContentFile(data, name)
+
+        # Unencrypted legacy file
+        return f
 
     def _open(self, name, mode='rb'):
-        # Open the file using the parent class
         f = super()._open(name, mode)
-        encrypted_data = f.read()
-        
-        try:
-            # Decrypt the data
-            decrypted_data = self.fernet.decrypt(encrypted_data)
-            return ContentFile(decrypted_data)
-        except Exception:
-            # If decryption fails, it might be an unencrypted file (legacy)
-            return ContentFile(encrypted_data)
+        cache = get_document_cache()
+        if cache is None or not self._is_encrypted(f):
+            return self._decrypted(f, name)
+
+        stat = os.fstat(f.fileno())
+        cached = cache.get(name, stat.st_mtime_ns, stat.st_size)
+        if cached is not None:
+            f.close()
+            return File(cached, name)
+
+        # Cached as it is read: a range request decrypts only its segments
+        plain = self._decrypted(f, name)
+        reader = cache.filling(name, stat.st_mtime_ns, stat.st_size, plain, plain.size)
+        return File(reader, name) if reader is not None else plain
+
+    def size(self, name):
+        # Bypasses the decrypted cache: only the header is read for new files
+        with self._decrypted(super()._open(name, 'rb'), name) as f:
+            f.seek(0, io.SEEK_END)
+            return f.tell()
@@ -0,0 +1,205 @@
+"""
+Durable inbox for Stripe notifications.
+
+``stripe_webhook`` only verifies the signature and stores the event here
+(keyed by the Stripe event id, so redeliveries are no-ops), then answers 200.
+``payment_success`` stores a ``PAYMENT_SUCCESS`` entry keyed by the checkout
+session id instead of calling Stripe itself. Only logged-in users can add
+one, for ids shaped like a checkout session and with at most
+``MAX_PENDING_PAYMENT_CHECKS`` waiting; the worker only applies the session
+when its ``client_reference_id`` is the user who came back with it.
+
+The ``process_stripe_events`` command drains due events, retrying failures
+with exponential backoff up to ``MAX_ATTEMPTS``. Handlers are idempotent per
+checkout session (the ``PaymentHistory`` row is the marker), so the webhook
+and the redirect can never both apply the same payment.
+"""
+import logging
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import stripe
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import PaymentHistory, StripeEvent, UserProfile
+from .plans import get_registry
+
+logger = logging.getLogger(__name__)
+
+stripe.api_key = settings.STRIPE_SECRET_KEY
+
+CHECKOUT_COMPLETED = 'checkout.session.completed'
+PAYMENT_SUCCESS = 'helkein.payment_success'
+
+MAX_ATTEMPTS = 8
+BASE_BACKOFF = timedelta(seconds=30)
+MAX_BACKOFF = timedelta(hours=6)
+# Events stuck in 'processing' longer than this (crashed worker) are retried.
+PROCESSING_TIMEOUT = timedelta(minutes=10)
+# Unprocessed success-redirect checks a single user may have queued.
+MAX_PENDING_PAYMENT_CHECKS = 3
+CHECKOUT_SESSION_PREFIX = 'cs_'
+
+
+def enqueue(event_id, event_type, payload):
+    """Store an event unless it is already in the inbox. Returns True if new."""
+    try:
+        with transaction.atomic():
+            StripeEvent.objects.create(event_id=event_id, type=event_type, payload=payload)
+    except IntegrityError:
+        return False
+    return True
+
+
+def enqueue_payment_success(user, session_id):
+    """Queue a check of the checkout session ``user`` was redirected back with. Returns True if queued."""
+    if not session_id.startswith(CHECKOUT_SESSION_PREFIX) or len(session_id) > 200:
+        return False
+    waiting = StripeEvent.objects.filter(
+        type=PAYMENT_SUCCESS, status__in=['pending', 'processing'], payload__user_id=user.pk,
+    ).count()
+    if waiting >= MAX_PENDING_PAYMENT_CHECKS:
+        logger.warning(f"User {user.pk} already has {waiting} payment checks waiting; ignoring {session_id}")
+        return False
+    return enqueue(f'payment_success:{session_id}', PAYMENT_SUCCESS, {'session_id': session_id, 'user_id': user.pk})
+
+
+def backoff(attempts):
+    return min(BASE_BACKOFF * (2 ** max(attempts - 1, 0)), MAX_BACKOFF)
+
+
+def handle_checkout_session_completed(session):
+    client_reference_id = session.get('client_reference_id')
+
+    # Already applied (by the webhook or by the success redirect)
+    if session.get('id') and PaymentHistory.objects.filter(stripe_id=session.get('id')).exists():
+        return
+
+    # Retrieve the user
+    try:
+        user = User.objects.get(id=client_reference_id)
+    except (User.DoesNotExist, ValueError):
+        logger.error(f"User with ID {client_reference_id} not found.")
+        return
+
+    # Retrieve the subscription to get the plan/product
+    subscription_id = session.get('subscription')
+    if not subscription_id:
+        return
+
+    try:
+        subscription = stripe.Subscription.retrieve(subscription_id)
+    except Exception as e:
+        logger.error(f"Error processing subscription: {e}")
+        raise
+
+    price_data = subscription['items']['data'][0]['price']
+    price_id = price_data['id']
+    product_id = price_data.get('product')
+
+    # Find the plan matching this price_id OR product_id (or the settings mapping)
+    plan = get_registry().for_price(price_id, product_id)
+
+    if not plan:
+        logger.warning(f"Plan not found for price ID {price_id}")
+        return
+
+    with transaction.atomic():
+        # Update user profile
+        profile, created = UserProfile.objects.get_or_create(user=user)
+        profile.current_plan = plan
+        profile.stripe_subscription_id = subscription_id
+        # Convert timestamp to datetime
+        if 'current_period_end' in subscription:
+            profile.subscription_end_date = datetime.fromtimestamp(subscription['current_period_end'], tz=dt_timezone.utc)
+        profile.save()
+        logger.info(f"Updated plan for user {user.username} to {plan.name}")
+
+        # Record payment history
+        amount_total = (session.get('amount_total') or 0) / 100.0  # Convert cents to currency unit
+        PaymentHistory.objects.create(
+            user=user,
+            amount=amount_total,
+            status=session.get('payment_status', 'unknown'),
+            stripe_id=session.get('id'),
+            plan_name=plan.name
+        )
+
+
+def handle_payment_success(payload):
+    try:
+        session = stripe.checkout.Session.retrieve(payload['session_id'])
+    except stripe.error.InvalidRequestError:
+        # Unknown id: retrying cannot help
+        logger.warning(f"Checkout session {payload['session_id']} not found; dropping it")
+        return
+    if str(session.get('client_reference_id')) != str(payload.get('user_id')):
+        logger.warning(f"Checkout session {payload['session_id']} does not belong to user {payload.get('user_id')}")
+        return
+    if session.payment_status == 'paid':
+        handle_checkout_session_completed(session)
+
+
+def dispatch(event):
+    if event.type == CHECKOUT_COMPLETED:
+        handle_checkout_session_completed(event.payload['data']['object'])
+    elif event.type == PAYMENT_SUCCESS:
+        handle_payment_success(event.payload)
+    else:
+        logger.info(f"Ignoring Stripe event {event.event_id} of type {event.type}")
+
+
+def claim(event):
+    """Mark a due event as processing. Returns False if another worker got it first."""
+    return StripeEvent.objects.filter(pk=event.pk, status=event.status).update(
+        status='processing', attempts=F('attempts') + 1, next_attempt_at=timezone.now(),
+    ) == 1
+
+
+def process_event(event):
+    """Run one claimed event, recording success or scheduling a retry."""
+    event.refresh_from_db()
+    try:
+        dispatch(event)
+    except Exception as e:
+        logger.exception(f"Error processing Stripe event {event.event_id}")
+        event.last_error = str(e)
+        if event.attempts >= MAX_ATTEMPTS:
+            event.status = 'failed'
+        else:
+            event.status = 'pending'
+            event.next_attempt_at = timezone.now() + backoff(event.attempts)
+        event.save(update_fields=['status', 'last_error', 'next_attempt_at'])
+        return False
+
+    event.status = 'processed'
+    event.processed_at = timezone.now()
+    event.last_error = ''
+    event.save(update_fields=['status', 'processed_at', 'last_error'])
+    return True
+
+
+def due_events(limit):
+    now = timezone.now()
+    return list(
+        StripeEvent.objects.filter(
+            Q(status='pending', next_attempt_at__lte=now)
+            | Q(status='processing', next_attempt_at__lte=now - PROCESSING_TIMEOUT)
+        ).order_by('next_attempt_at')[:limit]
+    )
+
+
+def process_due_events(limit=100):
+    """Process up to ``limit`` due events. Returns ``(processed, failed)``."""
+    processed = failed = 0
+    for event in due_events(limit):
+        if not claim(event):
+            continue
+        if process_event(event):
+            processed += 1
+        else:
+            failed += 1
+    return processed, failed
@@ -0,0 +1,85 @@
+"""
+Normalized article tags.
+
+``Article.tags`` stays the comma-separated field editors type into. On save
+it is mirrored into ``Tag`` rows linked through ``Article.tag_set`` (an
+indexed many-to-many), which is what ``/conteudo/?tag=<slug>`` filters on.
+
+Each ``Tag`` keeps ``published_count``, recounted only for the tags an
+article gained, lost or (through a status change) affected. The tag cloud is
+cached until a count changes.
+"""
+from django.core.cache import cache
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils.text import slugify
+
+CLOUD_KEY = 'tags:cloud'
+CLOUD_TIMEOUT = 60 * 60 * 24
+CLOUD_SIZE = 30
+
+
+def parse_tags(value):
+    """Return ``[(slug, name), ...]`` for a comma-separated string, without duplicates."""
+    tags = {}
+    for name in (value or '').split(','):
+        name = ' '.join(name.split())
+        slug = slugify(name)[:50]
+        if slug and slug not in tags:
+            tags[slug] = name[:50]
+    return list(tags.items())
+
+
+def recount(tag_ids):
+    """Recompute ``published_count`` for ``tag_ids``."""
+    from .models import Article, Tag
+
+    if not tag_ids:
+        return
+    published = (
+        Article.tag_set.through.objects
+        .filter(tag_id=OuterRef('pk'), article__status='published')
+        .values('tag_id').annotate(n=Count('pk')).values('n')
+    )
+    Tag.objects.filter(pk__in=tag_ids).update(
+        published_count=Coalesce(Subquery(published, output_field=IntegerField()), Value(0)),
+    )
+    cache.delete(CLOUD_KEY)
+
+
+def sync_article_tags(article, status_changed=True):
+    """Mirror ``article.tags`` into ``article.tag_set`` and update the counts it affects.
+
+    Only the tags the article gained or lost are recounted, unless its status
+    changed, which moves it in or out of every one of its counts.
+    """
+    from .models import Tag
+
+    wanted = parse_tags(article.tags)
+    existing = {tag.slug: tag for tag in Tag.objects.filter(slug__in=[slug for slug, _ in wanted])}
+    missing = [Tag(slug=slug, name=name) for slug, name in wanted if slug not in existing]
+    if missing:
+        Tag.objects.bulk_create(missing, ignore_conflicts=True)
+        existing = {tag.slug: tag for tag in Tag.objects.filter(slug__in=[slug for slug, _ in wanted])}
+
+    old_ids = set(article.tag_set.values_list('pk', flat=True))
+    new_ids = {existing[slug].pk for slug, _ in wanted if slug in existing}
+    if old_ids != new_ids:
+        article.tag_set.set(new_ids)
+    recount(old_ids | new_ids if status_changed else old_ids ^ new_ids)
+
+
+def tag_cloud():
+    """Return ``[{'slug', 'name', 'count'}, ...]`` for the most used published tags."""
+    from .models import Tag
+
+    cloud = cache.get(CLOUD_KEY)
+    if cloud is None:
+        cloud = list(
+            Tag.objects.filter(published_count__gt=0)
+            .order_by('-published_count', 'slug')
+            .values('slug', 'name', count=F('published_count'))[:CLOUD_SIZE]
+        )
+        cache.set(CLOUD_KEY, cloud, CLOUD_TIMEOUT)
+    return cloud
+
@@ -0,0 +1,10 @@
+from django import template
+
+register = template.Library()
+
+@register.filter
+def can_access(entitlement, required_plan):
+    """Usage: {% if request.entitlement|can_access:article.required_plan %}"""
+    if entitlement is None or entitlement == '':
+        return not required_plan or not required_plan.level
+    return entitlement.can_access(required_plan)
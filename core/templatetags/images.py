@@ -0,0 +1,39 @@
+from django import template
+from django.utils.html import format_html
+
+from core.images import get_manifest, srcset
+
+register = template.Library()
+
+@register.simple_tag
+def responsive_image(field, alt='', sizes='100vw', css_class='', loading='lazy'):
+    """
+    Usage: {% responsive_image article.cover_image alt=article.title sizes="(min-width: 768px) 33vw, 100vw" css_class="..." %}
+
+    Emits a <picture> with WebP and JPEG srcsets from the image's
+    derivatives, falling back to the original upload. Never builds them: that
+    is left to the post_save receiver and build_image_derivatives.
+    """
+    if not field:
+        return ''
+    manifest = get_manifest(field, build=False)
+    if not manifest:
+        return format_html(
+            '<img src="{}" alt="{}" class="{}" loading="{}" decoding="async">',
+            field.url, alt, css_class, loading,
+        )
+
+    storage = field.storage
+    variants = manifest['variants']
+    jpeg = variants['jpeg']
+    largest = jpeg[-1]
+    return format_html(
+        '<picture style="display: contents">'
+        '<source type="image/webp" srcset="{}" sizes="{}">'
+        '<img src="{}" srcset="{}" sizes="{}" width="{}" height="{}" alt="{}" class="{}" loading="{}" decoding="async">'
+        '</picture>',
+        srcset(storage, variants['webp']), sizes,
+        storage.url(largest[1]), srcset(storage, jpeg), sizes,
+        largest[0], round(manifest['height'] * largest[0] / manifest['width']),
+        alt, css_class, loading,
+    )
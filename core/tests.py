@@ -1,13 +1,54 @@
-from django.test import TestCase, Client
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from decimal import Decimal
+from django.conf import settings
+from django.test import TestCase, TransactionTestCase, Client, RequestFactory, override_settings
 from django.contrib.auth.models import User
 from django.urls import reverse
 from django.utils import timezone
-from django.core.management import call_command
-from unittest.mock import patch
-from .models import Plan, UserProfile
+from django.core.management import CommandError, call_command
+from unittest.mock import Mock, patch
+from django.db import OperationalError, connection, connections, transaction
+from django.db.utils import ConnectionHandler
+from django.db.models.query import QuerySet
+from django.contrib.sessions.models import Session
+from axes.models import AccessAttempt, AccessAttemptExpiration
+from django.test.utils import CaptureQueriesContext
+from django.core.cache import cache
+from django.http import Http404
+from django.core.files.base import ContentFile
+from .models import Plan, UserProfile, Tag, Article, Comment, Course, Module, Lesson, CourseProgress, DailyVisit, MetricRollup, PaymentHistory, StripeEvent, RelatedArticle, RelatedRefresh
+from .comments import load_comment_tree
+from .outline import get_course_outline
+from .counters import ViewCounterBuffer, pending_increments, view_counters
+from .visits import HyperLogLog, VisitAggregator, visit_aggregator
+from .entitlements import get_entitlement
+from .storage import EncryptedFileError, EncryptedFileSystemStorage
+from .file_serving import serve_file
+from .document_cache import get_document_cache
+from .routers import AnalyticsRouter
+from .sessions import clear_expired_sessions
+from .media import serve_media
+from .images import get_manifest
+from .body_images import optimize_upload, rewrite_images
+from .article_body import RENDER_VERSION, render_body
+from django.template import Context, Template
+from PIL import Image
+from . import outline, page_cache, plans, related, rollups, search, stripe_inbox, tags
 from datetime import timedelta
 
 class SubscriptionCancellationTest(TestCase):
+    databases = {'default', 'analytics'}
+
     def setUp(self):
         self.client = Client()
         self.user = User.objects.create_user(username='testuser', password='password')
@@ -45,6 +86,8 @@ class SubscriptionCancellationTest(TestCase):
         )
 
 class SubscriptionExpirationTest(TestCase):
+    databases = {'default', 'analytics'}
+
     def setUp(self):
         # Create user first, which triggers signal to create 'Livre' plan
         self.user = User.objects.create_user(username='expireduser', password='password')
@@ -85,3 +128,1438 @@ class SubscriptionExpirationTest(TestCase):
         
         active_profile.refresh_from_db()
         self.assertEqual(active_profile.current_plan, self.paid_plan)
+
+    def test_batches_and_dry_run(self):
+        for i in range(5):
+            user = User.objects.create_user(username=f'expired{i}', password='password')
+            user.profile.current_plan = self.paid_plan
+            user.profile.subscription_end_date = timezone.now() - timedelta(days=2)
+            user.profile.save()
+
+        out = io.StringIO()
+        call_command('check_subscriptions', '--dry-run', stdout=out)
+        self.assertIn('Would downgrade 6 profiles', out.getvalue())
+        self.assertEqual(UserProfile.objects.filter(current_plan=self.paid_plan).count(), 6)
+
+        out = io.StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('check_subscriptions', '--batch-size', '4', stdout=out)
+        self.assertIn('Downgraded 6 profiles to Livre in 2 batches', out.getvalue())
+        self.assertEqual(UserProfile.objects.filter(current_plan=self.free_plan).count(), 6)
+        today = timezone.localdate()
+        self.assertEqual(rollups.total('churn', today, today), 6)
+
+    def test_renewal_during_batch_is_not_downgraded(self):
+        renewed = User.objects.create_user(username='renewed', password='password').profile
+        renewed.current_plan = self.paid_plan
+        renewed.subscription_end_date = timezone.now() - timedelta(days=1)
+        renewed.save()
+        update = QuerySet.update
+
+        def renew_first(queryset, **kwargs):
+            if 'current_plan' in kwargs:
+                # The webhook extends the subscription between the SELECT and the UPDATE
+                UserProfile.objects.filter(pk=renewed.pk).update(subscription_end_date=timezone.now() + timedelta(days=30))
+            return update(queryset, **kwargs)
+
+        out = io.StringIO()
+        with patch.object(QuerySet, 'update', renew_first), self.captureOnCommitCallbacks(execute=True):
+            call_command('check_subscriptions', stdout=out)
+        self.assertIn('Downgraded 1 profiles', out.getvalue())
+        renewed.refresh_from_db()
+        self.assertEqual(renewed.current_plan, self.paid_plan)
+        today = timezone.localdate()
+        self.assertEqual(rollups.total('churn', today, today), 1)
+
+class ArticleSearchTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.ethics = Article.objects.create(
+            title='Ética a Nicômaco', summary='Sobre a virtude.',
+            content='<p>A ação virtuosa segundo Aristóteles.</p>', tags='ética, aristóteles',
+            status='published',
+        )
+        self.republic = Article.objects.create(
+            title='A República', summary='Platão e a justiça.',
+            content='<p>Uma leitura sobre a ação política e a ética.</p>', tags='platão',
+            status='published',
+        )
+        self.draft = Article.objects.create(
+            title='Rascunho sobre ética', summary='-', content='', tags='', status='draft',
+        )
+
+    def test_accent_insensitive_ranked_search(self):
+        results = search.search_articles(Article.objects.filter(status='published'), 'etica')
+        # Title matches outrank body matches; drafts are never returned
+        self.assertEqual([a.pk for a in results], [self.ethics.pk, self.republic.pk])
+        self.assertIn('<mark>', results[0].search_snippet)
+
+    def test_index_follows_save_and_delete(self):
+        self.republic.title = 'Metafísica'
+        self.republic.content = ''
+        self.republic.summary = ''
+        self.republic.save()
+        self.assertEqual([pk for pk, _ in search.search('republica')], [])
+        self.assertEqual([pk for pk, _ in search.search('metafisica')], [self.republic.pk])
+
+        self.ethics.delete()
+        self.assertEqual(search.search('nicomaco'), [])
+
+    def test_snippet_escapes_html(self):
+        Article.objects.create(
+            title='Script', summary='<script>x</script> virtude', content='',
+            tags='', status='published',
+        )
+        results = search.search('virtude')
+        self.assertTrue(all('<script>' not in snippet for _, snippet in results))
+
+    def test_content_list_uses_query(self):
+        response = self.client.get(reverse('content_list'), {'q': 'aristoteles'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['articles']), [self.ethics])
+
+    def test_filters_apply_before_limit(self):
+        # The better-ranked match outside the filter must not use up the limit
+        within = Article.objects.filter(tags__icontains='platão')
+        self.assertEqual([pk for pk, _ in search.search('etica', limit=1, within=within)], [self.republic.pk])
+        self.assertEqual(search.search('etica', within=Article.objects.none()), [])
+
+class CommentTreeTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username='reader', password='password')
+        self.article = Article.objects.create(
+            title='Fédon', summary='Sobre a alma.', content='', tags='', status='published',
+        )
+
+    def comment(self, parent=None, active=True):
+        return Comment.objects.create(
+            user=self.user, article=self.article, content='...', parent=parent, active=active,
+        )
+
+    def test_builds_nested_tree_with_counts(self):
+        root = self.comment()
+        reply = self.comment(parent=root)
+        self.comment(parent=reply)
+        hidden = self.comment(parent=root, active=False)
+        self.comment(parent=hidden)
+
+        with self.assertNumQueries(3):
+            tree = load_comment_tree(article=self.article)
+
+        self.assertEqual(tree.total, 3)
+        self.assertEqual(tree.roots, [root])
+        self.assertEqual(tree.roots[0].reply_count, 2)
+        self.assertEqual(tree.roots[0].children[0].children[0].parent_id, reply.pk)
+
+    def test_cursor_pagination(self):
+        roots = [self.comment() for _ in range(5)]
+        first = load_comment_tree(article=self.article, per_page=2)
+        self.assertEqual([c.pk for c in first], [roots[4].pk, roots[3].pk])
+        self.assertTrue(first.has_next)
+
+        second = load_comment_tree(article=self.article, cursor=first.next_cursor, per_page=2)
+        third = load_comment_tree(article=self.article, cursor=second.next_cursor, per_page=2)
+        self.assertEqual([c.pk for c in second], [roots[2].pk, roots[1].pk])
+        self.assertEqual([c.pk for c in third], [roots[0].pk])
+        self.assertFalse(third.has_next)
+
+    def test_only_loads_replies_of_the_page(self):
+        old, new = self.comment(), self.comment()
+        old_reply, new_reply = self.comment(parent=old), self.comment(parent=new)
+        tree = load_comment_tree(article=self.article, per_page=1)
+        self.assertEqual((tree.total, tree.root_count), (4, 2))
+        self.assertEqual(tree.roots[0].children, [new_reply])
+        second = load_comment_tree(article=self.article, cursor=tree.next_cursor, per_page=1)
+        self.assertEqual(second.roots[0].children, [old_reply])
+
+    def test_article_page_query_count_is_flat(self):
+        for _ in range(3):
+            root = self.comment()
+            self.comment(parent=self.comment(parent=root))
+        url = reverse('article_detail', args=[self.article.slug])
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(url)
+        for _ in range(20):
+            self.comment(parent=self.comment())
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.get(url)
+        self.assertEqual(len(few), len(many))
+        self.assertEqual(response.context['comments'].total, 49)
+
+class CourseOutlineTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.course = Course.objects.create(title='Lógica', description='...', status='published')
+        self.first = Module.objects.create(course=self.course, title='Termos', order=1)
+        self.second = Module.objects.create(course=self.course, title='Silogismos', order=2)
+        self.l1 = Lesson.objects.create(course=self.course, module=self.first, title='Aula 1', order=1, duration='10:30')
+        self.l2 = Lesson.objects.create(course=self.course, module=self.first, title='Aula 2', order=2, duration='59:30')
+        self.l3 = Lesson.objects.create(course=self.course, module=self.second, title='Aula 3', order=3, duration='??')
+
+    def test_outline_structure(self):
+        outline = get_course_outline(self.course.pk)
+        self.assertEqual(outline.lesson_count, 3)
+        self.assertEqual([m['lesson_count'] for m in outline.modules], [2, 1])
+        self.assertEqual(outline.total_duration, '1:10:00')
+        previous, following = outline.neighbours(self.l2.pk)
+        self.assertEqual((previous['id'], following['id']), (self.l1.pk, self.l3.pk))
+        self.assertEqual(outline.neighbours(self.l1.pk)[0], None)
+
+        response = self.client.get(reverse('course_detail', args=[self.course.slug]))
+        self.assertContains(response, '3 aulas • 1:10:00')
+
+    def test_rebuilt_on_lesson_save(self):
+        get_course_outline(self.course.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            Lesson.objects.create(course=self.course, module=self.second, title='Aula 4', order=4)
+        with self.assertNumQueries(0):
+            outline = get_course_outline(self.course.pk)
+        self.assertEqual(outline.lesson_count, 4)
+
+    def test_lesson_page_sidebar_does_not_query_per_module(self):
+        url = reverse('lesson_detail', args=[self.course.slug, self.l1.pk])
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as before:
+            self.client.get(url)
+        for i in range(5):
+            module = Module.objects.create(course=self.course, title=f'Extra {i}', order=10 + i)
+            Lesson.objects.create(course=self.course, module=module, title=f'Extra {i}', order=10 + i)
+        outline.rebuild_course_outline(self.course.pk)
+        with CaptureQueriesContext(connection) as after:
+            response = self.client.get(url)
+        self.assertEqual(len(before), len(after))
+        self.assertEqual(response.context['next_lesson']['id'], self.l2.pk)
+
+class MembersProgressTest(TestCase):
+    databases = {'default', 'analytics'}
+
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username='student', password='password')
+        self.client.force_login(self.user)
+
+    def make_course(self, title, lessons):
+        course = Course.objects.create(title=title, description='...', status='published')
+        return course, [
+            Lesson.objects.create(course=course, title=f'{title} {i}', order=i) for i in range(lessons)
+        ]
+
+    def test_progress_and_flat_query_count(self):
+        course, lessons = self.make_course('Ética', 4)
+        CourseProgress.objects.create(user=self.user, lesson=lessons[0])
+        CourseProgress.objects.create(user=self.user, lesson=lessons[1])
+        other = User.objects.create_user(username='other', password='password')
+        CourseProgress.objects.create(user=other, lesson=lessons[2])
+        self.make_course('Vazio', 0)
+
+        url = reverse('members')
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as before:
+            response = self.client.get(url)
+        progress = {item['course'].title: item['progress'] for item in response.context['course_data']}
+        self.assertEqual(progress, {'Ética': 50, 'Vazio': 0})
+
+        for i in range(5):
+            self.make_course(f'Curso {i}', 3)
+        with CaptureQueriesContext(connection) as after:
+            self.client.get(url)
+        self.assertEqual(len(before), len(after))
+
+class ViewCounterTest(TestCase):
+    databases = {'default', 'analytics'}
+
+    def setUp(self):
+        view_counters.discard()
+        self.client = Client()
+        self.article = Article.objects.create(
+            title='Timeu', summary='...', content='', tags='', status='published',
+        )
+        self.course = Course.objects.create(title='Cosmologia', description='...', status='published')
+
+    def tearDown(self):
+        view_counters.discard()
+
+    def test_views_are_buffered_then_flushed_in_batches(self):
+        url = reverse('article_detail', args=[self.article.slug])
+        for _ in range(3):
+            self.client.get(url)
+        self.client.get(reverse('course_detail', args=[self.course.slug]))
+
+        self.article.refresh_from_db()
+        self.assertEqual(self.article.views, 0)
+        self.assertEqual(view_counters.pending(), 4)
+
+        # One UPDATE per distinct increment (+3 for the article, +1 for the course)
+        with self.assertNumQueries(4):  # savepoint, 2 updates, release
+            self.assertEqual(view_counters.flush(), 4)
+        self.article.refresh_from_db()
+        self.course.refresh_from_db()
+        self.assertEqual((self.article.views, self.course.views), (3, 1))
+        self.assertEqual(view_counters.pending(), 0)
+
+    @override_settings(VIEW_COUNTER_FLUSH_HITS=2, VIEW_COUNTER_FLUSH_INTERVAL=3600)
+    def test_flushes_after_response_when_due(self):
+        url = reverse('article_detail', args=[self.article.slug])
+        self.client.get(url)
+        self.client.get(url)
+        self.article.refresh_from_db()
+        self.assertEqual(self.article.views, 2)
+
+    def test_staff_dashboard_shows_pending_increments(self):
+        staff = User.objects.create_user(username='staff', password='password', is_staff=True)
+        self.client.force_login(staff)
+        self.client.get(reverse('article_detail', args=[self.article.slug]))
+        response = self.client.get(reverse('members'))
+        self.assertContains(response, '1 visualizações pendentes')
+
+    def test_workers_publish_to_their_own_slots(self):
+        cache.clear()
+        with patch('core.counters.os.getpid', return_value=101):
+            other = ViewCounterBuffer()
+            other.incr(Article, self.article.pk, 4)
+        view_counters.incr(Article, self.article.pk)
+        self.assertEqual(pending_increments(), 5)
+        # A worker that published first keeps its slot
+        with patch('core.counters.os.getpid', return_value=101):
+            other.incr(Article, self.article.pk)
+            other._publish_pending(force=True)
+        self.assertEqual(pending_increments(), 6)
+
+class DailyVisitTest(TestCase):
+    databases = {'default', 'analytics'}
+
+    def setUp(self):
+        visit_aggregator.discard()
+        self.client = Client(HTTP_USER_AGENT='Mozilla/5.0')
+
+    def tearDown(self):
+        visit_aggregator.discard()
+
+    def test_hyperloglog_estimate_and_merge(self):
+        first, second = HyperLogLog(), HyperLogLog()
+        for i in range(20000):
+            value = int.from_bytes(hashlib.blake2b(str(i).encode(), digest_size=8).digest(), 'big')
+            (first if i % 2 else second).add_hash(value)
+            if i < 5000:
+                # Overlap between the two "workers"
+                (second if i % 2 else first).add_hash(value)
+        first.merge(second)
+        self.assertAlmostEqual(first.count(), 20000, delta=20000 * 0.05)
+
+    def test_middleware_records_without_session_or_queries(self):
+        with self.assertNumQueries(0), self.assertNumQueries(0, using='analytics'):
+            response = self.client.get(reverse('about'))
+        self.assertNotIn('sessionid', response.cookies)
+        self.assertEqual(DailyVisit.objects.count(), 0)
+
+        visit_aggregator.flush()
+        self.assertEqual(DailyVisit.objects.get().count, 1)
+
+    def test_bots_are_not_counted(self):
+        self.client.get(reverse('about'), HTTP_USER_AGENT='Googlebot/2.1')
+        self.assertEqual(visit_aggregator.flush(), 0)
+
+    def test_flushes_from_several_workers_merge(self):
+        other_worker = VisitAggregator()
+        self.client.get(reverse('about'), REMOTE_ADDR='10.0.0.1')
+        self.client.get(reverse('about'), REMOTE_ADDR='10.0.0.2')
+        for address in ('10.0.0.2', '10.0.0.3'):
+            request = RequestFactory().get('/', REMOTE_ADDR=address, HTTP_USER_AGENT='Mozilla/5.0')
+            other_worker.record(request)
+
+        visit_aggregator.flush()
+        other_worker.flush()
+        self.assertEqual(DailyVisit.objects.get().count, 3)
+
+class MetricRollupTest(TestCase):
+    databases = {'default', 'analytics'}
+
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username='subscriber', password='password')
+        self.paid_plan = Plan.objects.create(name='Apoiador', level=1)
+
+    def test_bucket_boundaries(self):
+        day = datetime.date(2026, 1, 15)  # Thursday
+        self.assertEqual(rollups.bucket_start(day, 'week'), datetime.date(2026, 1, 12))
+        self.assertEqual(rollups.bucket_start(day, 'month'), datetime.date(2026, 1, 1))
+        self.assertEqual(rollups.next_bucket(datetime.date(2025, 12, 1), 'month'), datetime.date(2026, 1, 1))
+
+    def test_revenue_and_subscription_rollups(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            PaymentHistory.objects.create(user=self.user, amount=Decimal('10.00'), status='paid')
+            PaymentHistory.objects.create(user=self.user, amount=Decimal('5.50'), status='paid')
+            PaymentHistory.objects.create(user=self.user, amount=Decimal('99.00'), status='open')
+            # Rolled back: never reaches the rollups
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                PaymentHistory.objects.create(user=self.user, amount=Decimal('7.00'), status='paid')
+                raise RuntimeError
+
+            profile = self.user.profile
+            profile.current_plan = self.paid_plan
+            profile.save()
+            profile.current_plan = Plan.objects.get(name='Livre')
+            profile.save()
+
+        today = timezone.localdate()
+        self.assertEqual(rollups.total('revenue', today, today), Decimal('15.50'))
+        self.assertEqual(rollups.series('revenue', today, today, 'month')[0][1], Decimal('15.50'))
+        self.assertEqual(rollups.total('new_subscribers', today, today), 1)
+        self.assertEqual(rollups.total('churn', today, today), 1)
+
+    def test_deferred_plan_is_not_loaded(self):
+        with self.assertNumQueries(1):
+            profiles = list(UserProfile.objects.only('pk', 'user_id'))
+        with self.captureOnCommitCallbacks(execute=True):
+            profiles[0].save()
+        self.assertEqual(rollups.total('new_subscribers', timezone.localdate(), timezone.localdate()), 0)
+
+    def test_series_fills_gaps_in_one_query(self):
+        start = datetime.date(2026, 1, 1)
+        rollups.record('visits', start, 4)
+        rollups.record('visits', start + timedelta(days=2), 6)
+        with self.assertNumQueries(1, using='analytics'):
+            values = rollups.series('visits', start, start + timedelta(days=3))
+        self.assertEqual([int(v) for _, v in values], [4, 0, 6, 0])
+        self.assertEqual(rollups.total('visits', start, start, 'week'), 10)
+
+    def test_staff_dashboard_range_and_payment_pages(self):
+        staff = User.objects.create_user(username='admin', password='password', is_staff=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            for _ in range(30):
+                PaymentHistory.objects.create(user=self.user, amount=Decimal('1.00'), status='paid')
+        self.client.force_login(staff)
+        response = self.client.get(reverse('members'), {'periodo': 'week', 'pagina': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['payments'].object_list), 5)
+        self.assertEqual(response.context['total_revenue'], Decimal('30.00'))
+
+        response = self.client.get(reverse('members'), {'inicio': '2026-01-14', 'fim': '2026-02-03', 'periodo': 'month'})
+        self.assertEqual(response.context['range_start'], datetime.date(2026, 1, 1))
+        self.assertEqual(response.context['range_end'], datetime.date(2026, 2, 28))
+
+        # At most MAX_RANGE_DAYS, never past today
+        response = self.client.get(reverse('members'), {'inicio': '0001-01-01', 'fim': '9999-12-31', 'periodo': 'month'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['range_end'], rollups.bucket_range(timezone.localdate(), timezone.localdate(), 'month')[1])
+        self.assertContains(response, 'Escolha um período de até 366 dias.')
+
+class EntitlementTest(TestCase):
+    databases = {'default', 'analytics'}
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.user = User.objects.create_user(username='member', password='password')
+        self.plan = Plan.objects.create(name='Irrestrito', level=2)
+        self.article = Article.objects.create(
+            title='Metafísica', summary='...', content='', tags='',
+            status='published', required_plan=self.plan,
+        )
+
+    def fresh_user(self):
+        return User.objects.get(pk=self.user.pk)
+
+    def test_resolved_once_and_cached(self):
+        user = self.fresh_user()
+        with self.assertNumQueries(1):
+            entitlement = get_entitlement(user)
+        self.assertEqual(entitlement.plan_name, 'Livre')
+        self.assertFalse(entitlement.can_access(self.plan))
+        user = self.fresh_user()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_entitlement(user).plan_level, 0)
+
+    def test_invalidated_on_profile_and_plan_save(self):
+        get_entitlement(self.fresh_user())
+        with self.captureOnCommitCallbacks() as callbacks:
+            profile = self.user.profile
+            profile.current_plan = self.plan
+            profile.save()
+            # Invalidated only once the change is committed
+            self.assertFalse(get_entitlement(self.fresh_user()).can_access(self.plan))
+        for callback in callbacks:
+            callback()
+        self.assertTrue(get_entitlement(self.fresh_user()).can_access(self.plan))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.plan.level = 1
+            self.plan.save()
+        self.assertEqual(get_entitlement(self.fresh_user()).plan_level, 1)
+
+    def test_gated_article(self):
+        url = reverse('article_detail', args=[self.article.slug])
+        self.assertRedirects(self.client.get(url), reverse('account_login'), fetch_redirect_response=False)
+
+        self.client.force_login(self.user)
+        self.assertRedirects(self.client.get(url), reverse('subscribe'), fetch_redirect_response=False)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            profile = self.user.profile
+            profile.current_plan = self.plan
+            profile.save()
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+
+class StripeInboxTest(TestCase):
+    databases = {'default', 'analytics'}
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='assinante', password='password')
+        self.plan = Plan.objects.create(name='Mecenas', level=2, stripe_price_id='price_mecenas')
+        self.session = {
+            'id': 'cs_test_1', 'client_reference_id': str(self.user.pk), 'subscription': 'sub_1',
+            'amount_total': 2500, 'payment_status': 'paid',
+        }
+        self.subscription = {
+            'items': {'data': [{'price': {'id': 'price_mecenas', 'product': 'prod_1'}}]},
+            'current_period_end': 1893456000,
+        }
+
+    def post_webhook(self, event_id):
+        event = {'id': event_id, 'type': 'checkout.session.completed', 'data': {'object': self.session}}
+        with patch('stripe.Webhook.construct_event', return_value=event):
+            return self.client.post(
+                reverse('stripe_webhook'), data=json.dumps(event), content_type='application/json',
+                HTTP_STRIPE_SIGNATURE='t=1,v1=x',
+            )
+
+    def test_webhook_stores_event_once(self):
+        self.assertEqual(self.post_webhook('evt_1').status_code, 200)
+        self.assertEqual(self.post_webhook('evt_1').status_code, 200)
+        event = StripeEvent.objects.get()
+        self.assertEqual(event.status, 'pending')
+        # Nothing is applied during the request
+        self.assertFalse(PaymentHistory.objects.exists())
+
+    @patch('stripe.checkout.Session.retrieve')
+    @patch('stripe.Subscription.retrieve')
+    def test_processing_is_idempotent(self, mock_subscription, mock_session):
+        mock_subscription.return_value = self.subscription
+        mock_session.return_value = Mock(payment_status='paid', **{'get': self.session.get})
+        self.post_webhook('evt_1')
+        self.client.force_login(self.user)
+        self.client.get(reverse('payment_success'), {'session_id': 'cs_test_1'})
+        self.assertEqual(StripeEvent.objects.count(), 2)
+
+        self.assertEqual(stripe_inbox.process_due_events(), (2, 0))
+        self.user.profile.refresh_from_db()
+        self.assertEqual(self.user.profile.current_plan, self.plan)
+        self.assertEqual(PaymentHistory.objects.get().amount, Decimal('25.00'))
+        self.assertEqual(StripeEvent.objects.filter(status='processed').count(), 2)
+
+    @patch('stripe.Subscription.retrieve')
+    def test_failure_is_retried_with_backoff(self, mock_subscription):
+        mock_subscription.side_effect = Exception('Stripe indisponível')
+        self.post_webhook('evt_1')
+        self.assertEqual(stripe_inbox.process_due_events(), (0, 1))
+        event = StripeEvent.objects.get()
+        self.assertEqual((event.status, event.attempts), ('pending', 1))
+        self.assertGreater(event.next_attempt_at, timezone.now())
+        # Not due yet
+        self.assertEqual(stripe_inbox.process_due_events(), (0, 0))
+
+        mock_subscription.side_effect = None
+        mock_subscription.return_value = self.subscription
+        StripeEvent.objects.update(next_attempt_at=timezone.now())
+        out = io.StringIO()
+        call_command('process_stripe_events', '--once', stdout=out)
+        self.assertIn('Processed 1 Stripe events, 0 failed.', out.getvalue())
+        self.assertEqual(StripeEvent.objects.get().status, 'processed')
+        self.assertEqual(PaymentHistory.objects.count(), 1)
+
+    @patch('stripe.checkout.Session.retrieve')
+    def test_success_redirect_checks_are_limited(self, mock_session):
+        url = reverse('payment_success')
+        self.assertEqual(self.client.get(url, {'session_id': 'cs_test_1'}).status_code, 302)
+        self.assertFalse(StripeEvent.objects.exists())
+
+        self.client.force_login(self.user)
+        self.client.get(url, {'session_id': 'not-a-session'})
+        for i in range(stripe_inbox.MAX_PENDING_PAYMENT_CHECKS + 2):
+            self.client.get(url, {'session_id': f'cs_test_{i}'})
+        self.assertEqual(StripeEvent.objects.count(), stripe_inbox.MAX_PENDING_PAYMENT_CHECKS)
+
+        # Someone else's session is not applied, and not retried
+        other = User.objects.create_user(username='outro', password='password')
+        mock_session.return_value = Mock(payment_status='paid', **{'get': {**self.session, 'client_reference_id': str(other.pk)}.get})
+        self.assertEqual(stripe_inbox.process_due_events(), (stripe_inbox.MAX_PENDING_PAYMENT_CHECKS, 0))
+        self.assertFalse(PaymentHistory.objects.exists())
+
+    def test_worker_survives_poll_errors(self):
+        class Stop(Exception):
+            pass
+
+        with patch('core.management.commands.process_stripe_events.process_due_events',
+                   side_effect=[OperationalError('database is locked'), (1, 0)]), \
+                patch('core.management.commands.process_stripe_events.time.sleep', side_effect=[None, Stop]) as sleep:
+            with self.assertLogs('core.management.commands.process_stripe_events', 'ERROR'), self.assertRaises(Stop):
+                call_command('process_stripe_events', '--interval', '1', stdout=io.StringIO())
+        self.assertEqual(sleep.call_args_list[0].args, (2,))
+
+    def test_gives_up_after_max_attempts(self):
+        StripeEvent.objects.create(
+            event_id='evt_2', type='checkout.session.completed', payload={},
+            attempts=stripe_inbox.MAX_ATTEMPTS - 1,
+        )
+        self.assertEqual(stripe_inbox.process_due_events(), (0, 1))
+        self.assertEqual(StripeEvent.objects.get().status, 'failed')
+
+
+class PlanRegistryTest(TestCase):
+    databases = {'default', 'analytics'}
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='comprador', password='password')
+        self.apoiador = Plan.objects.create(name='Apoiador', level=1, stripe_price_id='price_apoiador')
+        self.mecenas = Plan.objects.create(name='Mecenas', level=2, stripe_price_id='prod_mecenas')
+
+    def test_lookups_are_cached_and_invalidated(self):
+        plans.get_registry()
+        with self.assertNumQueries(0):
+            registry = plans.get_registry()
+            self.assertEqual(registry.named('apoiador'), self.apoiador)
+            self.assertEqual(registry.for_price('price_apoiador'), self.apoiador)
+            self.assertEqual(registry.for_price('price_x', 'prod_mecenas'), self.mecenas)
+            self.assertIsNone(registry.for_price('price_x', 'prod_x'))
+
+        self.apoiador.stripe_price_id = 'price_novo'
+        self.apoiador.save()
+        self.assertEqual(plans.get_registry().for_price('price_novo'), self.apoiador)
+        self.mecenas.delete()
+        self.assertIsNone(plans.get_registry().named('Mecenas'))
+
+    @override_settings(STRIPE_PRICE_ID_MECENAS='price_settings')
+    def test_settings_fallback(self):
+        self.assertEqual(plans.get_registry().for_price('price_settings'), self.mecenas)
+
+    @patch('stripe.checkout.Session.create')
+    @patch('stripe.Product.retrieve')
+    def test_checkout_caches_default_price(self, mock_product, mock_session):
+        mock_product.return_value = Mock(default_price='price_mecenas')
+        mock_session.return_value = Mock(url='https://checkout.stripe.com/x')
+        self.client.force_login(self.user)
+        url = reverse('create_checkout_session', args=[self.mecenas.pk])
+        for _ in range(2):
+            self.assertEqual(self.client.get(url).status_code, 302)
+        mock_product.assert_called_once_with('prod_mecenas')
+        self.assertEqual(mock_session.call_args.kwargs['line_items'][0]['price'], 'price_mecenas')
+        self.assertEqual(self.client.get(reverse('create_checkout_session', args=[999])).status_code, 404)
+
+
+@override_settings(ENCRYPTED_STORAGE_SEGMENT_SIZE=100)
+class EncryptedStorageTest(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.location)
+        self.storage = EncryptedFileSystemStorage(location=self.location)
+
+    def test_round_trip_and_random_access(self):
+        for length in (0, 99, 100, 1050):
+            data = os.urandom(length)
+            name = self.storage.save('doc.pdf', ContentFile(data))
+            if data:
+                self.assertNotIn(data[:20], open(self.storage.path(name), 'rb').read())
+            self.assertEqual(self.storage.size(name), length)
+            with self.storage.open(name) as f:
+                self.assertEqual(f.read(), data)
+                f.seek(length // 3)
+                self.assertEqual(f.read(250), data[length // 3:length // 3 + 250])
+
+    def test_tampering_is_detected(self):
+        name = self.storage.save('doc.pdf', ContentFile(os.urandom(500)))
+        path = self.storage.path(name)
+        # Drop the last segment: the new last one is not flagged as such
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 116)
+        with self.storage.open(name) as f:
+            with self.assertRaises(EncryptedFileError):
+                f.read()
+
+    def test_reads_legacy_files(self):
+        with open(os.path.join(self.location, 'fernet.pdf'), 'wb') as f:
+            f.write(self.storage.fernet.encrypt(b'%PDF legado'))
+        with open(os.path.join(self.location, 'plain.pdf'), 'wb') as f:
+            f.write(b'%PDF aberto')
+        self.assertEqual(self.storage.open('fernet.pdf').read(), b'%PDF legado')
+        self.assertEqual(self.storage.open('plain.pdf').read(), b'%PDF aberto')
+        self.assertEqual(self.storage.size('fernet.pdf'), len(b'%PDF legado'))
+
+
+@override_settings(ENCRYPTED_STORAGE_SEGMENT_SIZE=100)
+class ProtectedFileServingTest(TestCase):
+    databases = {'default', 'analytics'}
+
+    def setUp(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        self.storage = EncryptedFileSystemStorage(location=location)
+        self.data = os.urandom(1000)
+        self.name = self.storage.save('doc.pdf', ContentFile(self.data))
+        self.factory = RequestFactory()
+
+    def get(self, **headers):
+        request = self.factory.get('/conteudo/doc/pdf/', headers=headers)
+        return serve_file(
+            request, lambda: self.storage.open(self.name), self.storage.size(self.name),
+            self.storage.get_modified_time(self.name), 'application/pdf', 'private, no-cache',
+        )
+
+    def body(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_full_and_partial_content(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(self.body(response), self.data)
+
+        response = self.get(Range='bytes=250-549')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 250-549/1000')
+        self.assertEqual(self.body(response), self.data[250:550])
+
+        self.assertEqual(self.body(self.get(Range='bytes=-10')), self.data[-10:])
+        self.assertEqual(self.get(Range='bytes=1000-').status_code, 416)
+        # A stale If-Range gets the whole file
+        self.assertEqual(self.get(Range='bytes=0-9', If_Range='"other"').status_code, 200)
+
+    def test_conditional_requests(self):
+        response = self.get()
+        self.assertEqual(self.get(If_None_Match=response['ETag']).status_code, 304)
+        self.assertEqual(self.get(If_Modified_Since=response['Last-Modified']).status_code, 304)
+        self.assertEqual(self.get(If_None_Match='"other"').status_code, 200)
+
+    def test_view_requires_access_and_a_file(self):
+        plan = Plan.objects.create(name='Mecenas', level=2)
+        article = Article.objects.create(title='Gated', summary='...', content='', tags='', status='published', required_plan=plan)
+        user = User.objects.create_user(username='leitor', password='password')
+        self.client.force_login(user)
+        url = reverse('serve_protected_pdf', args=[article.slug])
+        self.assertEqual(self.client.get(url).status_code, 403)
+        article.required_plan = None
+        article.save()
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_view_answers_404_for_corrupt_file(self):
+        article = Article.objects.create(title='Corrompido', summary='...', content='', tags='', status='published')
+        with open(self.storage.path(self.name), 'r+b') as f:
+            f.truncate(10)  # Cut inside the header
+        pdf = Mock(storage=self.storage)
+        pdf.name = self.name
+        with patch.object(Article, 'pdf_file', pdf, create=True):
+            response = self.client.get(reverse('serve_protected_pdf', args=[article.slug]))
+        self.assertEqual(response.status_code, 404)
+
+
+class DocumentCacheTest(TestCase):
+    def setUp(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        settings_override = override_settings(
+            DECRYPTED_CACHE_DIR=os.path.join(location, 'cache'),
+            DECRYPTED_CACHE_MAX_BYTES=2500,
+            DECRYPTED_CACHE_MAX_ENTRY_BYTES=2000,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.storage = EncryptedFileSystemStorage(location=location)
+
+    def test_hits_misses_and_staleness(self):
+        data = os.urandom(1000)
+        name = self.storage.save('doc.pdf', ContentFile(data))
+        for _ in range(3):
+            with self.storage.open(name) as f:
+                self.assertEqual(f.read(), data)
+        stats = get_document_cache().stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (2, 1, 1))
+
+        # A rewritten file never matches the old entry
+        path = self.storage.path(name)
+        os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1000))
+        with self.storage.open(name) as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(get_document_cache().stats()['misses'], 2)
+
+    def read(self, name):
+        with self.storage.open(name) as f:
+            return f.read()
+
+    def test_lru_eviction_and_entry_limit(self):
+        first = self.storage.save('a.pdf', ContentFile(os.urandom(1000)))
+        second = self.storage.save('b.pdf', ContentFile(os.urandom(1000)))
+        self.read(first)
+        self.read(second)
+        self.read(first)  # first is now the most recent
+        third = self.storage.save('c.pdf', ContentFile(os.urandom(1000)))
+        self.read(third)
+        stats = get_document_cache().stats()
+        self.assertEqual((stats['entries'], stats['evictions']), (2, 1))
+        self.read(first)
+        self.assertEqual(get_document_cache().stats()['hits'], 2)
+
+        big = self.storage.save('big.pdf', ContentFile(os.urandom(3000)))
+        self.assertEqual(len(self.read(big)), 3000)
+        self.assertEqual(get_document_cache().stats()['entries'], 2)
+
+    def test_only_full_reads_fill_the_cache(self):
+        data = os.urandom(1000)
+        name = self.storage.save('doc.pdf', ContentFile(data))
+        response = serve_file(
+            RequestFactory().get('/', HTTP_RANGE='bytes=900-949'), lambda: self.storage.open(name),
+            self.storage.size(name), self.storage.get_modified_time(name), 'application/pdf', 'private',
+        )
+        self.assertEqual(b''.join(response.streaming_content), data[900:950])
+        self.assertEqual(get_document_cache().stats()['entries'], 0)
+        with self.storage.open(name) as f:
+            f.seek(0, io.SEEK_END)
+            f.seek(0)
+            self.assertEqual(f.read(), data)
+        self.assertEqual(self.read(name), data)
+        stats = get_document_cache().stats()
+        self.assertEqual((stats['entries'], stats['hits']), (1, 1))
+
+    def test_stats_are_written_per_worker(self):
+        cache = get_document_cache()
+        self.read(self.storage.save('doc.pdf', ContentFile(b'%PDF')))
+        cache.flush_stats()
+        with open(os.path.join(cache.directory, f'stats-{os.getpid()}.json')) as f:
+            self.assertEqual(json.load(f), {'misses': 1})
+        self.assertEqual(cache.stats()['misses'], 1)
+        cache.clear()
+        self.assertEqual(cache.stats()['misses'], 0)
+
+    def test_stats_of_exited_workers_are_folded(self):
+        cache = get_document_cache()
+        worker = subprocess.Popen(['true'])
+        worker.wait()
+        with open(os.path.join(cache.directory, f'stats-{worker.pid}.json'), 'w') as f:
+            json.dump({'hits': 3}, f)
+        self.read(self.storage.save('doc.pdf', ContentFile(b'%PDF')))
+        cache.flush_stats()
+
+        self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (3, 1))
+        stats_files = sorted(name for name in os.listdir(cache.directory) if name.startswith('stats'))
+        self.assertEqual(stats_files, [f'stats-{os.getpid()}.json', 'stats.json'])
+        cache.retire_stats([os.getpid()])
+        self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (3, 1))
+        self.assertNotIn(f'stats-{os.getpid()}.json', os.listdir(cache.directory))
+
+
+class MediaServingTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        settings_override = override_settings(MEDIA_ROOT=self.root, MEDIA_PRIVATE_PREFIXES=('articles/pdfs/',))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        os.makedirs(os.path.join(self.root, 'uploads'))
+        os.makedirs(os.path.join(self.root, 'articles', 'pdfs'))
+        self.svg = b'<svg xmlns="http://www.w3.org/2000/svg">' + b'<g/>' * 500 + b'</svg>'
+        with open(os.path.join(self.root, 'uploads', 'logo.svg'), 'wb') as f:
+            f.write(self.svg)
+        with open(os.path.join(self.root, 'articles', 'pdfs', 'doc.pdf'), 'wb') as f:
+            f.write(b'secret')
+
+    def get(self, path, **headers):
+        return serve_media(RequestFactory().get('/media/' + path, headers=headers), path)
+
+    def test_caching_headers_and_revalidation(self):
+        response = self.get('uploads/logo.svg')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/svg+xml')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(b''.join(response.streaming_content), self.svg)
+        self.assertEqual(self.get('uploads/logo.svg', If_None_Match=response['ETag']).status_code, 304)
+        self.assertEqual(self.get('uploads/logo.svg', Range='bytes=0-3').status_code, 206)
+
+    def test_precompressed_variant(self):
+        call_command('compress_media', stdout=io.StringIO())
+        response = self.get('uploads/logo.svg', Accept_Encoding='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), self.svg)
+        response = self.get('uploads/logo.svg', Accept_Encoding='gzip;q=0')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_private_and_missing_paths(self):
+        for path in ('articles/pdfs/doc.pdf', 'uploads/missing.png', '../secret', 'uploads'):
+            with self.assertRaises(Http404):
+                self.get(path)
+
+    @override_settings(MEDIA_SERVE_MODE='x-accel')
+    def test_accel_handoff(self):
+        response = self.get('uploads/logo.svg')
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/uploads/logo.svg')
+        self.assertEqual(response.content, b'')
+
+
+class ImageDerivativeTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        settings_override = override_settings(MEDIA_ROOT=root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        buffer = io.BytesIO()
+        Image.new('RGBA', (1000, 650), (200, 30, 30, 128)).save(buffer, 'PNG')
+        self.article = Article(title='Capa', summary='...', content='', tags='', status='published')
+        self.article.cover_image.save('capa.png', ContentFile(buffer.getvalue()), save=False)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.article.save()
+
+    def test_derivatives_built_on_save(self):
+        storage = self.article.cover_image.storage
+        manifest = get_manifest(self.article.cover_image, build=False)
+        self.assertEqual((manifest['width'], manifest['height']), (1000, 650))
+        self.assertEqual([w for w, _ in manifest['variants']['webp']], [320, 640, 960, 1000])
+        with storage.open(manifest['variants']['jpeg'][0][1]) as f:
+            self.assertEqual(Image.open(f).size, (320, 208))
+
+    def test_srcset_tag(self):
+        html = Template(
+            '{% load images %}{% responsive_image article.cover_image alt=article.title sizes="33vw" %}'
+        ).render(Context({'article': self.article}))
+        self.assertIn('<source type="image/webp" srcset="/media/derivatives/articles/covers/capa-', html)
+        self.assertIn('320w.webp 320w', html)
+        self.assertIn('width="1000" height="650"', html)
+        self.assertIn('loading="lazy"', html)
+
+    def test_tag_never_builds_derivatives(self):
+        buffer = io.BytesIO()
+        Image.new('RGB', (800, 600)).save(buffer, 'PNG')
+        article = Article(title='Sem derivados', summary='...', content='', tags='', status='published')
+        article.cover_image.save('nova.png', ContentFile(buffer.getvalue()), save=False)
+        with patch('core.images.build_derivatives') as build:
+            html = Template('{% load images %}{% responsive_image article.cover_image %}').render(Context({'article': article}))
+        build.assert_not_called()
+        self.assertIn(f'<img src="{article.cover_image.url}"', html)
+
+
+class BodyImageTest(TestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        settings_override = override_settings(MEDIA_ROOT=root, BODY_IMAGE_MAX_WIDTH=800)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        os.makedirs(os.path.join(root, 'uploads', '2025'))
+        image = Image.new('RGB', (2000, 1000), (10, 80, 160))
+        image.save(os.path.join(root, 'uploads', '2025', 'foto.jpg'), 'JPEG', exif=Image.Exif())
+        self.content = (
+            '<p>Texto</p><img alt="Foto" src="/media/uploads/2025/foto.jpg" />'
+            '<img src="/media/uploads/2025/foto.jpg" style="height:50px; width:100px" />'
+            '<img src="https://example.com/externa.png" />'
+        )
+
+    def test_article_save_only_uses_existing_copies(self):
+        article = Article.objects.create(title='Ilustrado', summary='...', content=self.content, tags='', status='published')
+        # Nothing is encoded during the save
+        self.assertEqual(article.content, self.content)
+        self.assertFalse(os.path.exists(os.path.join(settings.MEDIA_ROOT, 'optimized')))
+
+        self.assertIsNotNone(optimize_upload('uploads/2025/foto.jpg'))
+        article.save()
+        self.assertNotIn('/media/uploads/', article.content)
+        self.assertIn('alt="Foto" src="/media/optimized/uploads/2025/foto-', article.content)
+        self.assertIn('width="800" height="400" loading="lazy" decoding="async"', article.content)
+        self.assertIn('width="100" height="50"', article.content)
+        self.assertIn('<img src="https://example.com/externa.png" />', article.content)
+        # Idempotent
+        self.assertEqual(rewrite_images(article.content), article.content)
+
+    def test_rewrite_keeps_and_escapes_attributes(self):
+        optimize_upload('uploads/2025/foto.jpg')
+        html = rewrite_images(
+            """<img src=/media/uploads/2025/foto.jpg alt='diz "oi"' data-x=1 hidden>"""
+        )
+        self.assertIn('alt="diz &quot;oi&quot;"', html)
+        self.assertIn('data-x="1"', html)
+        self.assertIn(' hidden', html)
+        self.assertIn('src="/media/optimized/uploads/2025/foto-', html)
+
+    def test_command_optimizes_library(self):
+        Article.objects.create(title='Antigo', summary='...', content='', tags='', status='published')
+        Article.objects.filter(title='Antigo').update(content=self.content)
+        out = io.StringIO()
+        call_command('optimize_body_images', '--workers', '1', stdout=out)
+        self.assertIn('Optimized 1 of 1 uploaded images.', out.getvalue())
+        self.assertIn('Rewrote images in 1 articles.', out.getvalue())
+        self.assertIn('.webp', Article.objects.get(title='Antigo').content)
+
+        # Later passes neither open the uploads nor touch articles again
+        Article.objects.create(title='Sem imagens', summary='...', content='<p>Texto</p>', tags='', status='published')
+        cache.clear()
+        out = io.StringIO()
+        with patch('core.body_images.Image.open') as image_open, patch.object(Article, 'save') as save:
+            call_command('optimize_body_images', '--workers', '1', stdout=out)
+        self.assertIn('Optimized 0 of 1 uploaded images.', out.getvalue())
+        image_open.assert_not_called()
+        save.assert_not_called()
+
+
+class ArticleBodyTest(TestCase):
+    content = (
+        '<h2>Introdu&ccedil;&atilde;o</h2><p>Um texto sobre a <a href="https://plato.stanford.edu/">Rep&uacute;blica</a>'
+        ' e <a href="/conteudo/">outros</a>.</p><img src="/static/x.png"><h3>Introdução</h3><h2></h2>'
+        '<script>var nao = "conta";</script>'
+    )
+
+    def test_render_body(self):
+        body = render_body(self.content)
+        self.assertEqual(body.toc, [
+            {'level': 2, 'id': 'introducao', 'text': 'Introdução'},
+            {'level': 3, 'id': 'introducao-2', 'text': 'Introdução'},
+        ])
+        self.assertIn('<h2 id="introducao">Introdu&ccedil;&atilde;o</h2>', body.html)
+        self.assertIn('<a href="https://plato.stanford.edu/" target="_blank" rel="noopener noreferrer">', body.html)
+        self.assertIn('<a href="/conteudo/">outros</a>', body.html)
+        self.assertIn('<img src="/static/x.png" loading="lazy">', body.html)
+        self.assertEqual((body.word_count, body.reading_time), (9, 1))
+
+    def test_headings_without_slug_get_positional_ids(self):
+        body = render_body('<h2>!!!</h2><h2>🙂</h2><h3 id=" ">Fim</h3><h3 id="fim">De novo</h3><h2>secao-1</h2>')
+        self.assertEqual([entry['id'] for entry in body.toc], ['secao-1', 'secao-2', 'fim', 'de-novo', 'secao-1-2'])
+        self.assertIn('<h3 id="fim">Fim</h3>', body.html)
+        self.assertIn('<h3 id="de-novo">De novo</h3>', body.html)
+
+    def test_compiled_on_save_and_rebuilt(self):
+        article = Article.objects.create(title='Compilado', summary='...', content=self.content, tags='', status='published')
+        self.assertEqual(article.content_version, RENDER_VERSION)
+        self.assertIn('id="introducao"', article.content_html)
+        response = self.client.get(reverse('article_detail', args=[article.slug]))
+        self.assertContains(response, '<a href="#introducao-2"')
+        self.assertContains(response, '1 min de leitura')
+
+        Article.objects.filter(pk=article.pk).update(content_html='', content_version=0)
+        out = io.StringIO()
+        call_command('rebuild_article_bodies', stdout=out)
+        self.assertIn('Rebuilt 1 article bodies', out.getvalue())
+        article.refresh_from_db()
+        self.assertIn('id="introducao"', article.content_html)
+
+
+class TagIndexTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.platao = Article.objects.create(title='Platão', summary='...', content='', tags='Platão, Ética, ética', status='published')
+        self.kant = Article.objects.create(title='Kant', summary='...', content='', tags='Ética,Kant', status='draft')
+
+    def counts(self):
+        return dict(Tag.objects.values_list('slug', 'published_count'))
+
+    def test_tags_synced_and_counted(self):
+        self.assertEqual(sorted(self.platao.tag_set.values_list('slug', flat=True)), ['etica', 'platao'])
+        self.assertEqual(self.counts(), {'platao': 1, 'etica': 1, 'kant': 0})
+
+        self.kant.status = 'published'
+        self.kant.save()
+        self.platao.tags = 'Platão'
+        self.platao.save()
+        self.assertEqual(self.counts(), {'platao': 1, 'etica': 1, 'kant': 1})
+        self.kant.delete()
+        self.assertEqual(self.counts(), {'platao': 1, 'etica': 0, 'kant': 0})
+
+    def test_only_changed_tags_are_recounted(self):
+        with patch('core.tags.recount') as recount:
+            self.platao.tags = 'Platão, Kant'
+            self.platao.save()
+            self.assertEqual(recount.call_args.args[0], set(Tag.objects.filter(slug__in=['etica', 'kant']).values_list('pk', flat=True)))
+            self.platao.summary = 'Diálogos'
+            self.platao.save()
+            self.assertEqual(recount.call_args.args[0], set())
+            self.kant.status = 'published'
+            self.kant.save()
+            self.assertEqual(recount.call_args.args[0], set(self.kant.tag_set.values_list('pk', flat=True)))
+
+    def test_filter_and_cloud(self):
+        url = reverse('content_list')
+        response = self.client.get(url, {'tag': 'etica'})
+        self.assertEqual(list(response.context['articles']), [self.platao])
+        self.assertEqual(list(self.client.get(url, {'tag': 'nenhuma'}).context['articles']), [])
+
+        self.assertEqual(tags.tag_cloud(), [
+            {'slug': 'etica', 'name': 'Ética', 'count': 1},
+            {'slug': 'platao', 'name': 'Platão', 'count': 1},
+        ])
+        with self.assertNumQueries(0):
+            tags.tag_cloud()
+        self.kant.status = 'published'
+        self.kant.save()
+        self.assertEqual(tags.tag_cloud()[0], {'slug': 'etica', 'name': 'Ética', 'count': 2})
+
+
+class RelatedArticleTest(TestCase):
+    def create(self, title, tags, content, category='artigo'):
+        article = Article.objects.create(
+            title=title, summary='', content=content, tags=tags, category=category, status='published',
+        )
+        self.refresh()
+        return article
+
+    def refresh(self):
+        call_command('refresh_related_articles', stdout=io.StringIO())
+
+    def related(self, article):
+        return list(RelatedArticle.objects.filter(article=article).values_list('related__title', flat=True))
+
+    def setUp(self):
+        self.kant = self.create('Kant e a razão pura', 'Kant, Crítica', '<p>A razão pura e os juízos sintéticos a priori.</p>')
+        self.critica = self.create('A crítica kantiana', 'Kant', '<p>Juízos sintéticos, razão e experiência.</p>')
+        self.platao = self.create('Platão', 'Platão', '<p>O mundo das ideias e a alegoria da caverna.</p>', 'ensaio')
+
+    def test_tokenize(self):
+        self.assertEqual(related.tokenize('<p>A Razão &amp; os juízos do Ser</p>'), ['razao', 'juizos'])
+
+    def test_neighbours_stored_on_save(self):
+        self.assertEqual(self.related(self.kant), ['A crítica kantiana'])
+        self.assertEqual(self.related(self.platao), [])
+
+        caverna = self.create('A caverna', 'Platão', '<p>A alegoria da caverna e o mundo sensível.</p>', 'ensaio')
+        self.assertEqual(self.related(self.platao), ['A caverna'])
+        self.assertEqual(self.related(caverna), ['Platão'])
+
+        caverna.status = 'draft'
+        caverna.save()
+        self.refresh()
+        self.assertEqual(self.related(self.platao), [])
+        self.assertFalse(RelatedArticle.objects.filter(article=caverna).exists())
+
+        self.critica.delete()
+        self.refresh()
+        self.assertEqual(self.related(self.kant), [])
+
+    def test_saves_only_queue_the_refresh(self):
+        self.critica.title = 'Platão e a caverna'
+        self.critica.save()
+        self.critica.save()
+        self.assertEqual(list(RelatedRefresh.objects.values_list('article_id', flat=True)), [self.critica.pk])
+        self.assertEqual(self.related(self.platao), [])
+
+        self.refresh()
+        self.assertFalse(RelatedRefresh.objects.exists())
+        self.assertEqual(self.related(self.platao), ['Platão e a caverna'])
+
+    def test_refresh_changes_the_article_validators(self):
+        url = reverse('article_detail', args=[self.platao.slug])
+        Article.objects.create(title='A caverna', summary='', content='<p>A alegoria da caverna.</p>', tags='Platão', category='ensaio', status='published')
+        # The save is not committed in this test: only the refresh can change the page
+        etag = self.client.get(url)['ETag']
+        related.refresh_pending()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([article.title for article in response.context['related_articles']], ['A caverna'])
+
+    def test_unchanged_save_skips_refresh(self):
+        self.assertEqual(related.refresh_articles({self.kant.pk: []}), 0)
+
+    def test_rebuild_command_and_detail(self):
+        RelatedArticle.objects.all().delete()
+        call_command('rebuild_related_articles', stdout=io.StringIO())
+        self.assertEqual(self.related(self.critica), ['Kant e a razão pura'])
+
+        response = self.client.get(reverse('article_detail', args=[self.kant.slug]))
+        self.assertEqual(response.context['related_articles'], [self.critica])
+        self.assertContains(response, 'Leia também')
+
+
+class PageCacheTest(TestCase):
+    databases = {'default', 'analytics'}
+
+    def setUp(self):
+        cache.clear()
+        self.article = Article.objects.create(title='Platão', summary='...', content='', tags='Platão', status='published')
+
+    def status(self, url, **params):
+        return self.client.get(url, params).get(page_cache.STATUS_HEADER)
+
+    def test_anonymous_pages_cached_and_purged_by_group(self):
+        home = reverse('home')
+        self.assertEqual(self.status(home), 'miss')
+        with self.assertNumQueries(0):
+            response = self.client.get(home)
+        self.assertEqual(response[page_cache.STATUS_HEADER], 'hit')
+        self.assertContains(response, 'Platão')
+
+        # Courses are not on the home page
+        with self.captureOnCommitCallbacks(execute=True):
+            Course.objects.create(title='Curso', description='...', status='published')
+        self.assertEqual(self.status(home), 'hit')
+        self.assertEqual(self.status(reverse('course_list')), 'miss')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.article.title = 'Aristóteles'
+            self.article.save()
+        response = self.client.get(home)
+        self.assertEqual(response[page_cache.STATUS_HEADER], 'miss')
+        self.assertContains(response, 'Aristóteles')
+
+    def test_stale_copy_served_while_rendering(self):
+        url = reverse('content_list')
+        self.assertEqual(self.status(url, category='artigo'), 'miss')
+        page_cache.invalidate('articles')
+        with page_cache.render_lock(hashlib.md5(b'/conteudo/?category=artigo').hexdigest()) as locked:
+            self.assertTrue(locked)
+            self.assertEqual(self.status(url, category='artigo'), 'stale')
+        self.assertEqual(self.status(url, category='artigo'), 'miss')
+        self.assertEqual(self.status(url, category='artigo'), 'hit')
+
+    def test_bypassed_for_searches_and_users(self):
+        url = reverse('content_list')
+        self.assertIsNone(self.status(url, q='platao'))
+        self.client.force_login(User.objects.create_user('leitor', password='x'))
+        self.assertIsNone(self.status(url))
+
+
+@override_settings(VIEW_COUNTER_FLUSH_INTERVAL=3600)
+class ConditionalGetTest(TestCase):
+    databases = {'default', 'analytics'}
+
+    def setUp(self):
+        cache.clear()
+        view_counters.discard()
+        self.addCleanup(view_counters.discard)
+        self.article = Article.objects.create(title='Platão', summary='...', content='<p>Texto</p>', tags='', status='published')
+        self.course = Course.objects.create(title='Curso', description='...', status='published')
+
+    def revalidate(self, url, response, **params):
+        return self.client.get(url, params, HTTP_IF_NONE_MATCH=response['ETag'])
+
+    def test_article_revalidation_is_counted_without_rendering(self):
+        url = reverse('article_detail', args=[self.article.slug])
+        response = self.client.get(url)
+        self.assertTrue(response['ETag'].startswith('W/"'))
+        self.assertNotIn('Last-Modified', response)
+        self.assertIn('no-cache', response['Cache-Control'])
+
+        revalidated = self.revalidate(url, response)
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertTemplateNotUsed(revalidated, 'core/article_detail.html')
+        self.assertEqual(view_counters.pending(), 2)
+        # A date alone never revalidates a per-reader page
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT').status_code, 200)
+
+        # A new comment changes the page
+        Comment.objects.create(user=User.objects.create_user('leitor'), article=self.article, content='Oi')
+        self.assertEqual(self.revalidate(url, response).status_code, 200)
+
+    def test_validators_depend_on_reader_and_content(self):
+        url = reverse('course_detail', args=[self.course.slug])
+        anonymous = self.client.get(url)
+        self.assertEqual(self.revalidate(url, anonymous).status_code, 304)
+        Module.objects.create(course=self.course, title='Módulo 1', order=1)
+        cache.clear()
+        self.assertEqual(self.revalidate(url, anonymous).status_code, 200)
+
+        anonymous = self.client.get(url)
+        self.client.force_login(User.objects.create_user('leitor'))
+        self.assertEqual(self.revalidate(url, anonymous).status_code, 200)
+
+    def test_listing_revalidation(self):
+        url = reverse('content_list')
+        self.client.force_login(User.objects.create_user('leitor'))
+        response = self.client.get(url, {'category': 'artigo'})
+        self.assertEqual(self.revalidate(url, response, category='artigo').status_code, 304)
+        self.article.status = 'draft'
+        self.article.save()
+        self.assertEqual(self.revalidate(url, response, category='artigo').status_code, 200)
+
+    def test_cached_anonymous_page_revalidates(self):
+        url = reverse('content_list')
+        response = self.client.get(url)
+        revalidated = self.revalidate(url, response)
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(revalidated['ETag'], response['ETag'])
+
+
+class AnalyticsRouterTest(TestCase):
+    databases = {'default', 'analytics'}
+
+    def test_high_churn_tables_use_the_analytics_database(self):
+        router = AnalyticsRouter()
+        self.assertEqual(router.db_for_write(DailyVisit), 'analytics')
+        self.assertEqual(router.db_for_read(Session), 'analytics')
+        self.assertIsNone(router.db_for_write(Article))
+        self.assertTrue(router.allow_migrate('analytics', 'axes', 'accessattempt'))
+        self.assertFalse(router.allow_migrate('default', 'core', 'dailyvisit'))
+        self.assertFalse(router.allow_migrate('analytics', 'core', 'article'))
+        # Data migrations only run on the content database
+        self.assertFalse(router.allow_migrate('analytics', 'core'))
+
+        visit_aggregator.record(RequestFactory().get('/', HTTP_USER_AGENT='Mozilla/5.0'))
+        with self.assertNumQueries(0):
+            visit_aggregator.flush()
+        self.assertEqual(DailyVisit.objects.using('analytics').count(), 1)
+        self.assertNotIn(DailyVisit._meta.db_table, connections['default'].introspection.table_names())
+
+    def test_analytics_pragmas(self):
+        with connections['analytics'].cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+
+
+
+class MoveAnalyticsDataTest(TransactionTestCase):
+    databases = {'default', 'analytics'}
+
+    def setUp(self):
+        # Tables left in the content database from before the split
+        for model in (DailyVisit, MetricRollup, Session, AccessAttempt, AccessAttemptExpiration):
+            with connections['default'].schema_editor() as editor:
+                editor.create_model(model)
+            self.addCleanup(self.drop_table, model)
+
+    def drop_table(self, model):
+        with connections['default'].schema_editor() as editor:
+            editor.delete_model(model)
+
+    def sketch(self, *values):
+        sketch = HyperLogLog()
+        for value in values:
+            sketch.add_hash(value)
+        return sketch.to_bytes()
+
+    def test_conflicting_rows_are_merged(self):
+        old_day, shared_day = datetime.date(2025, 1, 1), datetime.date(2025, 1, 2)
+        expires = timezone.now() + timedelta(days=1)
+        # Same pks as the rows written after the split, and one shared date
+        DailyVisit.objects.using('default').create(pk=1, date=old_day, count=3)
+        DailyVisit.objects.using('default').create(pk=2, date=shared_day, count=2, sketch=self.sketch(1 << 60, 2 << 60))
+        MetricRollup.objects.using('default').create(pk=1, metric='revenue', period='day', bucket=old_day, value=Decimal('5'))
+        MetricRollup.objects.using('default').create(pk=2, metric='visits', period='day', bucket=old_day, value=Decimal('99'))
+        Session.objects.using('default').create(session_key='antiga', session_data='', expire_date=expires)
+        attempt = AccessAttempt.objects.using('default').create(pk=1, username='leitor', ip_address='10.0.0.1', failures_since_start=3)
+        AccessAttemptExpiration.objects.using('default').create(access_attempt_id=attempt.pk, expires_at=expires)
+        AccessAttempt.objects.using('analytics').create(pk=1, username='outro', ip_address='10.0.0.2', failures_since_start=1)
+        DailyVisit.objects.using('analytics').create(pk=1, date=shared_day, count=2, sketch=self.sketch(2 << 60, 3 << 60))
+        DailyVisit.objects.using('analytics').create(pk=2, date=datetime.date(2025, 1, 3), count=1)
+        MetricRollup.objects.using('analytics').create(pk=1, metric='revenue', period='day', bucket=old_day, value=Decimal('2'))
+
+        out = io.StringIO()
+        call_command('move_analytics_data', stdout=out)
+        self.assertIn('core.DailyVisit: 2 rows', out.getvalue())
+
+        visits = dict(DailyVisit.objects.using('analytics').values_list('date', 'count'))
+        self.assertEqual(visits, {old_day: 3, shared_day: 3, datetime.date(2025, 1, 3): 1})
+        revenue = MetricRollup.objects.using('analytics').get(metric='revenue', period='day', bucket=old_day)
+        self.assertEqual(revenue.value, Decimal('7'))
+        self.assertEqual(rollups.total('visits', old_day, old_day), 3)
+        self.assertEqual(rollups.total('visits', old_day, shared_day, 'month'), 7)
+        self.assertTrue(Session.objects.using('analytics').filter(session_key='antiga').exists())
+        moved = AccessAttempt.objects.using('analytics').get(username='leitor')
+        self.assertNotEqual(moved.pk, 1)
+        self.assertEqual(AccessAttemptExpiration.objects.using('analytics').get().access_attempt_id, moved.pk)
+        for model in (DailyVisit, MetricRollup, Session, AccessAttempt, AccessAttemptExpiration):
+            self.assertFalse(model.objects.using('default').exists())
+
+    def test_clashing_rows_fail_without_deleting(self):
+        expires = timezone.now() + timedelta(days=1)
+        Session.objects.using('default').create(session_key='mesma', session_data='antiga', expire_date=expires)
+        Session.objects.using('analytics').create(session_key='mesma', session_data='nova', expire_date=expires)
+        with self.assertRaises(CommandError):
+            call_command('move_analytics_data', stdout=io.StringIO())
+        self.assertTrue(Session.objects.using('default').filter(session_key='mesma').exists())
+
+
+class SQLiteBackendTest(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'stress.sqlite3')
+        self.handler = ConnectionHandler({
+            'default': {'ENGINE': 'core.backends.sqlite3', 'NAME': self.path},
+            'read': {'ENGINE': 'core.backends.sqlite3', 'NAME': self.path, 'OPTIONS': {'read_only': True}},
+        })
+        self.addCleanup(self.handler.close_all)
+        with self.handler['default'].cursor() as cursor:
+            cursor.execute('CREATE TABLE counter (id INTEGER PRIMARY KEY, value INTEGER)')
+            cursor.execute('INSERT INTO counter VALUES (1, 0)')
+
+    def test_pragmas_and_read_only_connection(self):
+        with self.handler['default'].cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 10000)
+        with self.handler['read'].cursor() as cursor:
+            cursor.execute('SELECT value FROM counter')
+            self.assertEqual(cursor.fetchone()[0], 0)
+            with self.assertRaises(OperationalError):
+                cursor.execute('UPDATE counter SET value = 1')
+
+    def test_concurrent_read_modify_write_transactions(self):
+        threads, iterations = 8, 25
+        errors = []
+
+        def worker():
+            try:
+                for _ in range(iterations):
+                    # BEGIN IMMEDIATE: the read below already holds the write lock
+                    with transaction.atomic(using='default'), self.handler['default'].cursor() as cursor:
+                        cursor.execute('SELECT value FROM counter WHERE id = 1')
+                        value = cursor.fetchone()[0]
+                        time.sleep(0.0005)
+                        cursor.execute('UPDATE counter SET value = %s WHERE id = 1', [value + 1])
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                self.handler['default'].close()
+
+        with patch('django.db.transaction.connections', self.handler):
+            workers = [threading.Thread(target=worker) for _ in range(threads)]
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+
+        self.assertEqual(errors, [])
+        with self.handler['default'].cursor() as cursor:
+            cursor.execute('SELECT value FROM counter WHERE id = 1')
+            self.assertEqual(cursor.fetchone()[0], threads * iterations)
+
+
+class SessionTest(TestCase):
+    databases = {'default', 'analytics'}
+
+    def setUp(self):
+        cache.clear()
+        Article.objects.create(title='Sem sessão', content='<p>Texto</p>', status='published')
+
+    def test_anonymous_browsing_creates_no_session(self):
+        article = Article.objects.get()
+        for url in (reverse('home'), reverse('content_list'), reverse('article_detail', args=[article.slug])):
+            response = self.client.get(url, HTTP_USER_AGENT='Mozilla/5.0')
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn(settings.SESSION_COOKIE_NAME, response.cookies)
+        self.assertFalse(Session.objects.exists())
+
+        self.client.force_login(User.objects.create_user('leitor'))
+        self.assertEqual(Session.objects.count(), 1)
+
+    def test_expired_sessions_are_deleted_in_batches(self):
+        now = timezone.now()
+        Session.objects.bulk_create(
+            [Session(session_key=f'expired{i:03}', session_data='', expire_date=now - datetime.timedelta(days=1)) for i in range(5)]
+            + [Session(session_key='current', session_data='', expire_date=now + datetime.timedelta(days=1))]
+        )
+        with CaptureQueriesContext(connections['analytics']) as queries:
+            self.assertEqual(clear_expired_sessions(batch_size=2), 5)
+        deletes = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('DELETE')]
+        self.assertEqual(len(deletes), 3)
+        self.assertEqual(list(Session.objects.values_list('session_key', flat=True)), ['current'])
+
+    def test_worker_survives_errors(self):
+        class Stop(Exception):
+            pass
+
+        with patch('core.management.commands.clear_expired_sessions.clear_expired_sessions',
+                   side_effect=[OperationalError('database is locked'), 0]) as clear, \
+                patch('core.management.commands.clear_expired_sessions.time.sleep', side_effect=[None, Stop]):
+            with self.assertLogs('core.management.commands.clear_expired_sessions', 'ERROR'), self.assertRaises(Stop):
+                call_command('clear_expired_sessions', '--interval', '3600', stdout=io.StringIO())
+        self.assertEqual(clear.call_count, 2)
@@ -1,57 +1,80 @@
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
-from django.http import FileResponse, Http404, HttpResponseForbidden, JsonResponse
+from django.http import Http404, HttpResponseForbidden, JsonResponse
+from django.utils.cache import patch_vary_headers
 from django.contrib import messages
-from django.db.models import F
-from .models import Article, Course, Lesson, Plan, ShopItem, PaymentHistory, CourseProgress, Comment, DailyVisit, UserProfile
+from django.core.paginator import Paginator
+from django.utils import timezone
+from datetime import timedelta
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from .models import Article, Course, Lesson, ShopItem, Tag, PaymentHistory, CourseProgress, Comment, UserProfile
 from .forms import CommentForm
+from . import search
+from .comments import load_comment_tree, CURSOR_PARAM
+from .outline import get_course_outline
+from .counters import count_view, pending_increments
+from . import rollups
+from .entitlements import get_entitlement
+from .plans import get_registry
+from .file_serving import serve_file
+from .storage import EncryptedFileError
+from .tags import tag_cloud
+from .page_cache import anonymous_page_cache
+from .conditional import article_validators, course_validators, listing_validators
+from .routers import read_db
 
 def check_plan_access(user, required_plan):
-    if not required_plan:
-        return True
-    
-    # Allow access if the plan level is 0 (Free/Public)
-    if required_plan.level == 0:
-        return True
-        
-    if not user.is_authenticated:
-        return False
-    if not hasattr(user, 'profile') or not user.profile.current_plan:
-        return False
-    return user.profile.current_plan.level >= required_plan.level
+    return get_entitlement(user).can_access(required_plan)
 
+@anonymous_page_cache('articles', 'plans')
 def home(request):
-    latest_articles = Article.objects.filter(status='published').order_by('-created_at')[:3]
+    latest_articles = Article.objects.using(read_db()).filter(status='published').select_related('required_plan').order_by('-created_at')[:3]
     return render(request, 'core/index.html', {'latest_articles': latest_articles})
 
+@anonymous_page_cache('articles', 'courses', 'plans', params=('category', 'tag'))
 def content_list(request):
     category = request.GET.get('category')
     query = request.GET.get('q')
-    articles = Article.objects.filter(status='published')
-    courses = Course.objects.filter(status='published')
+    tag_slug = request.GET.get('tag')
+    articles = Article.objects.using(read_db()).filter(status='published').select_related('required_plan')
+    courses = Course.objects.using(read_db()).filter(status='published')
     
     if category:
         articles = articles.filter(category=category)
+
+    current_tag = None
+    if tag_slug:
+        current_tag = Tag.objects.filter(slug=tag_slug).first()
+        articles = articles.filter(tag_set=current_tag) if current_tag else articles.none()
     
     if query:
-        articles = articles.filter(title__icontains=query) | articles.filter(summary__icontains=query) | articles.filter(content__icontains=query)
+        articles = search.search_articles(articles, query, category=category)
         courses = courses.filter(title__icontains=query)
-        
-    return render(request, 'core/content_list.html', {
-        'articles': articles.distinct(), 
+
+    validators = listing_validators(request, articles, courses)
+    not_modified = validators.not_modified(request)
+    if not_modified is not None:
+        return not_modified
+    return validators.apply(render(request, 'core/content_list.html', {
+        'articles': articles, 
         'current_category': category,
+        'current_tag': current_tag,
+        'tag_slug': tag_slug,
+        'tag_cloud': tag_cloud(),
         'query': query
-    })
+    }))
 
+@anonymous_page_cache('courses')
 def course_list(request):
-    courses = Course.objects.filter(status='published')
+    courses = Course.objects.using(read_db()).filter(status='published')
     return render(request, 'core/course_list.html', {'courses': courses})
 
 def article_detail(request, slug):
-    article = get_object_or_404(Article, slug=slug, status='published')
+    article = get_object_or_404(Article.objects.select_related('required_plan'), slug=slug, status='published')
     
-    # Increment views
-    Article.objects.filter(pk=article.pk).update(views=F('views') + 1)
+    # Increment views (buffered, see core.counters)
+    count_view(article)
     
     if not check_plan_access(request.user, article.required_plan):
         if not request.user.is_authenticated:
@@ -59,8 +82,7 @@ def article_detail(request, slug):
         messages.warning(request, 'Este conteúdo requer um plano superior.')
         return redirect('subscribe')
     
-    comments = article.comments.filter(active=True, parent__isnull=True)
-    
+    validators = None
     if request.method == 'POST':
         if not request.user.is_authenticated:
             return redirect('account_login')
@@ -73,36 +95,55 @@ def article_detail(request, slug):
             parent_id = request.POST.get('parent_id')
             if parent_id:
                 try:
-                    parent_comment = Comment.objects.get(id=parent_id)
+                    parent_comment = Comment.objects.get(id=parent_id, article=article)
                     comment.parent = parent_comment
-                except Comment.DoesNotExist:
+                except (Comment.DoesNotExist, ValueError):
                     pass
             
             comment.save()
             messages.success(request, 'Comentário enviado com sucesso!')
             return redirect('article_detail', slug=slug)
     else:
+        # Revalidations were counted above (see core.conditional)
+        validators = article_validators(request, article)
+        not_modified = validators.not_modified(request)
+        if not_modified is not None:
+            return not_modified
         form = CommentForm()
         
-    return render(request, 'core/article_detail.html', {
+    response = render(request, 'core/article_detail.html', {
         'article': article,
-        'comments': comments,
-        'comment_form': form
+        'comments': load_comment_tree(article=article, cursor=request.GET.get(CURSOR_PARAM)),
+        'comment_form': form,
+        # Precomputed by core.related
+        'related_articles': [
+            link.related for link in
+            article.related_links.filter(related__status='published').select_related('related')
+        ],
     })
+    return validators.apply(response) if validators else response
 
 def course_detail(request, slug):
     course = get_object_or_404(Course, slug=slug, status='published')
     
-    # Increment views
-    Course.objects.filter(pk=course.pk).update(views=F('views') + 1)
+    # Increment views (buffered, see core.counters)
+    count_view(course)
     
-    return render(request, 'core/course_detail.html', {'course': course})
+    outline = get_course_outline(course.pk)
+    validators = course_validators(request, course, outline)
+    not_modified = validators.not_modified(request)
+    if not_modified is not None:
+        return not_modified
+    return validators.apply(render(request, 'core/course_detail.html', {
+        'course': course,
+        'outline': outline,
+    }))
 
 def lesson_detail(request, course_slug, lesson_id):
     course = get_object_or_404(Course, slug=course_slug, status='published')
     lesson = get_object_or_404(Lesson, id=lesson_id, course=course)
-    
-    comments = lesson.comments.filter(active=True, parent__isnull=True)
+    outline = get_course_outline(course.pk)
+    previous_lesson, next_lesson = outline.neighbours(lesson.pk)
     
     is_completed = False
     if request.user.is_authenticated:
@@ -120,9 +161,9 @@ def lesson_detail(request, course_slug, lesson_id):
             parent_id = request.POST.get('parent_id')
             if parent_id:
                 try:
-                    parent_comment = Comment.objects.get(id=parent_id)
+                    parent_comment = Comment.objects.get(id=parent_id, lesson=lesson)
                     comment.parent = parent_comment
-                except Comment.DoesNotExist:
+                except (Comment.DoesNotExist, ValueError):
                     pass
             
             comment.save()
@@ -134,7 +175,10 @@ def lesson_detail(request, course_slug, lesson_id):
     return render(request, 'core/lesson_detail.html', {
         'course': course, 
         'lesson': lesson,
-        'comments': comments,
+        'outline': outline,
+        'previous_lesson': previous_lesson,
+        'next_lesson': next_lesson,
+        'comments': load_comment_tree(lesson=lesson, cursor=request.GET.get(CURSOR_PARAM)),
         'comment_form': form,
         'is_completed': is_completed
     })
@@ -143,6 +187,7 @@ def news(request):
     # Placeholder
     return render(request, 'core/news.html')
 
+@anonymous_page_cache()
 def about(request):
     return render(request, 'core/about.html')
 
@@ -154,14 +199,31 @@ def members(request):
     if request.user.is_staff:
         # Admin Dashboard Logic
         subscribers = UserProfile.objects.filter(current_plan__level__gt=0).select_related('user', 'current_plan')
-        payments = PaymentHistory.objects.all().select_related('user').order_by('-date')
+        payments = Paginator(PaymentHistory.objects.all().select_related('user').order_by('-date'), 25)
+        payments_page = payments.get_page(request.GET.get('pagina'))
         
-        # Daily Access (last 30 days)
-        daily_visits = DailyVisit.objects.all().order_by('date') # Ascending for chart
-        # Limit to last 30 days in template or here? Let's take last 30 here.
-        daily_visits = list(daily_visits) # Evaluate
-        if len(daily_visits) > 30:
-            daily_visits = daily_visits[-30:]
+        # Visits, revenue and subscriptions from the rollup tables (default: last 30 days)
+        today = timezone.localdate()
+        end = min(rollups.parse_day(request.GET.get('fim')) or today, today)
+        start = rollups.parse_day(request.GET.get('inicio')) or end - timedelta(days=29)
+        if start > end:
+            start, end = end, start
+        range_error = None
+        if (end - start).days >= rollups.MAX_RANGE_DAYS:
+            # Like an invalid date: back to the default range
+            range_error = f'Escolha um período de até {rollups.MAX_RANGE_DAYS} dias.'
+            start, end = today - timedelta(days=29), today
+        period = request.GET.get('periodo')
+        if period not in rollups.PERIODS:
+            period = 'day'
+        # Show the days the week/month buckets actually cover
+        start, end = rollups.bucket_range(start, end, period)
+        visit_series = rollups.series('visits', start, end, period)
+        revenue_series = rollups.series('revenue', start, end, period)
+        totals = {
+            metric: sum(value for _, value in rollups.series(metric, start, end, period))
+            for metric in ('new_subscribers', 'churn')
+        }
         
         # Most Accessed Content
         popular_articles = Article.objects.filter(status='published').order_by('-views')[:5]
@@ -169,10 +231,20 @@ def members(request):
         
         return render(request, 'core/staff_dashboard.html', {
             'subscribers': subscribers,
-            'payments': payments,
-            'daily_visits': daily_visits,
+            'payments': payments_page,
+            'visit_series': visit_series,
+            'revenue_series': revenue_series,
+            'total_visits': sum(value for _, value in visit_series),
+            'total_revenue': sum(value for _, value in revenue_series),
+            'new_subscribers': totals['new_subscribers'],
+            'churn': totals['churn'],
+            'range_start': start,
+            'range_end': end,
+            'range_error': range_error,
+            'period': period,
             'popular_articles': popular_articles,
             'popular_courses': popular_courses,
+            'pending_view_increments': pending_increments(),
         })
 
     # 1. Plan Status
@@ -185,17 +257,24 @@ def members(request):
     # 3. Replies to comments
     # Find comments where the parent is one of the user's comments
     user_comments = Comment.objects.filter(user=request.user)
-    replies = Comment.objects.filter(parent__in=user_comments, active=True).order_by('-created_at')
+    replies = Comment.objects.filter(parent__in=user_comments, active=True).select_related('user', 'article', 'lesson__course').order_by('-created_at')
 
     # 4. Course Progress
-    courses = Course.objects.filter(status='published')
+    # Lesson totals and the user's completed lessons come back as correlated
+    # subqueries, so the whole list is a single query however many courses exist.
+    total_lessons = Lesson.objects.filter(course=OuterRef('pk')).order_by().values('course').annotate(c=Count('pk')).values('c')
+    completed_lessons = CourseProgress.objects.filter(
+        user=request.user, lesson__course=OuterRef('pk')
+    ).order_by().values('lesson__course').annotate(c=Count('pk')).values('c')
+    courses = Course.objects.filter(status='published').annotate(
+        total_lessons=Coalesce(Subquery(total_lessons), 0),
+        completed_lessons=Coalesce(Subquery(completed_lessons), 0),
+    )
     course_data = []
     
     for course in courses:
-        total_lessons = course.lessons.count()
-        if total_lessons > 0:
-            completed_lessons = CourseProgress.objects.filter(user=request.user, lesson__course=course).count()
-            progress_percent = int((completed_lessons / total_lessons) * 100)
+        if course.total_lessons > 0:
+            progress_percent = int((course.completed_lessons / course.total_lessons) * 100)
         else:
             progress_percent = 0
             
@@ -231,9 +310,10 @@ def mark_lesson_completed(request, lesson_id):
     return redirect('home')
 
 def subscribe(request):
-    apoiador = Plan.objects.filter(name='Apoiador').first()
-    irrestrito = Plan.objects.filter(name='Irrestrito').first()
-    mecenas = Plan.objects.filter(name='Mecenas').first()
+    plans = get_registry()
+    apoiador = plans.named('Apoiador')
+    irrestrito = plans.named('Irrestrito')
+    mecenas = plans.named('Mecenas')
     
     context = {
         'apoiador': apoiador,
@@ -243,26 +323,33 @@ def subscribe(request):
     return render(request, 'core/subscribe.html', context)
 
 def serve_protected_pdf(request, slug):
-    article = get_object_or_404(Article, slug=slug, status='published')
+    article = get_object_or_404(Article.objects.select_related('required_plan'), slug=slug, status='published')
     
     if not check_plan_access(request.user, article.required_plan):
         return HttpResponseForbidden("Você não tem permissão para acessar este documento.")
 
-    if not article.pdf_file:
+    # The PDF field is currently disabled on Article; keep the endpoint safe
+    pdf_file = getattr(article, 'pdf_file', None)
+    if not pdf_file:
         raise Http404("PDF not found")
-    
-    # Open the file using the storage backend (which handles decryption)
+
+    # The storage backend handles decryption; only the requested range is read
+    storage, name = pdf_file.storage, pdf_file.name
     try:
-        file_handle = article.pdf_file.open()
-        response = FileResponse(file_handle, content_type='application/pdf')
-        response['Content-Disposition'] = 'inline; filename="{}.pdf"'.format(article.slug)
-        # Add headers to prevent caching and discourage saving
-        response['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
-        response['Pragma'] = 'no-cache'
-        return response
-    except Exception:
+        size = storage.size(name)
+        modified = storage.get_modified_time(name)
+    except (OSError, EncryptedFileError):
+        # Missing, or corrupt/truncated ciphertext
         raise Http404("Error reading PDF")
+    # Private: browsers may keep the file but must revalidate every time
+    response = serve_file(
+        request, lambda: storage.open(name), size, modified, 'application/pdf',
+        'private, no-cache', filename=f'{article.slug}.pdf',
+    )
+    patch_vary_headers(response, ['Cookie'])
+    return response
 
+@anonymous_page_cache('shop')
 def shop(request):
-    items = ShopItem.objects.filter(active=True)
+    items = ShopItem.objects.using(read_db()).filter(active=True)
     return render(request, 'core/shop.html', {'items': items})
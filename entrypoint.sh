@@ -1,8 +1,30 @@
 #!/bin/bash
 set -e
 
+# Run a background worker, restarting it (with a pause) whenever it exits
+supervise() {
+    while true; do
+        "$@" || true
+        echo "$* exited, restarting in 5s..." >&2
+        sleep 5
+    done
+}
+
 echo "Running database migrations..."
 python manage.py migrate --noinput
+python manage.py migrate --database analytics --noinput
+
+echo "Starting Stripe event worker..."
+supervise python manage.py process_stripe_events &
+
+echo "Starting body image optimizer..."
+supervise python manage.py optimize_body_images --interval 300 --workers 1 &
+
+echo "Starting related content worker..."
+supervise python manage.py refresh_related_articles --interval 60 &
+
+echo "Starting expired session cleanup..."
+supervise python manage.py clear_expired_sessions --interval 3600 &
 
 echo "Starting Gunicorn..."
 exec gunicorn config.wsgi:application --bind 0.0.0.0:8000 --timeout 120 --workers 3 --access-logfile - --error-logfile -
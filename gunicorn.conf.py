@@ -0,0 +1,12 @@
+# Gunicorn reads this file from the working directory on startup; the
+# command-line flags in entrypoint.sh still take precedence.
+
+
+def worker_exit(server, worker):
+    # Write any buffered page views, visits and cache stats before the worker goes away.
+    from core.counters import flush_view_counters
+    from core.document_cache import retire_worker_stats
+    from core.visits import flush_visits
+    flush_view_counters()
+    flush_visits()
+    retire_worker_stats()